@@ -0,0 +1,81 @@
+# Copy of TPM_Hud.py, the Raspberry Pi folder is copied to the Pi on its own (see run_on_boot.sh) and may not import
+# from the main folder. Changes go into both files.
+import time
+
+
+class HudText:
+    """
+    Block of text lines for the heads-up display of the experiment loops. Every line is split into its label (up to
+    the last ': ') and its value, which are kept as separate surfaces. Labels are rendered once per session, values
+    only when they changed and unchanged lines are not touched at all. With an interval above 0, due() is only True
+    once per interval, so the lines (and the formatting of their values) can be updated less often than the display.
+    """
+    def __init__(self, font, position=(0, 0), color=(255, 255, 255), align='left', interval=0.):
+        assert align in ('left', 'right'), \
+            'The text must be aligned left (position is the top left corner) or right (top right corner).'
+        assert interval >= 0, \
+            'The interval must be a duration in seconds (0 or more).'
+
+        self.font = font
+        self.position = position
+        self.color = color
+        self.align = align
+        self.interval = interval
+
+        self.label_surfaces = {}
+        self.lines = []
+        self.surfaces = []
+        self.last_update = None
+
+    def due(self):
+        return self.last_update is None or time.perf_counter() - self.last_update >= self.interval
+
+    def _render(self, text):
+        return self.font.render(text, False, self.color)
+
+    def _line_surfaces(self, line, old_line=None, old_surfaces=None):
+        label, separator, value = line.rpartition(': ')
+        label += separator
+        if label not in self.label_surfaces:
+            self.label_surfaces[label] = self._render(label) if label else None
+        # A line that only changed its label keeps its value surface
+        if old_line is not None and old_line.rpartition(': ')[2] == value:
+            return self.label_surfaces[label], old_surfaces[1]
+        return self.label_surfaces[label], self._render(value)
+
+    def update(self, lines):
+        """
+        :param lines: list of strings, only the parts that differ from the last update are rendered again
+        """
+        self.last_update = time.perf_counter()
+        for i, line in enumerate(lines):
+            if i < len(self.lines):
+                if self.lines[i] != line:
+                    self.surfaces[i] = self._line_surfaces(line, self.lines[i], self.surfaces[i])
+                    self.lines[i] = line
+            else:
+                self.lines.append(line)
+                self.surfaces.append(self._line_surfaces(line))
+        del self.lines[len(lines):]
+        del self.surfaces[len(lines):]
+
+    def items(self):
+        """
+        :return: list of (surface, position) of the labels and values, e.g. for parent.blit
+        """
+        x, y = self.position
+        line_height = self.font.get_linesize()
+        items = []
+        for i, (label_surface, value_surface) in enumerate(self.surfaces):
+            label_width = label_surface.get_width() if label_surface else 0
+            line_x = x - label_width - value_surface.get_width() if self.align == 'right' else x
+            if label_surface:
+                items.append((label_surface, (line_x, y + line_height * i)))
+            items.append((value_surface, (line_x + label_width, y + line_height * i)))
+        return items
+
+    def blit(self, parent):
+        """
+        :return: list of the changed areas of the parent
+        """
+        return [parent.blit(surface, position) for surface, position in self.items()]
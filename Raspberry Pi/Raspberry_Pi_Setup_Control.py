@@ -13,6 +13,7 @@ import pygame
 
 # project modules
 from Raspberry_Pi_Utility import Instructions
+from Raspberry_Pi_Hud import HudText
 
 
 class MarkerLayer:
@@ -241,6 +242,10 @@ def experiment_loop(instruction_pipe, settings):
     scaled_surface = pygame.Surface((int(display_info.current_w * scale), int(display_info.current_h * scale)))
     scaled_surface_size = scaled_surface.get_size()
 
+    # Debug text, the values are only formatted and drawn again every hud_interval seconds
+    hud = HudText(font, (scaled_surface_size[0] - int(650 * scale), 0), interval=settings['hud_interval'])
+    fps_hud = HudText(pygame.font.SysFont('Comic Sans MS', int(30 * scale)))
+
     # Create Screen objects
     marker_height = marker_height_cm * p_cm_ratio
     marker_layer = MarkerLayer(scaled_surface, (ahead_buffer, onscreen_objects, behind_buffer),
@@ -305,7 +310,6 @@ def experiment_loop(instruction_pipe, settings):
         fps_time = trial_start_time
         x = 0.5
         counter = 0
-        text_surface = pygame.Surface((100, 100))
 
     timestamp_volt = time.perf_counter() - trial_start_time     # separate recorder!!!
     if simulation:
@@ -479,20 +483,16 @@ def experiment_loop(instruction_pipe, settings):
             else:
                 phase = 'Inactive'
 
-            text = [f"Phase: {phase}",
-                    f"Screen speed: {speed_multiplier * delta_position_real / (timestamp_volt - timestamp_last_frame)}",
-                    f"Volt position [in V]: {position_volt}",
-                    f"Volt delta [in V]: {delta_position_volt}",
-                    f"Virtual position [in cm]: {tube_position}",
-                    f"Current disk state: {disk_names[disk_state]}"]
-
-            text_rects = []
+            if hud.due():
+                speed = speed_multiplier * delta_position_real / (timestamp_volt - timestamp_last_frame)
+                hud.update([f"Phase: {phase}",
+                            f"Screen speed: {speed}",
+                            f"Volt position [in V]: {position_volt}",
+                            f"Volt delta [in V]: {delta_position_volt}",
+                            f"Virtual position [in cm]: {tube_position}",
+                            f"Current disk state: {disk_names[disk_state]}"])
 
-            for i, l in enumerate(text):
-                render = font.render(l, 0, (255, 255, 255))
-                text_rects.append(scaled_surface.blit(render,
-                                                      (scaled_surface_size[0] - int(650 * scale),
-                                                       0 + font.get_linesize() * i)))
+            text_rects = hud.blit(scaled_surface)
 
             text_union_rect = text_rects[0].unionall(text_rects[1:])
             text_union_rect.width = int(650 * scale)
@@ -501,12 +501,10 @@ def experiment_loop(instruction_pipe, settings):
         if show_fps:
             counter += 1
             if (time.perf_counter() - fps_time) > x:
-                my_font = pygame.font.SysFont('Comic Sans MS', int(30 * scale))
-                text_surface = my_font.render(f'FPS: {int(counter / (time.perf_counter() - fps_time))}',
-                                              False, (255, 255, 255))
+                fps_hud.update([f'FPS: {int(counter / (time.perf_counter() - fps_time))}'])
                 counter = 0
                 fps_time = time.perf_counter()
-            update_rectangle_list.append(scaled_surface.blit(text_surface, (0, 0)))
+            update_rectangle_list.extend(fps_hud.blit(scaled_surface))
 
         pygame.transform.scale(scaled_surface, (display_info.current_w, display_info.current_h),
                                screen_surface)
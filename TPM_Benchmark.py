@@ -0,0 +1,173 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+import TPM_Recorder
+import TPM_Records
+import TPM_RingBuffer
+import TPM_Utility
+
+# Output of the recorder, None only fills the sample ring
+BENCHMARK_BACKENDS = {
+    'csv': 'csv',
+    'binary': 'binary',
+    'ring': None
+}
+
+# Timing strategy -> keyword arguments of the unlimited_recorder_func, rate is the target rate of the paced ones
+BENCHMARK_TIMINGS = {
+    'free': lambda rate: {'target_sps': None},
+    'sleep': lambda rate: {'target_sps': rate, 'spin_tail': 0.},
+    'deadline': lambda rate: {'target_sps': rate, 'spin_tail': 0.0005},
+    'spin': lambda rate: {'target_sps': rate, 'spin_tail': float('inf')}
+}
+
+
+def config_stream_rates(config_location='config.json'):
+    """returns the stream rates of the recorder settings, so the benchmark publishes like the experiment does
+    """
+    try:
+        with open(config_location) as json_data_file:
+            return tuple(json.load(json_data_file)["settings"]["recorder"]["stream_rates"])
+    except (OSError, KeyError):
+        return (1000, 100, 10)
+
+
+def machine_info():
+    """describes the machine, on a Raspberry Pi including the model from the device tree
+    """
+    info = {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count()
+    }
+    try:
+        with open('/proc/device-tree/model') as model_file:
+            info['model'] = model_file.read().strip('\x00\n')
+    except OSError:
+        info['model'] = None
+    return info
+
+
+def run_benchmark(backend, timing, duration=10., target_sps=1000, directory=None, stream_rates=None):
+    """
+    Runs the unlimited_recorder_func for a fixed duration with simulated signals.
+    :param backend: key of BENCHMARK_BACKENDS
+    :param timing: key of BENCHMARK_TIMINGS
+    :param duration: sampling time in seconds
+    :param target_sps: target rate of the paced timing strategies
+    :param directory: folder of the record file, a temporary folder if None
+    :param stream_rates: rates of the decimated streams published next to the raw samples, defaults to config.json
+    :return: dict with the sustained rate, inter-sample intervals and cpu time of the recorder process
+    """
+    assert backend in BENCHMARK_BACKENDS, \
+        f'Backend must be one of {tuple(BENCHMARK_BACKENDS.keys())}.'
+    assert timing in BENCHMARK_TIMINGS, \
+        f'Timing must be one of {tuple(BENCHMARK_TIMINGS.keys())}.'
+
+    instructions = TPM_Utility.Instructions
+    if stream_rates is None:
+        stream_rates = config_stream_rates()
+    # Same publishing as in the experiment loop, including the decimation of the summary streams
+    sample_ring = TPM_RingBuffer.SampleStreams(TPM_RingBuffer.SAMPLE_COLUMNS, rates=stream_rates)
+    go_event = multiprocessing.Event()
+    to_recorder, recorder_instructions = multiprocessing.Pipe()
+    kwargs = dict(BENCHMARK_TIMINGS[timing](target_sps), backend=BENCHMARK_BACKENDS[backend])
+    record_process = multiprocessing.Process(target=TPM_Recorder.unlimited_recorder_func,
+                                             args=(instructions, go_event, sample_ring, recorder_instructions),
+                                             kwargs=kwargs)
+
+    with tempfile.TemporaryDirectory(dir=directory) as temporary_directory:
+        extension = TPM_Records.RECORD_EXTENSIONS.get(backend, '.rec')
+        file_location = os.path.join(temporary_directory, f'benchmark_{backend}_{timing}{extension}')
+
+        record_process.start()
+        to_recorder.send(instructions.Reset)
+        to_recorder.send(file_location)
+        go_event.set()
+        to_recorder.send(instructions.Ready)
+        time.sleep(duration)
+        to_recorder.send(instructions.Stop)
+        run = to_recorder.recv()
+        record_process.join()
+        file_size = os.path.getsize(file_location) if os.path.exists(file_location) else 0
+
+    sample_ring.close()
+
+    timing_statistics = run['timing']
+    return {
+        'backend': backend,
+        'timing': timing,
+        'target_sps': kwargs['target_sps'],
+        'stream_rates': list(stream_rates),
+        'samples': run['samples'],
+        'duration': run['duration'],
+        'sps': run['samples'] / run['duration'] if run['duration'] > 0 else 0.,
+        'interval_p50': timing_statistics['interval_p50'],
+        'interval_p99': timing_statistics['interval_p99'],
+        'lateness_p99': timing_statistics['lateness_p99'],
+        'missed': timing_statistics['missed'],
+        'cpu_time': run['cpu_time'],
+        'cpu_load': run['cpu_time'] / run['duration'] if run['duration'] > 0 else 0.,
+        'file_size': file_size,
+        'storage': run['storage']
+    }
+
+
+def run_suite(backends=tuple(BENCHMARK_BACKENDS), timings=tuple(BENCHMARK_TIMINGS), duration=10., target_sps=1000,
+              directory=None, stream_rates=None):
+    """
+    Runs every combination of backend and timing strategy one after the other.
+    :return: dict with the machine info, the settings and one result per combination
+    """
+    results = []
+    for backend in backends:
+        for timing in timings:
+            print(f'BENCHMARK {backend} / {timing} ...')
+            result = run_benchmark(backend, timing, duration, target_sps, directory, stream_rates)
+            print(f'{result["sps"]:.0f}sps, interval p50 {result["interval_p50"] * 1e6:.0f}µs / '
+                  f'p99 {result["interval_p99"] * 1e6:.0f}µs, cpu {result["cpu_load"] * 100:.0f}%')
+            results.append(result)
+
+    return {
+        'created': datetime.datetime.now().isoformat(),
+        'machine': machine_info(),
+        'duration': duration,
+        'target_sps': target_sps,
+        'results': results
+    }
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Throughput benchmark of the recorder with fake hardware.')
+    argument_parser.add_argument('--backends', nargs='+', default=list(BENCHMARK_BACKENDS),
+                                 choices=list(BENCHMARK_BACKENDS))
+    argument_parser.add_argument('--timings', nargs='+', default=list(BENCHMARK_TIMINGS),
+                                 choices=list(BENCHMARK_TIMINGS))
+    argument_parser.add_argument('--duration', type=float, default=10., help='seconds per combination')
+    argument_parser.add_argument('--target-sps', type=float, default=1000, help='rate of the paced timings')
+    argument_parser.add_argument('--directory', default=None, help='folder for the record files (default: temp)')
+    argument_parser.add_argument('--stream-rates', nargs='*', type=float, default=None,
+                                 help='rates of the decimated streams (default: from config.json)')
+    argument_parser.add_argument('--output', default=None, help='json file (default: benchmark_<date>.json)')
+    arguments = argument_parser.parse_args()
+
+    suite = run_suite(arguments.backends, arguments.timings, arguments.duration, arguments.target_sps,
+                      arguments.directory, arguments.stream_rates)
+
+    output_location = arguments.output
+    if output_location is None:
+        output_location = f'benchmark_{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.json'
+    with open(output_location, 'w') as output_file:
+        json.dump(suite, output_file, indent=4)
+    print(f'RESULTS SAVED TO {output_location}')
+
+
+if __name__ == '__main__':
+    main()
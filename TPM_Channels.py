@@ -0,0 +1,98 @@
+import TPM_Hardware
+import TPM_Records
+
+CHANNEL_TYPES = ('ads', 'gpio')
+
+# Same acquisition as before the channel table existed, used if config.json has no channel list
+DEFAULT_CHANNELS = (
+    {'name': 'Position', 'type': 'ads', 'input': 'P0', 'gain': 2 / 3},
+    {'name': 'Speed', 'type': 'ads', 'input': 'P1', 'gain': 2 / 3},
+    {'name': 'Mouse Lick', 'type': 'gpio', 'pin': 'mouse_lick_in'},
+    {'name': 'Rat Lick', 'type': 'gpio', 'pin': 'rat_lick_in'}
+)
+
+
+class Channel:
+    """
+    One input of the recorder. ADS channels are a single ended input (P0-P3) or a differential pair (e.g. P0-P1) of
+    the ADS1115 with their own gain, GPIO channels are a pin of the Raspberry Pi which is stored as 0/1.
+    """
+    def __init__(self, name, type, input=None, gain=2 / 3, pin=None, enabled=True):
+        assert type in CHANNEL_TYPES, \
+            f'Channel type must be one of {CHANNEL_TYPES}.'
+        if type == 'ads':
+            assert input in TPM_Hardware.ADS_MUX, \
+                f'ADS input of {name} must be one of {tuple(TPM_Hardware.ADS_MUX.keys())}.'
+            assert gain in TPM_Hardware.ADS_GAIN, \
+                f'Gain of {name} must be one of {tuple(TPM_Hardware.ADS_GAIN.keys())}.'
+        else:
+            assert isinstance(pin, int) and 0 <= pin < 32, \
+                f'Pin of {name} must be a GPIO number of bank 1 (0-31).'
+
+        self.name = name
+        self.type = type
+        self.input = input
+        self.gain = gain
+        self.pin = pin
+        self.enabled = enabled
+
+    def meta(self):
+        if self.type == 'ads':
+            return {'name': self.name, 'type': self.type, 'input': self.input, 'gain': self.gain}
+        return {'name': self.name, 'type': self.type, 'pin': self.pin}
+
+
+class ChannelTable:
+    """
+    Declarative list of the recorded channels. Disabled channels are dropped here, so the recorders neither read nor
+    store them. A sample row is always the timestamp, the voltages of the ADS channels and the levels of the GPIO
+    channels, in the order of the table. The sample ring only gets the timestamp and the ADS channels.
+    """
+    def __init__(self, channels):
+        self.channels = tuple(channel for channel in channels if channel.enabled)
+        names = [channel.name for channel in self.channels]
+        assert len(set(names)) == len(names), \
+            'Channel names must be unique.'
+        assert 'Timestamp' not in names, \
+            'Timestamp is added by the recorder and can not be used as channel name.'
+
+        self.ads_channels = tuple(channel for channel in self.channels if channel.type == 'ads')
+        self.gpio_channels = tuple(channel for channel in self.channels if channel.type == 'gpio')
+        self.ads_inputs = tuple(channel.input for channel in self.ads_channels)
+        self.ads_gains = tuple(channel.gain for channel in self.ads_channels)
+        self.gpio_pins = tuple(channel.pin for channel in self.gpio_channels)
+
+        self.ring_columns = ('Timestamp',) + tuple(channel.name for channel in self.ads_channels)
+        self.fieldnames = self.ring_columns + tuple(channel.name for channel in self.gpio_channels)
+        self.field_types = dict(TPM_Records.FIELD_TYPES, **{channel.name: 'u1' for channel in self.gpio_channels})
+
+    @classmethod
+    def from_config(cls, recorder_settings, hardware_settings=None):
+        """
+        Builds the table from the recorder settings of config.json. The pin of a GPIO channel is either a number or
+        the name of an entry of the hardware settings (e.g. "mouse_lick_in").
+        :param recorder_settings: CONFIG["settings"]["recorder"]
+        :param hardware_settings: CONFIG["settings"]["hardware"]
+        :return: ChannelTable
+        """
+        hardware_settings = hardware_settings if hardware_settings else {}
+        channels = []
+        for settings in recorder_settings.get('channels', DEFAULT_CHANNELS):
+            settings = dict(settings)
+            if isinstance(settings.get('pin'), str):
+                settings['pin'] = hardware_settings[settings['pin']]
+            channels.append(Channel(**settings))
+        return cls(channels)
+
+    def pack(self, timestamp, voltages, gpio_bank):
+        """
+        Builds the row of one sample.
+        :param timestamp: time of the sample in seconds
+        :param voltages: voltages of the ADS channels, in table order
+        :param gpio_bank: levels of GPIO 0-31 as returned by pigpio's read_bank_1
+        :return: tuple in the order of fieldnames, the first len(ring_columns) entries are the row of the sample ring
+        """
+        return (timestamp, *voltages, *[(gpio_bank >> pin) & 1 for pin in self.gpio_pins])
+
+    def meta(self):
+        return [channel.meta() for channel in self.channels]
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+
+CONFIG_LOCATION = 'config.json'
+ANIMAL_SECTIONS = ('mice', 'rats')
+
+
+def _coerce(current, value):
+    """
+    Brings a new settings value to the type of the value it replaces. Numbers typed into the menu arrive as strings or
+    floats, an integral number stays an int if the setting was one. Anything else is kept as it is.
+    """
+    if isinstance(current, bool) or not isinstance(current, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return value
+    if isinstance(current, int) and isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+class ConfigStore:
+    """
+    In-memory copy of config.json. Reads work as on the loaded dict (CONFIG["settings"]["setup"] etc.), changes go
+    through set_settings, add_animal and remove_animal. save() does not write right away but (re)starts a timer of
+    delay seconds, so a burst of changes is written once. The file is written to a temporary file next to it and
+    renamed over the old one, a crash during the write leaves the old file intact.
+    The timer thread is not a daemon, a pending write is still done when the program exits.
+    """
+    def __init__(self, file_location=CONFIG_LOCATION, delay=1.):
+        assert delay >= 0, \
+            'The delay must be a duration in seconds (0 or more).'
+
+        self.file_location = file_location
+        self.delay = delay
+        with open(file_location) as json_data_file:
+            self.data = json.load(json_data_file)
+        for section in ANIMAL_SECTIONS:
+            self.data.setdefault(section, {})
+
+        self.lock = threading.RLock()
+        self.timer = None
+        self.dirty = False
+        self._animal_ids = {}
+        self.versions = {}
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def set_settings(self, section, values):
+        """
+        Partial update of one settings section. Only keys the section already has are accepted, every value is
+        brought to the type of the old one.
+        :param section: name of the section in settings, e.g. 'setup'
+        :param values: dict of the changed keys and their values
+        :return: list of the keys whose value actually changed
+        """
+        settings = self.data["settings"][section]
+        unknown = [key for key in values if key not in settings]
+        if unknown:
+            raise KeyError(f'Unknown settings in section {section}: {", ".join(unknown)}.')
+
+        changed = []
+        with self.lock:
+            for key, value in values.items():
+                value = _coerce(settings[key], value)
+                if settings[key] != value:
+                    settings[key] = value
+                    changed.append(key)
+            if changed:
+                self.dirty = True
+        return changed
+
+    def animal_ids(self, section):
+        """ids of the animals of a section ('mice' or 'rats') in the order of the config, kept until the next change
+        """
+        if section not in self._animal_ids:
+            self._animal_ids[section] = list(self.data[section].keys())
+        return self._animal_ids[section]
+
+    def animal_index(self, section, animal_id):
+        return self.animal_ids(section).index(animal_id)
+
+    def record_version(self, section, animal_id):
+        """counts the changes of an animal record, e.g. to know when a plot of it is outdated
+        """
+        return self.versions.get((section, animal_id), 0)
+
+    def _changed_animal(self, section, animal_id):
+        self.versions[(section, animal_id)] = self.record_version(section, animal_id) + 1
+        self.dirty = True
+
+    def add_animal(self, section, animal_id, record):
+        """
+        :param section: 'mice' or 'rats'
+        :param record: dict of the animal (name, dob, weight, ...), replaces an animal with the same id
+        """
+        if section not in ANIMAL_SECTIONS:
+            raise ValueError(f'Animals are kept in one of the sections {", ".join(ANIMAL_SECTIONS)}.')
+        with self.lock:
+            self.data[section][animal_id] = record
+            self._animal_ids.pop(section, None)
+            self._changed_animal(section, animal_id)
+
+    def remove_animal(self, section, animal_id):
+        with self.lock:
+            if self.data[section].pop(animal_id, None) is not None:
+                self._animal_ids.pop(section, None)
+                self._changed_animal(section, animal_id)
+
+    def save(self, delay=None):
+        """
+        Schedules the write of all changes, an earlier scheduled write is moved back.
+        :param delay: seconds until the write, defaults to the delay of the store
+        """
+        with self.lock:
+            self.dirty = True
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay if delay is None else delay, self.flush)
+            self.timer.start()
+
+    def flush(self):
+        """writes the config now if anything changed since the last write
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.dirty:
+                return
+
+            temporary_location = self.file_location + '.tmp'
+            with open(temporary_location, 'w') as outfile:
+                json.dump(self.data, outfile, indent=4, default=str)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(temporary_location, self.file_location)
+            self.dirty = False
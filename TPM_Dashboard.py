@@ -0,0 +1,363 @@
+import argparse
+import io
+import sys
+import threading
+import time
+import tkinter as tk
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import matplotlib.image
+import matplotlib.pyplot as plt
+import TPM_Statistics
+
+FRAMEBUFFER_NAME = 'tpm_statistics'
+
+# Slots of the int64 header in front of the pixels
+_HEADER_SLOTS = 8
+_SEQUENCE = 0
+_WIDTH = 1
+_HEIGHT = 2
+_FRAME = 3
+_CLOSED = 4
+
+
+def _attach_untracked(name):
+    """
+    Compatibility shim for Python < 3.13, which has no track=False: attaches to an existing block without
+    registering it with the resource tracker of this process. The registration is skipped for the duration of the
+    attach, so a shared memory block created by another thread of this process in that moment would not be
+    registered either. Can be replaced by SharedMemory(name=name, track=False) once Python 3.13 is the minimum.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedFramebuffer:
+    """
+    RGBA image of the statistics in shared memory under a fixed name, so viewers in any process (or started later)
+    can attach to it. The renderer is the only writer. The sequence number is odd while a frame is written, a reader
+    copies the pixels and only keeps the copy if the sequence number was even and unchanged around the copy. When the
+    renderer stops, closed is set before the block is unlinked, attached viewers then let go of it.
+    The renderer owns the block, only its resource tracker knows it (and unlinks it if the renderer dies). Viewers
+    attach without registering it, see _attach_untracked.
+    """
+    def __init__(self, width=None, height=None, name=FRAMEBUFFER_NAME):
+        self.owner = width is not None
+        self.name = name
+
+        if self.owner:
+            assert isinstance(width, int) and isinstance(height, int) and width > 0 and height > 0, \
+                'Width and height of the framebuffer must be integers above 0.'
+            size = 8 * _HEADER_SLOTS + width * height * 4
+            try:
+                self.shared_memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # Left over by a renderer that did not stop cleanly
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                self.shared_memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.shared_memory = _attach_untracked(name)
+
+        self.header = np.ndarray((_HEADER_SLOTS,), dtype=np.int64, buffer=self.shared_memory.buf)
+        if self.owner:
+            self.header[:] = 0
+            self.header[_WIDTH] = width
+            self.header[_HEIGHT] = height
+        self.width = int(self.header[_WIDTH])
+        self.height = int(self.header[_HEIGHT])
+        self.pixels = np.ndarray((self.height, self.width, 4), dtype=np.uint8, buffer=self.shared_memory.buf,
+                                 offset=8 * _HEADER_SLOTS)
+
+    @property
+    def frame_number(self):
+        return int(self.header[_FRAME])
+
+    @property
+    def closed(self):
+        return bool(self.header[_CLOSED])
+
+    def write(self, rgba):
+        """
+        Publishes a new frame.
+        :param rgba: uint8 array of shape (height, width, 4), e.g. the buffer_rgba() of an Agg canvas
+        """
+        sequence = self.header[_SEQUENCE]
+        self.header[_SEQUENCE] = sequence + 1
+        self.pixels[:] = rgba
+        self.header[_FRAME] += 1
+        self.header[_SEQUENCE] = sequence + 2
+
+    def read(self, last_frame=None, attempts=3):
+        """
+        Copies the current frame.
+        :param last_frame: frame number of the last read, nothing is copied if there is no newer frame
+        :param attempts: number of copies before giving up if the renderer keeps writing
+        :return: tuple of frame number and a copy of the pixels, None if there is no new (complete) frame
+        """
+        for _ in range(attempts):
+            sequence = int(self.header[_SEQUENCE])
+            frame_number = int(self.header[_FRAME])
+            if frame_number == 0 or frame_number == last_frame:
+                return None
+            if sequence % 2:
+                time.sleep(0.001)
+                continue
+            pixels = self.pixels.copy()
+            if int(self.header[_SEQUENCE]) == sequence:
+                return frame_number, pixels
+        return None
+
+    def close(self):
+        if self.owner:
+            self.header[_CLOSED] = 1
+        self.header = None
+        self.pixels = None
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
+
+
+class FramebufferClient:
+    """
+    Viewer side of the SharedFramebuffer. Attaches on the first read, lets go when the renderer closes the buffer and
+    attaches again once a renderer is back, so viewers can be started before, during or after the experiment.
+    """
+    def __init__(self, name=FRAMEBUFFER_NAME):
+        self.name = name
+        self.framebuffer = None
+        self.frame_number = None
+        self.frame = None
+
+    def read(self):
+        """
+        :return: the newest frame (RGBA uint8 array), the last one if nothing new arrived, None before the first one
+        """
+        if self.framebuffer is None:
+            try:
+                self.framebuffer = SharedFramebuffer(name=self.name)
+            except FileNotFoundError:
+                return self.frame
+        elif self.framebuffer.closed:
+            self.framebuffer.close()
+            self.framebuffer = None
+            self.frame_number = None
+            return self.frame
+
+        new_frame = self.framebuffer.read(self.frame_number)
+        if new_frame is not None:
+            self.frame_number, self.frame = new_frame
+        return self.frame
+
+    def close(self):
+        if self.framebuffer is not None:
+            self.framebuffer.close()
+            self.framebuffer = None
+
+
+def statistics_render_func(instructions, go_event, stop_event, instruction_pipe, sample_ring, stream_rate=None,
+                           target_fps=10, framebuffer_name=FRAMEBUFFER_NAME, trace_location=None):
+    """
+    Headless counterpart of TPM_Statistics.tracer_func. The statistics figure is rendered with Agg at target_fps and
+    every new frame is copied into a SharedFramebuffer, independent of the number of viewers. Takes the same
+    instructions as the tracer, pause and stop of the experiment are left to the experiment window.
+    """
+    plt.switch_backend('Agg')
+
+    disk_states, performance = TPM_Statistics.placeholder_session()
+    statistics = TPM_Statistics.Statistics(disk_states, performance, trial_number=15, trial_plot_span=11)
+    canvas = statistics.statistics_figure.canvas
+    statistics.redraw()
+    width, height = canvas.get_width_height()
+    framebuffer = SharedFramebuffer(width, height, name=framebuffer_name)
+    framebuffer.write(np.asarray(canvas.buffer_rgba()))
+    print(f'STATISTICS FRAMEBUFFER: {framebuffer_name} ({width}x{height})')
+
+    def publish_frame(drawn, frame_clock):
+        if drawn:
+            framebuffer.write(np.asarray(canvas.buffer_rgba()))
+
+    TPM_Statistics.statistics_loop(instructions, go_event, instruction_pipe, sample_ring, statistics, 'RENDERER',
+                                   stream_rate, target_fps, trace_location, render_step=publish_frame)
+    framebuffer.close()
+    print('RENDERER STOPPED.')
+
+
+def replay_archive(trace_location, framebuffer_name=FRAMEBUFFER_NAME, interval=2., stop_event=None):
+    """
+    Shows the trials of a trace archive (e.g. the traces_file of a session of TPM_Results) one after the other in
+    the shared framebuffer, so the viewers show the statistics of a past session again. The last trial stays until
+    stop_event is set.
+    """
+    plt.switch_backend('Agg')
+    stop_event = stop_event if stop_event is not None else threading.Event()
+
+    trials = TPM_Statistics.read_trace_archive(trace_location)
+    disk_states, performance = TPM_Statistics.placeholder_session(max(len(trials), 1))
+    statistics = TPM_Statistics.Statistics(disk_states, performance, trial_number=max(len(trials), 1),
+                                           trial_plot_span=11)
+    canvas = statistics.statistics_figure.canvas
+    statistics.redraw()
+    width, height = canvas.get_width_height()
+    framebuffer = SharedFramebuffer(width, height, name=framebuffer_name)
+    print(f'REPLAY OF {trace_location}: {len(trials)} trials')
+
+    try:
+        for trial, (trace_store, phases) in sorted(trials.items()):
+            duration = float(trace_store['Timestamp'][-1]) if len(trace_store) else 1.
+            statistics.show_trial(trace_store, phases, duration)
+            framebuffer.write(np.asarray(canvas.buffer_rgba()))
+            if stop_event.wait(interval):
+                break
+        stop_event.wait()
+    finally:
+        framebuffer.close()
+
+
+def _ppm(frame):
+    height, width, _ = frame.shape
+    return f'P6 {width} {height} 255\n'.encode('ascii') + np.ascontiguousarray(frame[:, :, :3]).tobytes()
+
+
+class FramebufferView:
+    """
+    Tk label that shows the framebuffer, polled every interval milliseconds.
+    """
+    def __init__(self, root, name=FRAMEBUFFER_NAME, interval=100):
+        self.root = root
+        self.client = FramebufferClient(name)
+        self.interval = interval
+        self.shown_frame = None
+        self.image = tk.PhotoImage(master=root, width=1, height=1)
+        self.label = tk.Label(root, image=self.image, text='Waiting for the statistics...', compound='center')
+        self.label.pack(fill='both', expand=True)
+        self.poll()
+
+    def poll(self):
+        frame = self.client.read()
+        if frame is not None and self.client.frame_number != self.shown_frame:
+            self.shown_frame = self.client.frame_number
+            self.image.configure(data=_ppm(frame), format='PPM', width=frame.shape[1], height=frame.shape[0])
+            self.label.configure(text='')
+        self.root.after(self.interval, self.poll)
+
+
+class PngCache:
+    """
+    Encodes the newest frame to png once, no matter how many web viewers ask for it.
+    """
+    def __init__(self, name=FRAMEBUFFER_NAME):
+        self.client = FramebufferClient(name)
+        self.lock = threading.Lock()
+        self.frame_number = None
+        self.png = None
+        self.encodings = 0
+
+    def get(self):
+        with self.lock:
+            frame = self.client.read()
+            if frame is not None and self.client.frame_number != self.frame_number:
+                output = io.BytesIO()
+                matplotlib.image.imsave(output, frame, format='png')
+                self.png = output.getvalue()
+                self.frame_number = self.client.frame_number
+                self.encodings += 1
+            return self.png
+
+
+_VIEWER_PAGE = '''<!DOCTYPE html>
+<html>
+<head><title>Experiment Statistics</title></head>
+<body style="margin: 0; background: #e43724;">
+<img id="frame" src="frame.png" style="width: 100%;">
+<script>
+setInterval(function () {{
+    document.getElementById('frame').src = 'frame.png?' + Date.now();
+}}, {interval});
+</script>
+</body>
+</html>
+'''
+
+
+def serve_web_viewer(port=8050, name=FRAMEBUFFER_NAME, interval=200, host='127.0.0.1'):
+    """
+    Serves the framebuffer to browsers: / is a page that reloads /frame.png every interval milliseconds.
+    """
+    png_cache = PngCache(name)
+    page = _VIEWER_PAGE.format(interval=interval).encode('utf-8')
+
+    class ViewerHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] == '/frame.png':
+                content, content_type = png_cache.get(), 'image/png'
+                if content is None:
+                    self.send_error(503, 'No frame rendered yet.')
+                    return
+            elif self.path == '/':
+                content, content_type = page, 'text/html; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), ViewerHandler)
+    print(f'WEB VIEWER: http://{host}:{port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        png_cache.client.close()
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Viewers of the headless statistics renderer.')
+    argument_parser.add_argument('--name', default=FRAMEBUFFER_NAME, help='name of the shared framebuffer')
+    argument_parser.add_argument('--web', type=int, metavar='PORT', help='serve the statistics on this port')
+    argument_parser.add_argument('--host', default='127.0.0.1', help='address of the web viewer')
+    argument_parser.add_argument('--replay', metavar='TRACES', help='show the trials of a trace archive instead')
+    argument_parser.add_argument('--interval', type=float, default=2., help='seconds per trial of the replay')
+    arguments = argument_parser.parse_args()
+
+    if arguments.replay:
+        replay_stop = threading.Event()
+        replay_thread = threading.Thread(target=replay_archive,
+                                         args=(arguments.replay, arguments.name, arguments.interval, replay_stop))
+        replay_thread.start()
+
+    try:
+        if arguments.web:
+            serve_web_viewer(arguments.web, arguments.name, host=arguments.host)
+        else:
+            window = tk.Tk()
+            window.title('Experiment Statistics')
+            view = FramebufferView(window, arguments.name)
+            window.mainloop()
+            view.client.close()
+    finally:
+        if arguments.replay:
+            replay_stop.set()
+            replay_thread.join()
+
+
+if __name__ == '__main__':
+    main()
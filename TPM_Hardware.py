@@ -0,0 +1,482 @@
+import math
+import os
+import queue
+import random as rdm
+import threading
+import time
+import numpy as np
+import TPM_Records
+
+# -----------------------------------------------------------------------------
+# pigpio constants (same values as in the pigpio module, so the fake can be used without it)
+# -----------------------------------------------------------------------------
+INPUT = 0
+OUTPUT = 1
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+
+TICK_MASK = 0xFFFFFFFF
+
+# -----------------------------------------------------------------------------
+# ADS1115 registers and configuration bits
+# -----------------------------------------------------------------------------
+ADS_ADDRESS = 0x48
+ADS_REG_CONVERSION = 0x00
+ADS_REG_CONFIG = 0x01
+ADS_REG_LO_THRESH = 0x02
+ADS_REG_HI_THRESH = 0x03
+
+ADS_OS_SINGLE = 0x8000
+ADS_MODE_CONTINUOUS = 0x0000
+ADS_MODE_SINGLE = 0x0100
+ADS_COMP_QUE_ONE = 0x0000
+ADS_COMP_QUE_DISABLE = 0x0003
+
+# Single ended inputs and differential pairs, same naming as in adafruit_ads1x15 (P0-P3)
+ADS_MUX = {
+    'P0-P1': 0x0000,
+    'P0-P3': 0x1000,
+    'P1-P3': 0x2000,
+    'P2-P3': 0x3000,
+    'P0': 0x4000,
+    'P1': 0x5000,
+    'P2': 0x6000,
+    'P3': 0x7000
+}
+
+# gain -> (config bits, full scale range in volt)
+ADS_GAIN = {
+    2 / 3: (0x0000, 6.144),
+    1: (0x0200, 4.096),
+    2: (0x0400, 2.048),
+    4: (0x0600, 1.024),
+    8: (0x0800, 0.512),
+    16: (0x0A00, 0.256)
+}
+
+# samples per second -> config bits
+ADS_DATA_RATE = {
+    8: 0x0000,
+    16: 0x0020,
+    32: 0x0040,
+    64: 0x0060,
+    128: 0x0080,
+    250: 0x00A0,
+    475: 0x00C0,
+    860: 0x00E0
+}
+
+
+def tick_difference(start_tick, end_tick):
+    """returns the time between two pigpio ticks in seconds, the ticks wrap around every ~72 minutes
+    """
+    return ((end_tick - start_tick) & TICK_MASK) / 1e6
+
+
+def connect_pi(fake_hardware=False, **kwargs):
+    """
+    Connects to the pigpio daemon or creates a stand-in that simulates the wheel-ADC and the GPIOs.
+    :param fake_hardware: if True a FakePi is returned, which runs on any machine
+    :param kwargs: passed on to the FakePi
+    :return: pigpio.pi or FakePi
+    """
+    if fake_hardware:
+        return FakePi(**kwargs)
+
+    import pigpio
+    return pigpio.pi()
+
+
+class ContinuousADS1115:
+    """
+    Runs the ADS1115 in continuous conversion mode and paces the reads off the ALERT/RDY pin. The pin pulses low after
+    every finished conversion, the pigpio callback puts the tick of that edge into a queue and the sampling loop reads
+    the conversion register once per tick. If more than one channel is given, the multiplexer is switched after every
+    conversion and a scan is returned once all channels have been converted, so every channel runs at
+    data_rate / len(channels). The gain is either one gain for all channels or a tuple with one gain per channel.
+    """
+    def __init__(self, pi, alert_pin, channels=('P0', 'P1'), gain=2 / 3, data_rate=860, i2c_bus=1,
+                 address=ADS_ADDRESS):
+        assert all(channel in ADS_MUX for channel in channels) and len(channels) > 0, \
+            f'Channels must be a tuple of ADS1115 inputs ({", ".join(ADS_MUX.keys())}).'
+        gains = tuple(gain) if isinstance(gain, (tuple, list)) else (gain,) * len(channels)
+        assert len(gains) == len(channels) and all(channel_gain in ADS_GAIN for channel_gain in gains), \
+            f'Gain must be one of {tuple(ADS_GAIN.keys())} or a tuple of those with one gain per channel.'
+        assert data_rate in ADS_DATA_RATE, \
+            f'Data rate must be one of {tuple(ADS_DATA_RATE.keys())}.'
+
+        self.pi = pi
+        self.alert_pin = alert_pin
+        self.channels = tuple(channels)
+        self.gains = gains
+        self.data_rate = data_rate
+        self.volt_per_bit = tuple(ADS_GAIN[channel_gain][1] / 32768 for channel_gain in gains)
+
+        self.handle = pi.i2c_open(i2c_bus, address)
+        self.ticks = queue.SimpleQueue()
+        self.callback = None
+        self.running = False
+
+        self.channel_index = 0
+        self.mux_tick = 0
+        self.scan_tick = 0
+        self.voltages = [0.] * len(self.channels)
+
+    def _write_register(self, register, value):
+        self.pi.i2c_write_i2c_block_data(self.handle, register, [(value >> 8) & 0xFF, value & 0xFF])
+
+    def _read_conversion(self, channel_index):
+        count, data = self.pi.i2c_read_i2c_block_data(self.handle, ADS_REG_CONVERSION, 2)
+        raw = (data[0] << 8) | data[1]
+        if raw > 0x7FFF:
+            raw -= 0x10000
+        return raw * self.volt_per_bit[channel_index]
+
+    def _config(self, channel_index, continuous=True):
+        mode = ADS_MODE_CONTINUOUS if continuous else ADS_MODE_SINGLE
+        return (ADS_MUX[self.channels[channel_index]] | ADS_GAIN[self.gains[channel_index]][0] | mode |
+                ADS_DATA_RATE[self.data_rate] | ADS_COMP_QUE_ONE)
+
+    def _select_channel(self, channel_index):
+        self._write_register(ADS_REG_CONFIG, self._config(channel_index))
+        # Conversions that finished before the switch still belong to the previous channel
+        self.mux_tick = self.pi.get_current_tick()
+
+    def _on_ready(self, gpio, level, tick):
+        self.ticks.put(tick)
+
+    def _next_tick(self, timeout):
+        while True:
+            try:
+                tick = self.ticks.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if ((tick - self.mux_tick) & TICK_MASK) < 0x80000000:
+                return tick
+
+    def start(self):
+        # MSB of Hi_thresh set and MSB of Lo_thresh cleared turns ALERT/RDY into a conversion-ready pin
+        self._write_register(ADS_REG_HI_THRESH, 0x8000)
+        self._write_register(ADS_REG_LO_THRESH, 0x0000)
+
+        self.pi.set_mode(self.alert_pin, INPUT)
+        self.pi.set_pull_up_down(self.alert_pin, PUD_UP)
+        if not self.callback:
+            self.callback = self.pi.callback(self.alert_pin, FALLING_EDGE, self._on_ready)
+
+        self.clear()
+        self.running = True
+
+    def clear(self):
+        """drops pending conversions and restarts the scan at the first channel
+        """
+        self.channel_index = 0
+        self._select_channel(0)
+
+    def set_data_rate(self, samples_per_second):
+        """selects the slowest data rate which still delivers the requested scans per second, at most 860sps
+        """
+        required_rate = samples_per_second * len(self.channels)
+        fitting_rates = [rate for rate in ADS_DATA_RATE if rate >= required_rate]
+        self.data_rate = min(fitting_rates) if fitting_rates else max(ADS_DATA_RATE)
+        if self.running:
+            self.clear()
+        return self.data_rate / len(self.channels)
+
+    def read_scan(self, timeout=0.05):
+        """
+        Waits for the next full scan over all channels.
+        :param timeout: maximum time to wait for a single conversion in seconds
+        :return: tuple of the tick of the first conversion and the list of voltages or None after a timeout
+        """
+        while True:
+            tick = self._next_tick(timeout)
+            if tick is None:
+                return None
+
+            if self.channel_index == 0:
+                self.scan_tick = tick
+            self.voltages[self.channel_index] = self._read_conversion(self.channel_index)
+            self.channel_index = (self.channel_index + 1) % len(self.channels)
+
+            if len(self.channels) > 1:
+                self._select_channel(self.channel_index)
+
+            if self.channel_index == 0:
+                return self.scan_tick, self.voltages
+
+    def stop(self):
+        if self.callback:
+            self.callback.cancel()
+            self.callback = None
+        # Back to single-shot mode, which powers the converter down
+        self._write_register(ADS_REG_CONFIG, self._config(0, continuous=False))
+        self.running = False
+
+    def close(self):
+        if self.running:
+            self.stop()
+        self.pi.i2c_close(self.handle)
+
+
+class LickEventRecorder:
+    """
+    Captures every edge on the lick inputs with a pigpio callback. The callback only stores the microsecond tick,
+    the gpio and the new level in a preallocated array, so licks shorter than a sample period are not missed and
+    the lick latency can be analysed afterwards.
+    """
+    def __init__(self, pi, gpios, capacity=16384):
+        assert isinstance(capacity, int) and capacity > 0, \
+            'The capacity must be an integer above 0.'
+
+        self.pi = pi
+        self.gpios = tuple(gpios)
+        self.dtype = np.dtype([('Tick', '<u4'), ('GPIO', 'u1'), ('Level', 'u1')])
+        self.events = np.zeros(capacity, dtype=self.dtype)
+        self.count = 0
+        self.overflow = 0
+        self.start_tick = pi.get_current_tick()
+        self.lock = threading.Lock()
+        self.callbacks = [pi.callback(gpio, EITHER_EDGE, self._on_edge) for gpio in self.gpios]
+
+    def _on_edge(self, gpio, level, tick):
+        # Level 2 is a watchdog timeout and no edge
+        if level > 1:
+            return
+        with self.lock:
+            if self.count < len(self.events):
+                self.events[self.count] = (tick, gpio, level)
+                self.count += 1
+            else:
+                self.overflow += 1
+
+    def start(self, start_tick=None):
+        """drops all stored events and sets the tick which corresponds to timestamp 0
+        """
+        with self.lock:
+            self.count = 0
+            self.overflow = 0
+            self.start_tick = self.pi.get_current_tick() if start_tick is None else start_tick
+
+    def take(self):
+        """
+        Removes all stored events.
+        :return: structured array with Timestamp (seconds since start), Tick, GPIO and Level
+        """
+        with self.lock:
+            events = self.events[:self.count].copy()
+            self.count = 0
+        table = np.zeros(len(events), dtype=TPM_Records.record_dtype(TPM_Records.LICK_FIELDNAMES))
+        table['Timestamp'] = ((events['Tick'].astype(np.int64) - self.start_tick) & TICK_MASK) / 1e6
+        for name in self.dtype.names:
+            table[name] = events[name]
+        return table
+
+    def meta(self):
+        return {'gpios': list(self.gpios), 'overflow': self.overflow}
+
+    def save(self, file_location):
+        events = self.take()
+        writer = TPM_Records.RecordWriter(file_location, TPM_Records.LICK_FIELDNAMES, chunk_size=1,
+                                          meta=self.meta())
+        writer.extend(events)
+        writer.close()
+        return len(events)
+
+    def cancel(self):
+        for callback in self.callbacks:
+            callback.cancel()
+        self.callbacks = []
+
+
+def lick_file_location(file_location):
+    """location of the lick events belonging to a trial file
+    """
+    root, extension = os.path.splitext(file_location)
+    return root + '_licks' + TPM_Records.RECORD_EXTENSIONS['binary']
+
+
+# -----------------------------------------------------------------------------
+# Stand-ins for testing without a Raspberry Pi
+# -----------------------------------------------------------------------------
+def fake_position(t):
+    """wheel position, a 0-5V sawtooth with one revolution every 2 seconds
+    """
+    return 5. * ((t / 2.) % 1.)
+
+
+def fake_speed(t):
+    return 2.5 + 2. * math.sin(2 * math.pi * 0.25 * t)
+
+
+class FakeCallback:
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+
+class FakeADS1115:
+    """
+    Simulated ADS1115 on the fake i2c bus. In continuous mode a thread finishes a conversion every 1/data_rate seconds
+    and pulses the ALERT/RDY pin of the FakePi.
+    """
+    def __init__(self, pi, alert_pin=None, signals=None):
+        self.pi = pi
+        self.alert_pin = alert_pin
+        self.signals = signals if signals else {
+            ADS_MUX['P0']: fake_position,
+            ADS_MUX['P1']: fake_speed
+        }
+        self.registers = {
+            ADS_REG_CONVERSION: 0,
+            ADS_REG_CONFIG: 0x8583,
+            ADS_REG_LO_THRESH: 0x8000,
+            ADS_REG_HI_THRESH: 0x7FFF
+        }
+        self.thread = None
+        self.running = False
+
+    def _convert(self):
+        config = self.registers[ADS_REG_CONFIG]
+        full_scale = [fsr for bits, fsr in ADS_GAIN.values() if bits == config & 0x0E00][0]
+        signal = self.signals.get(config & 0x7000, lambda t: 0.)
+        raw = int(signal(time.perf_counter()) / full_scale * 32768)
+        self.registers[ADS_REG_CONVERSION] = max(-32768, min(32767, raw)) & 0xFFFF
+
+    def _conversion_loop(self):
+        next_conversion = time.perf_counter()
+        while self.running:
+            config = self.registers[ADS_REG_CONFIG]
+            rate = [rate for rate, bits in ADS_DATA_RATE.items() if bits == config & 0x00E0][0]
+            next_conversion += 1. / rate
+            delay = next_conversion - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self._convert()
+            conversion_ready = self.registers[ADS_REG_HI_THRESH] & 0x8000 and \
+                not self.registers[ADS_REG_LO_THRESH] & 0x8000
+            if self.alert_pin is not None and conversion_ready and config & 0x0003 != ADS_COMP_QUE_DISABLE:
+                self.pi.pulse(self.alert_pin, level=0)
+
+    def write(self, register, value):
+        self.registers[register] = value
+        if register != ADS_REG_CONFIG:
+            return
+
+        if value & ADS_MODE_SINGLE:
+            self.running = False
+            if value & ADS_OS_SINGLE:
+                self._convert()
+        elif not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._conversion_loop, daemon=True)
+            self.thread.start()
+
+    def read(self, register):
+        return self.registers[register]
+
+
+class FakePi:
+    """
+    Minimal stand-in for pigpio.pi with GPIO levels, edge callbacks, hardware PWM and an ADS1115 on the i2c bus.
+    """
+    def __init__(self, adc_alert_pin=None, adc_signals=None):
+        self.connected = True
+        self.levels = {}
+        self.modes = {}
+        self.pwm = {}
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.adc = FakeADS1115(self, adc_alert_pin, adc_signals)
+        self.i2c_handles = {}
+
+    def get_current_tick(self):
+        return int(time.perf_counter() * 1e6) & TICK_MASK
+
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+
+    def set_pull_up_down(self, gpio, pud):
+        if gpio not in self.levels:
+            self.levels[gpio] = 1 if pud == PUD_UP else 0
+
+    def read(self, gpio):
+        return self.levels.get(gpio, 0)
+
+    def read_bank_1(self):
+        bank = 0
+        for gpio, level in list(self.levels.items()):
+            if level and gpio < 32:
+                bank |= 1 << gpio
+        return bank
+
+    def write(self, gpio, level):
+        with self.lock:
+            old_level = self.levels.get(gpio, 0)
+            self.levels[gpio] = level
+            callbacks = [cb for cb in self.callbacks if cb.gpio == gpio] if old_level != level else []
+        tick = self.get_current_tick()
+        for cb in callbacks:
+            if cb.edge == EITHER_EDGE or (cb.edge == RISING_EDGE) == bool(level):
+                cb.func(gpio, level, tick)
+
+    def pulse(self, gpio, level=0):
+        """drives a short pulse on the gpio and returns to the idle level
+        """
+        idle_level = 1 - level
+        self.write(gpio, level)
+        self.write(gpio, idle_level)
+
+    def simulate_licks(self, gpios, rate=2., duration=0.04):
+        """
+        Starts a thread that pulses the gpios high at random, rate is the mean number of licks per second and gpio.
+        """
+        def lick_loop():
+            while self.connected:
+                time.sleep(rdm.expovariate(rate * len(gpios)))
+                gpio = rdm.choice(gpios)
+                self.write(gpio, 1)
+                time.sleep(duration)
+                self.write(gpio, 0)
+
+        thread = threading.Thread(target=lick_loop, daemon=True)
+        thread.start()
+        return thread
+
+    def callback(self, user_gpio, edge=RISING_EDGE, func=None):
+        cb = FakeCallback(self, user_gpio, edge, func)
+        with self.lock:
+            self.callbacks.append(cb)
+        return cb
+
+    def hardware_PWM(self, gpio, frequency, dutycycle):
+        self.pwm[gpio] = (frequency, dutycycle)
+
+    def i2c_open(self, i2c_bus, i2c_address, i2c_flags=0):
+        handle = len(self.i2c_handles)
+        self.i2c_handles[handle] = i2c_address
+        return handle
+
+    def i2c_close(self, handle):
+        self.i2c_handles.pop(handle, None)
+
+    def i2c_write_i2c_block_data(self, handle, reg, data):
+        self.adc.write(reg, (data[0] << 8) | data[1])
+
+    def i2c_read_i2c_block_data(self, handle, reg, count):
+        value = self.adc.read(reg)
+        return 2, bytearray(((value >> 8) & 0xFF, value & 0xFF))
+
+    def stop(self):
+        self.adc.running = False
+        self.connected = False
@@ -5,16 +5,24 @@ import screeninfo
 import pygameMenu
 import random as rdm
 import os
-import json
 import datetime
 from dateutil import parser
 import time
 import pygame.gfxdraw as gfxdraw
 import math
 from collections import deque
+import numpy as np
 import TPM_Utility
 import TPM_Recorder
 import TPM_Statistics
+import TPM_RingBuffer
+import TPM_Channels
+import TPM_Timing
+import TPM_Hardware
+import TPM_Dashboard
+import TPM_Hud
+import TPM_Results
+import TPM_Config
 import pyautogui
 
 # Importing Matplotlib for performance-graph and statistics window
@@ -40,6 +48,73 @@ COLOR_BACKGROUND = (128, 0, 128)
 # -----------------------------------------------------------------------------
 # Classes
 # -----------------------------------------------------------------------------
+class MarkerSpriteCache:
+    """
+    Surfaces of all marker images, loaded and scaled to the marker height once. Mirrored markers also get the
+    rotated and flipped copy for the lower half of the screen. The surfaces are converted to the pixel format of the
+    display (if there is one), so blitting them needs no conversion either.
+    """
+    def __init__(self, image_location, marker_height, mirrored=True):
+        self.marker_height = marker_height
+        self.mirrored = mirrored
+        self.sprites = {}
+        for location in image_location:
+            loaded_image = pygame.image.load(location)
+            zoom_factor = marker_height / loaded_image.get_height()
+            sprites = [pygame.transform.rotozoom(loaded_image, 0, zoom_factor)]
+            if mirrored:
+                sprites.append(pygame.transform.flip(pygame.transform.rotozoom(loaded_image, 180, zoom_factor),
+                                                     True, False))
+            if pygame.display.get_surface() is not None:
+                sprites = [sprite.convert_alpha() for sprite in sprites]
+            self.sprites[location] = tuple(sprites)
+        self.locations = tuple(self.sprites.keys())
+
+    def __getitem__(self, location):
+        return self.sprites[location]
+
+    def random(self):
+        """returns the surfaces of a random image, (upper, lower) if mirrored and (marker,) otherwise
+        """
+        return self.sprites[rdm.choice(self.locations)]
+
+
+class PlotCache:
+    """
+    Rendered plots of the performance and pairing records of the animals, keyed by animal, metric and the version of
+    the record in the config store, so a plot is only drawn again after its record changed. The dates of a record are
+    parsed once per version and kept as datetime64 array.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.records = {}
+        self.surfaces = {}
+
+    def _key(self, section, animal_id, metric):
+        return section, animal_id, metric, self.config.record_version(section, animal_id)
+
+    def record(self, section, animal_id, metric, dayfirst=True):
+        """
+        :return: tuple of the dates (datetime64 array) and the values (float array) of a record
+        """
+        key = self._key(section, animal_id, metric)
+        if key not in self.records:
+            record = self.config[section][animal_id][metric]
+            self.records = {old_key: value for old_key, value in self.records.items() if old_key[:3] != key[:3]}
+            self.records[key] = (np.array([parser.parse(date, dayfirst=dayfirst) for date in record],
+                                          dtype='datetime64[s]'),
+                                 np.array(list(record.values()), dtype=float))
+        return self.records[key]
+
+    def surface(self, section, animal_id, metric, dayfirst=True):
+        key = self._key(section, animal_id, metric)
+        if key not in self.surfaces:
+            self.surfaces = {old_key: value for old_key, value in self.surfaces.items() if old_key[:3] != key[:3]}
+            dates, values = self.record(section, animal_id, metric, dayfirst)
+            self.surfaces[key] = plot_performance(dates, values, metric)
+        return self.surfaces[key]
+
+
 class ExperimentScreen:
     def __init__(self, parent, size, position, marker_distribution, marker_height,
                  image_location, font, background_color=(0, 0, 0), mirrored=True):
@@ -78,20 +153,12 @@ class ExperimentScreen:
         self.image_location = image_location
         self.mirrored = mirrored
         self.markers = deque(maxlen=sum(marker_distribution))
+        # Spawning a marker during the experiment only picks from the prepared surfaces
+        self.sprite_cache = MarkerSpriteCache(image_location, marker_height, mirrored)
 
-        _surf = [None] * sum(marker_distribution)
+        _surf = [self.sprite_cache.random() for _ in range(sum(marker_distribution))]
         _rect = [None] * sum(marker_distribution)
 
-        for i in range(sum(marker_distribution)):
-            loaded_image = pygame.image.load(image_location[rdm.randint(0, len(image_location) - 1)])
-            zoom_factor = marker_height / loaded_image.get_height()
-            if self.mirrored:
-                _surf[i] = [pygame.transform.rotozoom(loaded_image, 0, zoom_factor),
-                            pygame.transform.flip(pygame.transform.rotozoom(loaded_image, 180, zoom_factor),
-                                                  True, False)]
-            else:
-                _surf[i] = pygame.transform.rotozoom(loaded_image, 0, zoom_factor)
-
         self.location_pointer = _surf[marker_distribution[0]][0].get_width() / 2
         self.space = parent.get_width() / marker_distribution[1]
         self.left_spawn = -(marker_distribution[0] * self.space)
@@ -123,12 +190,28 @@ class ExperimentScreen:
                 wobble_y_abs = int((parent.get_width() / 2))
                 wobble_y_random = rdm.randint(-wobble_y_abs, wobble_y_abs)
                 _rect[i] = _rect[i].move(wobble_x_random, wobble_y_random)
-                self.markers.append([_surf[i], _rect[i]])
+                self.markers.append([_surf[i][0], _rect[i]])
         print("init")
+        self.full_redraw = True
         self.move(0)
 
+    def _sprites(self):
+        if self.mirrored:
+            return [sprite for marker in self.markers for sprite in marker]
+        return list(self.markers)
+
     def move(self, delta):
-        self.surface.fill(self.background_color)
+        """
+        Moves the markers by delta pixels. Only the old positions of the markers are cleared, the rest of the surface
+        is left as it is (except for the first move, which clears everything).
+        :return: list of the changed areas of the surface
+        """
+        old_sprites = self._sprites()
+        if self.full_redraw:
+            self.surface.fill(self.background_color)
+        else:
+            for sprite in old_sprites:
+                self.surface.fill(self.background_color, sprite[1])
         self.location_pointer += delta
 
         if self.location_pointer < 0 or self.location_pointer > self.space:
@@ -137,13 +220,8 @@ class ExperimentScreen:
             else:
                 spawn = self.left_spawn
 
-            loaded_image = pygame.image.load(self.image_location[rdm.randint(0, len(IMAGE_LIST) - 1)])
-            zoom_factor = self.marker_height / loaded_image.get_height()
+            _surf = self.sprite_cache.random()
             if self.mirrored:
-                _surf = [pygame.transform.rotozoom(loaded_image, 0, zoom_factor),
-                         pygame.transform.flip(pygame.transform.rotozoom(loaded_image, 180, zoom_factor),
-                                               True, False)]
-
                 _rect = [_surf[0].get_rect(),
                          _surf[1].get_rect()]
                 _rect[0].center = [spawn, self.parent.get_height() * 1 / 4]
@@ -151,7 +229,7 @@ class ExperimentScreen:
                 wobble_y_abs = int(self.parent.get_height() / 4 - _rect[0].height / 2)
                 wobble_y_random = rdm.randint(-wobble_y_abs, wobble_y_abs)
             else:
-                _surf = pygame.transform.rotozoom(loaded_image, 0, zoom_factor)
+                _surf = _surf[0]
                 _rect = _surf.get_rect()
                 _rect.center = [spawn, self.parent.get_height() * 2 / 4]
                 wobble_y_abs = int(self.parent.get_height() / 2)
@@ -177,18 +255,212 @@ class ExperimentScreen:
 
             self.location_pointer = self.location_pointer % self.space
 
-        for i in range(0, len(self.markers)):
-            if self.mirrored:
-                self.markers[i][0][1] = self.markers[i][0][1].move(delta, 0)
-                self.markers[i][1][1] = self.markers[i][1][1].move(delta, 0)
-                self.surface.blit(*self.markers[i][0])
-                self.surface.blit(*self.markers[i][1])
-            else:
-                self.markers[i][1] = self.markers[i][1].move(delta, 0)
-                self.surface.blit(*self.markers[i])
+        # Every marker changes the area between its old and new position
+        changed_rects = []
+        sprites = self._sprites()
+        for sprite in sprites:
+            old_rect = sprite[1]
+            sprite[1] = old_rect.move(delta, 0)
+            self.surface.blit(*sprite)
+            changed_rects.append(old_rect.union(sprite[1]))
+        # Markers that were dropped for a newly spawned one
+        current_sprites = set(map(id, sprites))
+        changed_rects.extend(sprite[1] for sprite in old_sprites if id(sprite) not in current_sprites)
+
+        surface_area = self.surface.get_rect()
+        if self.full_redraw:
+            self.full_redraw = False
+            return [surface_area]
+        changed_rects = [rect.clip(surface_area) for rect in changed_rects]
+        return [rect for rect in changed_rects if rect.width and rect.height]
+
+    def blit_to_parent(self, rects=None):
+        """
+        Copies the surface (or only the given areas of it) to the parent.
+        :param rects: areas of the surface, e.g. the return value of move
+        :return: list of the changed areas of the parent
+        """
+        if rects is None:
+            return [self.parent.blit(self.surface, self.rectangle)]
+        return [self.parent.blit(self.surface, rect.move(self.rectangle.topleft), rect) for rect in rects]
+
+
+class DisplayUpdater:
+    """
+    Draws the frames of the experiment loop. In dirty mode only the changed areas are handed to the display
+    (pygame.display.update(rects)): the old and new positions of the markers and the overlays (text, fps) of this and
+    the last frame. A frame with a new background colour (the colour flashes at the start and end of a trial) and
+    every frame outside of dirty mode is drawn completely and flipped. The frame times of both kinds are kept until
+    the next reset.
+    A frame that was begun but not ended (the loop left it with break or return) may have drawn areas that never
+    reached the display, the frame after it is drawn completely.
+    """
+    def __init__(self, screen, experiment_screen, dirty=True, history=1000):
+        self.screen = screen
+        self.experiment_screen = experiment_screen
+        self.dirty = dirty
+        self.history = history
+        self.fill_color = None
+        self.full_frame = True
+        self.open_frame = False
+        self.frame_start = time.perf_counter()
+        self.rects = []
+        self.overlays = []
+        self.reset()
+
+    def reset(self):
+        self.frame_times = {'dirty': deque(maxlen=self.history), 'full': deque(maxlen=self.history)}
+
+    def begin(self, fill_color):
+        self.frame_start = time.perf_counter()
+        self.full_frame = not self.dirty or fill_color != self.fill_color or self.open_frame
+        self.open_frame = True
+        self.fill_color = fill_color
+        self.rects = []
+        if self.full_frame:
+            self.screen.fill(fill_color)
+        else:
+            # The overlays of the last frame are replaced by what was below them
+            surface_area = self.experiment_screen.surface.get_rect()
+            offset = self.experiment_screen.rectangle.topleft
+            for rect in self.overlays:
+                self.rects.append(self.screen.fill(fill_color, rect))
+                below = rect.move(-offset[0], -offset[1]).clip(surface_area)
+                if below.width and below.height:
+                    self.experiment_screen.blit_to_parent([below])
+        self.overlays = []
+
+    def move_markers(self, delta):
+        changed_rects = self.experiment_screen.move(delta)
+        if self.full_frame:
+            self.experiment_screen.blit_to_parent()
+        else:
+            self.rects.extend(self.experiment_screen.blit_to_parent(changed_rects))
+
+    def overlay(self, surface, position):
+        rect = self.screen.blit(surface, position)
+        self.overlays.append(rect)
+        self.rects.append(rect)
 
-    def blit_to_parent(self):
-        self.parent.blit(self.surface, self.rectangle)
+    def end(self):
+        self.open_frame = False
+        if self.full_frame:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.rects)
+        self.frame_times['full' if self.full_frame else 'dirty'].append(time.perf_counter() - self.frame_start)
+
+    def statistics(self):
+        statistics = {}
+        for kind, frame_times in self.frame_times.items():
+            frame_times = np.array(frame_times)
+            statistics[kind] = {
+                'frames': len(frame_times),
+                'frame_time_p50': float(np.percentile(frame_times, 50)) if len(frame_times) else 0.,
+                'frame_time_max': float(frame_times.max()) if len(frame_times) else 0.
+            }
+        return statistics
+
+    def report(self):
+        mode = 'dirty rectangles' if self.dirty else 'full frames'
+        return f'RENDERING ({mode}): ' + ', '.join(
+            f'{stats["frames"]} {kind} frames p50 {stats["frame_time_p50"] * 1e3:.1f}ms / '
+            f'max {stats["frame_time_max"] * 1e3:.1f}ms' for kind, stats in self.statistics().items())
+
+
+class PinoutOverlay:
+    """
+    Pinout of the Hardware Settings menu. The image of the Raspberry Pi and the annotations of the fixed pins (power,
+    ground, ADC, EEPROM) are composed and scaled once. Every label of a pin chosen in the menu is scaled once per pin,
+    text and colour and drawn on a copy of this layer. When a pin or the selected widget changed, only the areas of
+    the old and new labels are restored from the static layer and drawn again.
+    """
+    def __init__(self, image_location, font_name, scale=1.3):
+        self.scale = scale
+        self.text_font = pygame.font.SysFont(font_name, 30, bold=False)
+        self.annotation_font = pygame.font.SysFont(font_name, 15, bold=True)
+
+        pinout_surface = pygame.image.load(image_location)
+        self.image_width, self.image_height = pinout_surface.get_size()
+        layer = self._annotation_surface()
+        layer.blit(pinout_surface, (int(0.5 * self.image_width), 0))
+        for pin in special_pins:
+            self._annotate(layer, int(pin[0]), pin[1], COLOR_BLACK)
+        self.static_layer = pygame.transform.rotozoom(layer, 0, scale)
+        # The image is centered on the annotations, so both are placed by the rectangle of the scaled image
+        self.image_size = (int(self.image_width * scale), int(self.image_height * scale))
+
+        self.label_surfaces = {}
+        self.state = None
+        self.labels = []
+        self.surface = self.static_layer.copy()
+
+    def _annotation_surface(self):
+        annotation_surface = pygame.Surface((2 * self.image_width, self.image_height), pygame.SRCALPHA, 32)
+        return annotation_surface.convert_alpha() if pygame.display.get_surface() is not None else annotation_surface
+
+    def _annotate(self, surface, pin_number, label, color):
+        """
+        :return: rectangle of the line and the text of the annotation
+        """
+        pin_x = int(0.5 * self.image_width) + pin_positions[pin_number - 1][0]
+        pin_y = pin_positions[pin_number - 1][1]
+        word_surface = self.annotation_font.render(label, 0, color)
+        word_rect = word_surface.get_rect()
+        # Odd pins are labeled to the left of the header, even pins to the right
+        if pin_number % 2 != 0:
+            line_rect = pygame.draw.line(surface, color, (pin_x, pin_y), (pin_x - 75, pin_y))
+            word_rect.midright = (pin_x - 80, pin_y)
+        else:
+            line_rect = pygame.draw.line(surface, color, (pin_x, pin_y), (pin_x + 30, pin_y))
+            word_rect.midleft = (pin_x + 35, pin_y)
+        return surface.blit(word_surface, word_rect).union(line_rect)
+
+    def _label(self, pin_number, label, color):
+        """
+        :return: scaled surface of the annotation and its rectangle on the scaled layer
+        """
+        key = (pin_number, label, color)
+        if key not in self.label_surfaces:
+            layer = self._annotation_surface()
+            rect = self._annotate(layer, pin_number, label, color).clip(layer.get_rect())
+            surface = pygame.transform.rotozoom(layer.subsurface(rect), 0, self.scale)
+            self.label_surfaces[key] = (surface, surface.get_rect(topleft=(int(rect.x * self.scale),
+                                                                          int(rect.y * self.scale))))
+        return self.label_surfaces[key]
+
+    def update(self, pins):
+        """
+        :param pins: list of (pin number, label, selected) of the pins chosen in the menu
+        """
+        state = tuple(pins)
+        if state == self.state:
+            return
+        self.state = state
+
+        labels = [(pin_number, label, COLOR_WHITE if selected else COLOR_BLACK) for pin_number, label, selected in pins]
+        changed = [key for key in self.labels if key not in labels] + [key for key in labels if key not in self.labels]
+        self.labels = labels
+
+        current = [self._label(*key) for key in labels]
+        for key in changed:
+            rect = self._label(*key)[1]
+            # The area goes back to the static layer, then every label reaching into it is drawn again
+            self.surface.blit(self.static_layer, rect, rect)
+            self.surface.set_clip(rect)
+            for surface, label_rect in current:
+                if label_rect.colliderect(rect):
+                    self.surface.blit(surface, label_rect)
+            self.surface.set_clip(None)
+
+    def blit(self, parent, image_position):
+        """
+        :param image_position: top left corner of the scaled image of the Raspberry Pi
+        """
+        image_rectangle = pygame.Rect(image_position, self.image_size)
+        surface_rectangle = self.surface.get_rect()
+        surface_rectangle.center = image_rectangle.center
+        return parent.blit(self.surface, surface_rectangle)
 
 
 # -----------------------------------------------------------------------------
@@ -237,7 +509,8 @@ MESSAGE_TIMERS = {
 VIRTUAL_EXPERIMENT = False
 
 CONFIG = None
-RESULTS = None
+PLOT_CACHE = None  # Plots of the animal records drawn behind the menus
+PINOUT_OVERLAY = None  # Pinout of the Hardware Settings menu, made when the menu is first shown
 clock = None
 main_menu = None
 
@@ -319,24 +592,44 @@ def find_font_file(query):
     return matches
 
 
-def plot_performance(x, y):
+def plot_performance(x, y, metric='performance'):
     ax = plt.gca()
     for l in ax.get_lines():
         l.remove()
     ax.plot(x, y, color='black', linewidth=0.75)
     plt.xticks(x)
+    if metric == 'performance':
+        ax.set_title("Performance over time [%]")
+        ax.set_ylim(0, 100)
+    else:
+        ax.set_title("Pairing Duration over time [s]")
+        ax.set_ylim(0, max(y))
     canvas = agg.FigureCanvasAgg(plt.gcf())
     canvas.draw()
-    renderer = canvas.get_renderer()
-    raw_data = renderer.tostring_rgb()
     size = canvas.get_width_height()
-    if not main_menu._actual.get_title() == 'Select Animals':
-        ax.set_title("Pairing Duration over time [s]")
-        ax.set_ylim(0, max(y))
-    else:
-        ax.set_title("Performance over time [%]")
-        ax.set_ylim(0, 100)
-    return pygame.image.fromstring(raw_data, size, "RGB")
+    surface = pygame.image.fromstring(bytes(canvas.buffer_rgba()), size, "RGBA")
+    return surface.convert() if pygame.display.get_surface() is not None else surface
+
+
+def read_wheel_position(sample_reader, old_position_volt, acceleration_cutoff, stream_monitor=None):
+    """
+    Reads all samples the recorder published since the last call.
+    :param sample_reader: RingReader on the sample ring of the recorder
+    :param old_position_volt: position of the last call
+    :param acceleration_cutoff: position changes between two samples above this value (wrap-around of the wheel,
+    glitches) are ignored
+    :param stream_monitor: optional TPM_Timing.StreamMonitor counting throughput and lag of the samples
+    :return: tuple of the newest position and the summed position change in volt
+    """
+    samples = sample_reader.read()
+    if stream_monitor is not None:
+        stream_monitor.update(samples, sample_reader.ring.epoch)
+    if not len(samples):
+        return old_position_volt, 0.
+    positions = samples[:, sample_reader.ring.column('Position')]
+    deltas = np.diff(positions, prepend=old_position_volt)
+    deltas[np.abs(deltas) > acceleration_cutoff] = 0.
+    return float(positions[-1]), float(deltas.sum())
 
 
 def main_background():
@@ -353,11 +646,9 @@ def main_background():
         gfxdraw.filled_polygon(SCREEN, EXPERIMENT_MENUBAR._polygon_pos, MAIN_MENUBAR._font_color)
 
         if len(CONFIG["mice"]) > 0 and CONFIG["mice"][CURRENT_MOUSE]["performance"].keys():
-            performance = [CONFIG["mice"][CURRENT_MOUSE]["performance"][date] for date
-                           in CONFIG["mice"][CURRENT_MOUSE]["performance"]]
-            dates = [parser.parse(date, dayfirst=True) for date in CONFIG["mice"][CURRENT_MOUSE]["performance"]]
-            if not all(date < datetime.datetime.today() - datetime.timedelta(days=14) for date in dates):
-                surface = plot_performance(dates, performance)
+            dates, _ = PLOT_CACHE.record("mice", CURRENT_MOUSE, "performance")
+            if dates.max() >= np.datetime64(datetime.datetime.today() - datetime.timedelta(days=14)):
+                surface = PLOT_CACHE.surface("mice", CURRENT_MOUSE, "performance")
                 plot_rect = surface.get_rect()
                 plot_rect.center = back_rect.center
                 plot_rect.centery = plot_rect.centery + 40
@@ -370,10 +661,7 @@ def main_background():
         gfxdraw.filled_polygon(SCREEN, PAIRING_MENUBAR._polygon_pos, MAIN_MENUBAR._font_color)
 
         if len(CONFIG["mice"]) > 0 and CONFIG["mice"][CURRENT_MOUSE]["pairing_duration"].keys():
-            performance = [CONFIG["mice"][CURRENT_MOUSE]["pairing_duration"][date] for date
-                           in CONFIG["mice"][CURRENT_MOUSE]["pairing_duration"]]
-            dates = [parser.parse(date, dayfirst=True) for date in CONFIG["mice"][CURRENT_MOUSE]["pairing_duration"]]
-            surface = plot_performance(dates, performance)
+            surface = PLOT_CACHE.surface("mice", CURRENT_MOUSE, "pairing_duration")
             plot_rect = surface.get_rect()
             plot_rect.center = back_rect.center
             plot_rect.centery = plot_rect.centery + 40
@@ -385,11 +673,8 @@ def main_background():
         pygame.draw.rect(SCREEN, MENU_BACKGROUND_COLOR, back_rect)
         gfxdraw.filled_polygon(SCREEN, PAIRING_MENUBAR._polygon_pos, MAIN_MENUBAR._font_color)
 
-        if len(CONFIG["mice"]) > 0 and CONFIG["rats"][CURRENT_RAT]["pairing_duration"].keys():
-            performance = [CONFIG["rats"][CURRENT_RAT]["pairing_duration"][date] for date
-                           in CONFIG["rats"][CURRENT_RAT]["pairing_duration"]]
-            dates = [parser.parse(date) for date in CONFIG["rats"][CURRENT_RAT]["pairing_duration"]]
-            surface = plot_performance(dates, performance)
+        if len(CONFIG["rats"]) > 0 and CONFIG["rats"][CURRENT_RAT]["pairing_duration"].keys():
+            surface = PLOT_CACHE.surface("rats", CURRENT_RAT, "pairing_duration", dayfirst=False)
             plot_rect = surface.get_rect()
             plot_rect.center = back_rect.center
             plot_rect.centery = plot_rect.centery + 40
@@ -402,81 +687,18 @@ def main_background():
         gfxdraw.filled_polygon(SCREEN, HARDWARE_MENUBAR._polygon_pos, MAIN_MENUBAR._font_color)
         text_rect = pygame.Rect((0, 0), (int(MENU_SIZE[0] * 1.05), int(MENU_SIZE[1] * 0.8)))
         text_rect = text_rect.move(WINDOW_SIZE[0] * 0.13, WINDOW_SIZE[1] * 0.12)
-        text_font = pygame.font.SysFont(FONT_NAME, 30, bold=False)
-        annotation_font = pygame.font.SysFont(FONT_NAME, 15, bold=True)
-        blit_text_in_area(SCREEN, text_rect, hardware_descriptions[main_menu._actual._index], text_font)
-        pinout_surface = pygame.image.load('RaspberryPi3bplus.png')
-        image_width, image_height = pinout_surface.get_size()
-        annotation_surface = pygame.Surface((2 * image_width, image_height), pygame.SRCALPHA, 32)
-        annotation_surface = annotation_surface.convert_alpha()
-
-        for pin in special_pins:
-            pin_number = int(pin[0])
-            if pin_number % 2 != 0:
-                pygame.draw.line(annotation_surface, COLOR_BLACK,
-                                 (int(0.5 * image_width) + pin_positions[pin_number - 1][0],
-                                  pin_positions[pin_number - 1][1]),
-                                 (int(0.5 * image_width) + pin_positions[pin_number - 1][0] - 75,
-                                  pin_positions[pin_number - 1][1]))
-                word_surface = annotation_font.render(pin[1], 0, COLOR_BLACK)
-                word_rect = word_surface.get_rect()
-                word_rect.midright = (int(0.5 * image_width) + pin_positions[pin_number - 1][0] - 80,
-                                      pin_positions[pin_number - 1][1])
-                annotation_surface.blit(word_surface, word_rect)
-
-            else:
-                pygame.draw.line(annotation_surface, COLOR_BLACK,
-                                 (int(0.5 * image_width) + pin_positions[pin_number - 1][0],
-                                  pin_positions[pin_number - 1][1]),
-                                 (int(0.5 * image_width) + pin_positions[pin_number - 1][0] + 30,
-                                  pin_positions[pin_number - 1][1]))
-                word_surface = annotation_font.render(pin[1], 0, COLOR_BLACK)
-                word_rect = word_surface.get_rect()
-                word_rect.midleft = (int(0.5 * image_width) + pin_positions[pin_number - 1][0] + 35,
-                                     pin_positions[pin_number - 1][1])
-                annotation_surface.blit(word_surface, word_rect)
-
-        input_data = main_menu._actual.get_input_data()
-        for input_key in input_data.keys():
-            pin_number = int(input_data[input_key][0])
+        global PINOUT_OVERLAY
+        if PINOUT_OVERLAY is None:
+            PINOUT_OVERLAY = PinoutOverlay('RaspberryPi3bplus.png', FONT_NAME)
+        blit_text_in_area(SCREEN, text_rect, hardware_descriptions[main_menu._actual._index],
+                          PINOUT_OVERLAY.text_font)
+
+        pins = []
+        for input_key, value in main_menu._actual.get_input_data().items():
             corresponding_widget = main_menu._actual.get_widget(input_key)
-            if corresponding_widget.selected:
-                annotation_color = COLOR_WHITE
-            else:
-                annotation_color = COLOR_BLACK
-            if pin_number % 2 != 0:
-                pygame.draw.line(annotation_surface, annotation_color,
-                                 (int(0.5 * image_width) + pin_positions[pin_number - 1][0],
-                                  pin_positions[pin_number - 1][1]),
-                                 (int(0.5 * image_width) + pin_positions[pin_number - 1][0] - 75,
-                                  pin_positions[pin_number - 1][1]))
-                word_surface = annotation_font.render(corresponding_widget._label.strip(': '),
-                                                      0, annotation_color)
-                word_rect = word_surface.get_rect()
-                word_rect.midright = (int(0.5 * image_width) + pin_positions[pin_number - 1][0] - 80,
-                                      pin_positions[pin_number - 1][1])
-                annotation_surface.blit(word_surface, word_rect)
-
-            else:
-                pygame.draw.line(annotation_surface, annotation_color,
-                                 (int(0.5 * image_width) + pin_positions[pin_number - 1][0],
-                                  pin_positions[pin_number - 1][1]),
-                                 (int(0.5 * image_width) + pin_positions[pin_number - 1][0] + 30,
-                                  pin_positions[pin_number - 1][1]))
-                word_surface = annotation_font.render(corresponding_widget._label.strip(': '),
-                                                      0, annotation_color)
-                word_rect = word_surface.get_rect()
-                word_rect.midleft = (int(0.5 * image_width) + pin_positions[pin_number - 1][0] + 35,
-                                     pin_positions[pin_number - 1][1])
-                annotation_surface.blit(word_surface, word_rect)
-
-        annotation_surface = pygame.transform.rotozoom(annotation_surface, 0, 1.3)
-        pinout_surface = pygame.transform.rotozoom(pinout_surface, 0, 1.3)
-        pinout_rectangle = pinout_surface.get_rect().move(WINDOW_SIZE[0] * 0.335, WINDOW_SIZE[1] * 0.17)
-        annotation_rectangle = annotation_surface.get_rect()
-        annotation_rectangle.center = pinout_rectangle.center
-        SCREEN.blit(pinout_surface, pinout_rectangle)
-        SCREEN.blit(annotation_surface, annotation_rectangle)
+            pins.append((int(value[0]), corresponding_widget._label.strip(': '), corresponding_widget.selected))
+        PINOUT_OVERLAY.update(pins)
+        PINOUT_OVERLAY.blit(SCREEN, (WINDOW_SIZE[0] * 0.335, WINDOW_SIZE[1] * 0.17))
 
     global MESSAGE_TIMERS
     if any(MESSAGE_TIMERS.values()):
@@ -525,11 +747,6 @@ def blit_text_in_area(surface, area, text, font, color=pygame.Color('black')):
         y += word_height  # Start on new row.
 
 
-def save_results():
-    with open('results.json', 'w') as outfile:
-        json.dump(RESULTS, outfile, indent=4, default=str)
-
-
 # -------------------------------------------------------------------------
 # Loops
 # -------------------------------------------------------------------------
@@ -565,11 +782,10 @@ def calibration_loop():
                 if event.key == pygame.K_RETURN:
                     global p_cm_input  # Points back into menu, to update it when this closes.
                     p_cm_ratio = (bars[1].left - bars[0].right) / 10
-                    CONFIG["settings"]["setup"]["p_cm_ratio"] = p_cm_ratio
+                    CONFIG.set_settings("setup", {"p_cm_ratio": p_cm_ratio})
+                    CONFIG.save()
                     MESSAGE_TIMERS["Pixel/Centimeter calibrated."] = time.time() + message_duration
                     p_cm_input._input_string = str(p_cm_ratio)
-                    with open('config.json', 'w') as outfile:
-                        json.dump(CONFIG, outfile, indent=4, default=str)
                     return
 
         SCREEN.fill(black)
@@ -593,17 +809,14 @@ def experiment_loop():
         MESSAGE_TIMERS["No rat found."] = time.time() + message_duration
         return
 
-    # Load result storage
-    global RESULTS
-    with open('results.json') as json_data_file:
-        RESULTS = json.load(json_data_file)
-
-    experiment_start = datetime.datetime.now().strftime("%d-%m-%Y (%H:%M:%S.%f)")
+    session_start = datetime.datetime.now()
+    experiment_start = session_start.strftime("%d-%m-%Y (%H:%M:%S.%f)")
+    # The statistics process keeps the traces it shows, trial by trial (python TPM_Dashboard.py --replay <file>)
+    trace_location = f'{experiment_start} traces.rec'
 
-    RESULTS[experiment_start] = dict()
-    RESULTS[experiment_start]["mouse"] = CURRENT_MOUSE
-    RESULTS[experiment_start]["config"] = CONFIG
-    RESULTS[experiment_start]["measurements"] = dict()
+    # Every session gets its own append-only result file, every finished trial is added to it (see TPM_Results)
+    session_store = TPM_Results.SessionStore(session_start, CURRENT_MOUSE, CURRENT_RAT, CONFIG["settings"],
+                                             traces_file=trace_location)
 
     # Load font
     font = pygame.font.SysFont(FONT_NAME, 30, bold=True)
@@ -626,13 +839,31 @@ def experiment_loop():
 
     screens = screeninfo.get_monitors()
 
+    statistics_screen = None
     for screen in screens:
         if screen.x == 0:
             experiment_screen = screen
         else:
             statistics_screen = screen
 
-    latest_line = multiprocessing.Array('f', 3)
+    # Without a second screen the statistics are rendered headless into a shared framebuffer (see TPM_Dashboard)
+    statistics_settings = CONFIG["settings"]["statistics"]
+    headless_statistics = statistics_settings["headless"] or statistics_screen is None
+
+    # The hardware recorders publish the timestamp and all ADS channels of the channel table
+    channel_table = TPM_Channels.ChannelTable.from_config(CONFIG["settings"]["recorder"],
+                                                          CONFIG["settings"]["hardware"])
+    # Next to the raw samples the recorder publishes decimated streams, the tracer only reads one of those
+    stream_rates = CONFIG["settings"]["recorder"]["stream_rates"]
+    tracer_stream_rate = CONFIG["settings"]["recorder"]["tracer_stream_rate"]
+    if VIRTUAL_EXPERIMENT:
+        sample_ring = TPM_RingBuffer.SampleStreams(TPM_RingBuffer.SAMPLE_COLUMNS, rates=stream_rates)
+    else:
+        assert all(column in channel_table.ring_columns for column in TPM_RingBuffer.SAMPLE_COLUMNS), \
+            'The channel table needs an ADS channel named Position and one named Speed.'
+        sample_ring = TPM_RingBuffer.SampleStreams(channel_table.ring_columns, rates=stream_rates)
+    sample_reader = sample_ring.reader()
+    stream_monitor = TPM_Timing.StreamMonitor('EXPERIMENT STREAM')
     to_recorder, recorder_instructions = multiprocessing.Pipe()
     to_tracer, tracer_instructions = multiprocessing.Pipe()
 
@@ -648,15 +879,19 @@ def experiment_loop():
     experiment_screen = ExperimentScreen(SCREEN, experiment_screen_size, experiment_screen_position,
                                          (ahead_buffer, onscreen_objects, behind_buffer),
                                          marker_height, IMAGE_LIST, font)
+    # Draws the frames, only the changed areas are updated unless dirty rendering is turned off
+    display_updater = DisplayUpdater(SCREEN, experiment_screen, CONFIG["settings"]["advanced"]["dirty_rendering"])
+    # Debug text, the values are only formatted and drawn again every hud_interval seconds
+    hud = TPM_Hud.HudText(font, (WINDOW_SIZE[0], 0), align='right',
+                          interval=CONFIG["settings"]["advanced"]["hud_interval"])
+    fps_hud = TPM_Hud.HudText(pygame.font.SysFont('Comic Sans MS', 30))
 
     # Load settings
     acceleration_cutoff = CONFIG["settings"]["advanced"]["acceleration_cutoff"]
     reward_abort = CONFIG["settings"]["advanced"]["reward_abort"]
     tube_out = CONFIG["settings"]["hardware"]["tube_out"]
     disk_out = CONFIG["settings"]["hardware"]["disk_out"]
-    mouse_lick_in = CONFIG["settings"]["hardware"]["mouse_lick_in"]
     mouse_lick_out = CONFIG["settings"]["hardware"]["mouse_lick_out"]
-    rat_lick_in = CONFIG["settings"]["hardware"]["rat_lick_in"]
     rat_lick_out = CONFIG["settings"]["hardware"]["rat_lick_out"]
     if CONFIG["settings"]["setup"]["main_screen_direction_left"]:
         screen_direction = -1
@@ -668,7 +903,7 @@ def experiment_loop():
         user_input = multiprocessing.Queue()
         record_process = multiprocessing.Process(target=TPM_Recorder.virtual_recorder_func, args=(instructions,
                                                                                                   go_event,
-                                                                                                  latest_line,
+                                                                                                  sample_ring,
                                                                                                   recorder_instructions,
                                                                                                   user_input))
 
@@ -682,35 +917,80 @@ def experiment_loop():
 
     # Else import and prepare the Raspberry Pi communication with the ADC and the PWM pins
     else:
-        record_process = multiprocessing.Process(target=TPM_Recorder.analog_recorder_func, args=(instructions,
-                                                                                                 go_event,
-                                                                                                 latest_line,
-                                                                                                 recorder_instructions,
-                                                                                                 (mouse_lick_in,
-                                                                                                  rat_lick_in)
-                                                                                                 ))
-
-        # Prepare the PWM-pin to be written on
-        import pigpio
-        pi = pigpio.pi()
+        recorder_settings = CONFIG["settings"]["recorder"]
+        replay = recorder_settings["sampling_mode"] == "replay"
+        if replay:
+            record_process = multiprocessing.Process(target=TPM_Recorder.replay_recorder_func,
+                                                     args=(instructions, go_event, sample_ring, recorder_instructions,
+                                                           recorder_settings["replay_location"]),
+                                                     kwargs={'speed': recorder_settings["replay_speed"]})
+        elif recorder_settings["sampling_mode"] == "continuous":
+            record_process = multiprocessing.Process(target=TPM_Recorder.continuous_recorder_func,
+                                                     args=(instructions, go_event, sample_ring, recorder_instructions,
+                                                           channel_table, recorder_settings["adc_alert_in"]),
+                                                     kwargs={'target_sps': recorder_settings["target_sps"],
+                                                             'backend': recorder_settings["backend"]})
+        else:
+            record_process = multiprocessing.Process(target=TPM_Recorder.analog_recorder_func,
+                                                     args=(instructions, go_event, sample_ring, recorder_instructions,
+                                                           channel_table),
+                                                     kwargs={'target_sps': recorder_settings["target_sps"],
+                                                             'backend': recorder_settings["backend"]})
+
+        # Prepare the PWM-pin to be written on (replayed experiments run without the setup)
+        pi = TPM_Hardware.connect_pi(fake_hardware=replay)
         pi.hardware_PWM(tube_out, 500, 100000)
         pi.hardware_PWM(disk_out, 500, 100000)
         print("PiGPIO PWM initialized.")
 
         # Prepare to write the lick-outputs
-        pi.set_mode(mouse_lick_out, pigpio.OUTPUT)
-        pi.set_mode(rat_lick_out, pigpio.OUTPUT)
+        pi.set_mode(mouse_lick_out, TPM_Hardware.OUTPUT)
+        pi.set_mode(rat_lick_out, TPM_Hardware.OUTPUT)
         print("PiGPIO output initialized.")
 
-    trace_process = multiprocessing.Process(target=TPM_Statistics.tracer_func, args=(instructions,
-                                                                                     go_event, stop_event,
-                                                                                     tracer_instructions,
-                                                                                     latest_line, statistics_screen))
+    if headless_statistics:
+        trace_process = multiprocessing.Process(target=TPM_Dashboard.statistics_render_func,
+                                                args=(instructions, go_event, stop_event, tracer_instructions,
+                                                      sample_ring),
+                                                kwargs={'stream_rate': tracer_stream_rate,
+                                                        'target_fps': statistics_settings["target_fps"],
+                                                        'framebuffer_name': statistics_settings["framebuffer_name"],
+                                                        'trace_location': trace_location})
+    else:
+        trace_process = multiprocessing.Process(target=TPM_Statistics.tracer_func,
+                                                args=(instructions, go_event, stop_event, tracer_instructions,
+                                                      sample_ring, statistics_screen),
+                                                kwargs={'stream_rate': tracer_stream_rate,
+                                                        'trace_location': trace_location})
 
     trace_process.start()
     # pyautogui.click(10, 10)
     record_process.start()
 
+    def end_session(status):
+        """
+        Closes the session file and stops tracer and recorder. An aborted session still stores the running trial and
+        retracts the tube.
+        :param status: 'finished' or 'aborted'
+        """
+        if status == 'aborted' and not VIRTUAL_EXPERIMENT:
+            session_store.add_trial(trial, trial_result)
+            pi.hardware_PWM(tube_out, 500, 100000)
+        session_store.close(status)
+
+        # The tracer archives the last trial on Dump, both processes are done before the ring goes away
+        to_tracer.send(instructions.Dump)
+        print('tracer told to stop')
+        to_tracer.send(instructions.Stop)
+        print('recorder told to stop')
+        to_recorder.send(instructions.Stop)
+        trace_process.join()
+        record_process.join()
+        sample_ring.close()
+
+        message = "Experiment finished." if status == 'finished' else "Experiment ended."
+        MESSAGE_TIMERS[message] = time.time() + message_duration
+
     # external values and parameters
     speed_multiplier = CONFIG["settings"]["experiment"]["speed_multiplier"]
 
@@ -738,12 +1018,12 @@ def experiment_loop():
     for trial in range(1, trial_number + 1):
         # Preparing storage for this trial
         if not VIRTUAL_EXPERIMENT:
-            RESULTS[experiment_start]["measurements"]["trial_" + str(trial)] = dict()
-            RESULTS[experiment_start]["measurements"]["trial_" + str(trial)]["phase_transitions"] = []
-            RESULTS[experiment_start]["measurements"]["trial_" + str(trial)]["disk_state"] = disk_names[
-                disk_states[trial - 1]]
-            RESULTS[experiment_start]["measurements"]["trial_" + str(trial)]["trial_phase"]["rat_position"] = []
-            RESULTS[experiment_start]["measurements"]["trial_" + str(trial)]["reward_phase"]["records_file"] = ''
+            trial_result = {
+                "phase_transitions": [],
+                "disk_state": disk_names[disk_states[trial - 1]],
+                "trial_phase": {"rat_position": []},
+                "reward_phase": {"records_file": ''}
+            }
 
         # Writing the disk-movement
         if VIRTUAL_EXPERIMENT:
@@ -762,11 +1042,18 @@ def experiment_loop():
         to_tracer.send(instructions.Reset)
         to_tracer.send(trial_length + reward_length + inter_trial_length)
         to_recorder.send(instructions.Reset)
+        print(stream_monitor.report())
+        print(display_updater.report())
+        stream_monitor.reset()
+        display_updater.reset()
 
         if not VIRTUAL_EXPERIMENT:
-            to_recorder.send(f'{experiment_start}\trial_{trial}.csv')
-            RESULTS[experiment_start]["measurements"]["trial_" + str(trial)][
-                "reward_phase"]["records_file"] = f'{experiment_start}\trial_{trial}.csv'
+            to_recorder.send(f'{experiment_start}\trial_{trial}.rec')
+            trial_result["reward_phase"]["records_file"] = f'{experiment_start}\trial_{trial}.rec'
+            # The recorder opens the file of the next trial in the background, the next Reset only switches over
+            if trial < trial_number:
+                to_recorder.send(instructions.Prepare)
+                to_recorder.send(f'{experiment_start}\trial_{trial + 1}.rec')
 
         go_event.clear()
         to_tracer.send(instructions.Ready)
@@ -774,8 +1061,8 @@ def experiment_loop():
         go_event.wait()
 
         tube_position = 0
-        old_position_volt = latest_line[1]
-        old_delta_position_volt = 0
+        old_position_volt = sample_ring.latest()[sample_ring.column('Position')]
+        sample_reader.skip()
 
         trial_start = time.perf_counter()
         last_frame = trial_start
@@ -785,10 +1072,10 @@ def experiment_loop():
             start_time = trial_start
             x = 0.5
             counter = 0
-            text_surface = pygame.Surface((100, 100))
 
         if not VIRTUAL_EXPERIMENT:
-            RESULTS[experiment_start]["measurements"]["trial_" + str(trial)]["phase_transitions"].append(latest_line[0])
+            trial_result["phase_transitions"].append(
+                sample_ring.latest()[sample_ring.column('Timestamp')])
 
         # Trial-phase loop
         while time.perf_counter() < trial_end:
@@ -810,55 +1097,27 @@ def experiment_loop():
 
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
-                        if not VIRTUAL_EXPERIMENT:
-                            save_results()
-                            pi.hardware_PWM(tube_out, 500, 100000)
-
-                        to_tracer.send(instructions.Dump)
-                        print('tracer told to stop')
-                        to_tracer.send(instructions.Stop)
-                        print('recorder told to stop')
-                        to_recorder.send(instructions.Stop)
-                        trace_process.join()
-                        record_process.join()
-
-                        MESSAGE_TIMERS["Experiment ended."] = time.time() + message_duration
+                        end_session('aborted')
                         return
 
             if stop_event.is_set():
-                if not VIRTUAL_EXPERIMENT:
-                    save_results()
-                    pi.hardware_PWM(tube_out, 500, 100000)
-
-                to_tracer.send(instructions.Dump)
-                print('tracer told to stop')
-                to_tracer.send(instructions.Stop)
-                print('recorder told to stop')
-                to_recorder.send(instructions.Stop)
-                trace_process.join()
-                record_process.join()
-
-                MESSAGE_TIMERS["Experiment ended."] = time.time() + message_duration
+                end_session('aborted')
                 return
 
-            # Filling screen and showing starting signal
+            clock.tick(target_fps)
+            # Filling screen and showing starting signal (a new colour redraws the whole screen)
             if time.time() < trial_start + 1.2:
                 if int((time.time() - trial_start) / 0.2) % 2 != 0:
-                    SCREEN.fill(starting_color)
+                    display_updater.begin(starting_color)
                 else:
-                    SCREEN.fill(black)
+                    display_updater.begin(black)
             else:
-                SCREEN.fill(black)
-            clock.tick(target_fps)
+                display_updater.begin(black)
 
-            position_volt = latest_line[1]
+            position_volt, delta_position_volt = read_wheel_position(sample_reader, old_position_volt,
+                                                                     acceleration_cutoff, stream_monitor)
             this_frame = time.perf_counter()
-            delta_position_volt = position_volt - old_position_volt
             old_position_volt = position_volt
-            delta2_position_volt = delta_position_volt - old_delta_position_volt
-
-            if abs(delta2_position_volt) > acceleration_cutoff:
-                continue
 
             delta_position_real = delta_position_volt / 5.033 * wheel_circumference
 
@@ -874,12 +1133,13 @@ def experiment_loop():
 
             absolute_position += delta_position_real
 
-            text = ["Phase: Trial",
-                    f"Screen speed: {speed_multiplier * delta_position_real / (this_frame - last_frame)}",
-                    f"Volt position [in V]: {position_volt}",
-                    f"Volt delta [in V]: {delta_position_volt}",
-                    f"Virtual position [in cm]: {tube_position}",
-                    f"Current disk state: {disk_names[disk_states[trial - 1]]}"]
+            if hud.due():
+                hud.update(["Phase: Trial",
+                            f"Screen speed: {speed_multiplier * delta_position_real / (this_frame - last_frame)}",
+                            f"Volt position [in V]: {position_volt}",
+                            f"Volt delta [in V]: {delta_position_volt}",
+                            f"Virtual position [in cm]: {tube_position}",
+                            f"Current disk state: {disk_names[disk_states[trial - 1]]}"])
 
             last_frame = this_frame
 
@@ -888,38 +1148,35 @@ def experiment_loop():
                 break
 
             # Moving the markers
-            experiment_screen.move(screen_direction * speed_multiplier * p_cm_ratio * delta_position_real)
-            experiment_screen.blit_to_parent()
+            display_updater.move_markers(screen_direction * speed_multiplier * p_cm_ratio * delta_position_real)
 
-            for i, l in enumerate(text):
-                render = font.render(l, 0, (255, 255, 255))
-                SCREEN.blit(render, (WINDOW_SIZE[0] - render.get_size()[0], 0 + font.get_linesize() * i))
+            for surface, position in hud.items():
+                display_updater.overlay(surface, position)
 
             if VIRTUAL_EXPERIMENT:
                 visual_output[1][0].center = [200 + 20 * tube_position, 50]
-                SCREEN.blit(visual_output[0][0], visual_output[1][0])
-                SCREEN.blit(visual_output[0][1], visual_output[1][1])
+                display_updater.overlay(visual_output[0][0], visual_output[1][0])
+                display_updater.overlay(visual_output[0][1], visual_output[1][1])
 
             if show_fps:
                 counter += 1
                 if (time.perf_counter() - start_time) > x:
-                    my_font = pygame.font.SysFont('Comic Sans MS', 30)
-                    text_surface = my_font.render(f'FPS: {int(counter / (time.perf_counter() - start_time))}',
-                                                  False, (255, 255, 255))
+                    fps_hud.update([f'FPS: {int(counter / (time.perf_counter() - start_time))}'])
                     start_time = time.perf_counter()
                     counter = 0
 
-                SCREEN.blit(text_surface, (0, 0))
+                for surface, position in fps_hud.items():
+                    display_updater.overlay(surface, position)
 
-            pygame.display.flip()
+            display_updater.end()
 
         if get_reward:
             to_tracer.send(instructions.Phase)
             to_tracer.send('Reward')
 
             if not VIRTUAL_EXPERIMENT:
-                RESULTS[experiment_start]["measurements"]["trial_" + str(trial)]["phase_transitions"].append(
-                    latest_line[0])
+                trial_result["phase_transitions"].append(
+                    sample_ring.latest()[sample_ring.column('Timestamp')])
 
             reward_start = time.perf_counter()
             reward_end = reward_start + reward_length
@@ -938,48 +1195,20 @@ def experiment_loop():
 
                     if event.type == pygame.KEYDOWN:
                         if event.key == pygame.K_ESCAPE:
-                            if not VIRTUAL_EXPERIMENT:
-                                save_results()
-                                pi.hardware_PWM(tube_out, 500, 100000)
-
-                            to_tracer.send(instructions.Dump)
-                            print('tracer told to stop')
-                            to_tracer.send(instructions.Stop)
-                            print('recorder told to stop')
-                            to_recorder.send(instructions.Stop)
-                            trace_process.join()
-                            record_process.join()
-
-                            MESSAGE_TIMERS["Experiment ended."] = time.time() + message_duration
+                            end_session('aborted')
                             return
 
                 if stop_event.is_set():
-                    if not VIRTUAL_EXPERIMENT:
-                        save_results()
-                        pi.hardware_PWM(tube_out, 500, 100000)
-
-                    to_tracer.send(instructions.Dump)
-                    print('tracer told to stop')
-                    to_tracer.send(instructions.Stop)
-                    print('recorder told to stop')
-                    to_recorder.send(instructions.Stop)
-                    trace_process.join()
-                    record_process.join()
-
-                    MESSAGE_TIMERS["Experiment ended."] = time.time() + message_duration
+                    end_session('aborted')
                     return
 
                 # Filling screen
-                SCREEN.fill(black)
+                display_updater.begin(black)
 
-                position_volt = latest_line[1]
+                position_volt, delta_position_volt = read_wheel_position(sample_reader, old_position_volt,
+                                                                         acceleration_cutoff, stream_monitor)
                 this_frame = time.perf_counter()
-                delta_position_volt = position_volt - old_position_volt
                 old_position_volt = position_volt
-                delta2_position_volt = delta_position_volt - old_delta_position_volt
-
-                if abs(delta2_position_volt) > acceleration_cutoff:
-                    continue
 
                 delta_position_real = delta_position_volt / 5.033 * wheel_circumference
 
@@ -995,52 +1224,46 @@ def experiment_loop():
 
                 absolute_position += delta_position_real
 
-                text = ["Phase: Reward",
-                        f"Screen speed: {speed_multiplier * delta_position_real / (this_frame - last_frame)}",
-                        f"Volt position [in V]: {position_volt}",
-                        f"Volt delta [in V]: {delta_position_volt}",
-                        f"Virtual position [in cm]: {tube_position}",
-                        f"Current disk state: {disk_names[disk_states[trial - 1]]}"]
+                if hud.due():
+                    hud.update(["Phase: Reward",
+                                f"Screen speed: {speed_multiplier * delta_position_real / (this_frame - last_frame)}",
+                                f"Volt position [in V]: {position_volt}",
+                                f"Volt delta [in V]: {delta_position_volt}",
+                                f"Virtual position [in cm]: {tube_position}",
+                                f"Current disk state: {disk_names[disk_states[trial - 1]]}"])
 
                 last_frame = this_frame
 
-                for i, l in enumerate(text):
-                    render = font.render(l, 0, (255, 255, 255))
-                    SCREEN.blit(render, (WINDOW_SIZE[0] - render.get_size()[0], 0 + font.get_linesize() * i))
-
                 # Moving the markers
-                experiment_screen.move(screen_direction * speed_multiplier * p_cm_ratio * delta_position_real)
-                experiment_screen.blit_to_parent()
+                display_updater.move_markers(screen_direction * speed_multiplier * p_cm_ratio * delta_position_real)
 
-                for i, l in enumerate(text):
-                    render = font.render(l, 0, (255, 255, 255))
-                    SCREEN.blit(render, (WINDOW_SIZE[0] - render.get_size()[0], 0 + font.get_linesize() * i))
+                for surface, position in hud.items():
+                    display_updater.overlay(surface, position)
 
                 if VIRTUAL_EXPERIMENT:
                     visual_output[1][0].center = [200 + 20 * tube_position, 50]
-                    SCREEN.blit(visual_output[0][0], visual_output[1][0])
-                    SCREEN.blit(visual_output[0][1], visual_output[1][1])
+                    display_updater.overlay(visual_output[0][0], visual_output[1][0])
+                    display_updater.overlay(visual_output[0][1], visual_output[1][1])
 
                 if show_fps:
                     counter += 1
                     if (time.perf_counter() - start_time) > x:
-                        my_font = pygame.font.SysFont('Comic Sans MS', 30)
-                        text_surface = my_font.render(f'FPS: {int(counter / (time.perf_counter() - start_time))}',
-                                                      False, (255, 255, 255))
+                        fps_hud.update([f'FPS: {int(counter / (time.perf_counter() - start_time))}'])
                         start_time = time.perf_counter()
                         counter = 0
 
-                    SCREEN.blit(text_surface, (0, 0))
+                    for surface, position in fps_hud.items():
+                        display_updater.overlay(surface, position)
 
-                pygame.display.flip()
+                display_updater.end()
 
         # Inter-trial-phase loop
-        if len(screens) > 1:
-            to_tracer.send(instructions.Phase)
-            to_tracer.send('Inter-Trial')
+        to_tracer.send(instructions.Phase)
+        to_tracer.send('Inter-Trial')
 
         if not VIRTUAL_EXPERIMENT:
-            RESULTS[experiment_start]["measurements"]["trial_" + str(trial)]["phase_transitions"].append(latest_line[0])
+            trial_result["phase_transitions"].append(
+                sample_ring.latest()[sample_ring.column('Timestamp')])
 
         inter_trial_start = time.perf_counter()
         inter_trial_end = inter_trial_start + inter_trial_length
@@ -1057,54 +1280,26 @@ def experiment_loop():
 
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
-                        if not VIRTUAL_EXPERIMENT:
-                            save_results()
-                            pi.hardware_PWM(tube_out, 500, 100000)
-
-                        to_tracer.send(instructions.Dump)
-                        print('tracer told to stop')
-                        to_tracer.send(instructions.Stop)
-                        print('recorder told to stop')
-                        to_recorder.send(instructions.Stop)
-                        trace_process.join()
-                        record_process.join()
-
-                        MESSAGE_TIMERS["Experiment ended."] = time.time() + message_duration
+                        end_session('aborted')
                         return
 
             if stop_event.is_set():
-                if not VIRTUAL_EXPERIMENT:
-                    save_results()
-                    pi.hardware_PWM(tube_out, 500, 100000)
-
-                to_tracer.send(instructions.Dump)
-                print('tracer told to stop')
-                to_tracer.send(instructions.Stop)
-                print('recorder told to stop')
-                to_recorder.send(instructions.Stop)
-                trace_process.join()
-                record_process.join()
-
-                MESSAGE_TIMERS["Experiment ended."] = time.time() + message_duration
+                end_session('aborted')
                 return
 
-            # Filling screen
+            # Filling screen (a new colour redraws the whole screen)
             if not get_reward and time.time() < inter_trial_start + 1.2:
                 if int((time.time() - inter_trial_start) / 0.2) % 2 != 0:
-                    SCREEN.fill(warning_color)
+                    display_updater.begin(warning_color)
                 else:
-                    SCREEN.fill(black)
+                    display_updater.begin(black)
             else:
-                SCREEN.fill(black)
+                display_updater.begin(black)
 
-            position_volt = latest_line[1]
+            position_volt, delta_position_volt = read_wheel_position(sample_reader, old_position_volt,
+                                                                     acceleration_cutoff, stream_monitor)
             this_frame = time.perf_counter()
-            delta_position_volt = position_volt - old_position_volt
             old_position_volt = position_volt
-            delta2_position_volt = delta_position_volt - old_delta_position_volt
-
-            if abs(delta2_position_volt) > acceleration_cutoff:
-                continue
 
             delta_position_real = delta_position_volt / 5.033 * wheel_circumference
 
@@ -1115,56 +1310,48 @@ def experiment_loop():
             elif tube_position > 0.95 * tube_distance:
                 tube_position = tube_distance
 
-            if VIRTUAL_EXPERIMENT:
-                visual_output[1][0].center = [200 + 20 * tube_position, 50]
-                SCREEN.blit(visual_output[0][0], visual_output[1][0])
-                SCREEN.blit(visual_output[0][1], visual_output[1][1])
-
-            else:
+            if not VIRTUAL_EXPERIMENT:
                 pi.hardware_PWM(tube_out, 500, 100000)
 
             absolute_position += delta_position_real
 
-            text = ["Phase: Inter-Trial",
-                    f"Screen speed: {speed_multiplier * delta_position_real / (this_frame - last_frame)}",
-                    f"Volt position [in V]: {position_volt}",
-                    f"Volt delta [in V]: {delta_position_volt}",
-                    f"Virtual position [in cm]: {tube_position}",
-                    f"Current disk state: {disk_names[disk_states[trial - 1]]}"]
+            if hud.due():
+                hud.update(["Phase: Inter-Trial",
+                            f"Screen speed: {speed_multiplier * delta_position_real / (this_frame - last_frame)}",
+                            f"Volt position [in V]: {position_volt}",
+                            f"Volt delta [in V]: {delta_position_volt}",
+                            f"Virtual position [in cm]: {tube_position}",
+                            f"Current disk state: {disk_names[disk_states[trial - 1]]}"])
 
             last_frame = this_frame
-            for i, l in enumerate(text):
-                render = font.render(l, 0, (255, 255, 255))
-                SCREEN.blit(render, (WINDOW_SIZE[0] - render.get_size()[0], 0 + font.get_linesize() * i))
 
             # Moving the markers
-            experiment_screen.move(screen_direction * speed_multiplier * p_cm_ratio * delta_position_real)
-            experiment_screen.blit_to_parent()
+            display_updater.move_markers(screen_direction * speed_multiplier * p_cm_ratio * delta_position_real)
 
-            for i, l in enumerate(text):
-                render = font.render(l, 0, (255, 255, 255))
-                SCREEN.blit(render, (WINDOW_SIZE[0] - render.get_size()[0], 0 + font.get_linesize() * i))
+            for surface, position in hud.items():
+                display_updater.overlay(surface, position)
 
             if VIRTUAL_EXPERIMENT:
                 visual_output[1][0].center = [200 + 20 * tube_position, 50]
-                SCREEN.blit(visual_output[0][0], visual_output[1][0])
-                SCREEN.blit(visual_output[0][1], visual_output[1][1])
+                display_updater.overlay(visual_output[0][0], visual_output[1][0])
+                display_updater.overlay(visual_output[0][1], visual_output[1][1])
 
             if show_fps:
                 counter += 1
                 if (time.perf_counter() - start_time) > x:
-                    my_font = pygame.font.SysFont('Comic Sans MS', 30)
-                    text_surface = my_font.render(f'FPS: {int(counter / (time.perf_counter() - start_time))}',
-                                                  False, (255, 255, 255))
+                    fps_hud.update([f'FPS: {int(counter / (time.perf_counter() - start_time))}'])
                     start_time = time.perf_counter()
                     counter = 0
 
-                SCREEN.blit(text_surface, (0, 0))
+                for surface, position in fps_hud.items():
+                    display_updater.overlay(surface, position)
 
-            pygame.display.flip()
+            display_updater.end()
+
+        if not VIRTUAL_EXPERIMENT:
+            session_store.add_trial(trial, trial_result)
 
-    save_results()
-    MESSAGE_TIMERS["Experiment finished."] = time.time() + message_duration
+    end_session('finished')
 
 
 def pairing_mouse_loop():
@@ -1186,6 +1373,7 @@ def main(test=False):
     global main_menu
     global SCREEN
     global CONFIG
+    global PLOT_CACHE
     global CURRENT_MOUSE
     global MOUSE_NR
     global MOUSE_INFO
@@ -1202,8 +1390,9 @@ def main(test=False):
     # -------------------------------------------------------------------------
     # Reading config
     # -------------------------------------------------------------------------
-    with open('config.json') as json_data_file:
-        CONFIG = json.load(json_data_file)
+    # Changes are written by the store on a short delay and atomically (see TPM_Config)
+    CONFIG = TPM_Config.ConfigStore('config.json')
+    PLOT_CACHE = PlotCache(CONFIG)
     message_duration = CONFIG["settings"]["advanced"]["message_duration"]
     MOUSE_NR = 0
     RAT_NR = 0
@@ -1676,10 +1865,8 @@ def main(test=False):
     # Menu functions
     # -------------------------------------------------------------------------
     def save_config(*args):
-        global CONFIG
         global MESSAGE_TIMERS
-        with open('config.json', 'w') as outfile:
-            json.dump(CONFIG, outfile, indent=4, default=str)
+        CONFIG.save()
         MESSAGE_TIMERS["Config saved."] = time.time() + message_duration
 
     # Main Menu
@@ -1690,14 +1877,8 @@ def main(test=False):
     def update_experiment_start_menu(*args):
         global VIRTUAL_EXPERIMENT
         input_data = experiment_parameter_menu.get_input_data()
-        for key in input_data.keys():
-            if key == "virtual_experiment":
-                if input_data[key][0] == "Yes":
-                    VIRTUAL_EXPERIMENT = True
-                else:
-                    VIRTUAL_EXPERIMENT = False
-                continue
-            CONFIG["settings"]["experiment"][key] = input_data[key]
+        VIRTUAL_EXPERIMENT = input_data.pop("virtual_experiment")[0] == "Yes"
+        CONFIG.set_settings("experiment", input_data)
 
         experiment_start_menu._text = \
             ['Run a virtual experiment?: {0}'.format("Yes" if VIRTUAL_EXPERIMENT else "No"),
@@ -1786,9 +1967,7 @@ def main(test=False):
 
     # Pairing Mouse Parameter Menu
     def update_pairing_mouse_start_menu(*args):
-        input_data = pairing_mouse_parameter_menu.get_input_data()
-        for key in input_data.keys():
-            CONFIG["settings"]["pairing_mouse"][key] = input_data[key]
+        CONFIG.set_settings("pairing_mouse", pairing_mouse_parameter_menu.get_input_data())
 
         pairing_mouse_start_menu._text = \
             ['Number of trials: {0}'.format(CONFIG["settings"]["pairing_mouse"]["trial_number"]),
@@ -1802,9 +1981,7 @@ def main(test=False):
 
     # Pairing Rat Parameter Menu
     def update_pairing_rat_start_menu(*args):
-        input_data = pairing_rat_parameter_menu.get_input_data()
-        for key in input_data.keys():
-            CONFIG["settings"]["pairing_rat"][key] = input_data[key]
+        CONFIG.set_settings("pairing_rat", pairing_rat_parameter_menu.get_input_data())
 
         pairing_rat_start_menu._text = \
             ['Number of trials: {0}'.format(CONFIG["settings"]["pairing_rat"]["trial_number"]),
@@ -1819,9 +1996,7 @@ def main(test=False):
 
     # Setup Settings Menu
     def update_setup_settings_menu(*args):
-        input_data = setup_settings_menu.get_input_data()
-        for key in input_data.keys():
-            CONFIG["settings"]["setup"][key] = input_data[key]
+        CONFIG.set_settings("setup", setup_settings_menu.get_input_data())
 
     # Hardware Settings Menu
     # Lists for the hardware menu
@@ -1859,15 +2034,13 @@ def main(test=False):
                     while corresponding_widget.get_value() in input_data.values():
                         corresponding_widget._index = (corresponding_widget._index - 1) % 21
                 index_memory[input_key] = corresponding_widget._index
-                CONFIG["settings"]["hardware"][input_key] = \
-                    corresponding_widget._elements[corresponding_widget._index][1]
+                CONFIG.set_settings("hardware",
+                                    {input_key: corresponding_widget._elements[corresponding_widget._index][1]})
                 break
 
     # Advanced Settings Menu
     def update_advanced_settings_menu(*args):
-        input_data = advanced_settings_menu.get_input_data()
-        for key in input_data.keys():
-            CONFIG["settings"]["advanced"][key] = input_data[key]
+        CONFIG.set_settings("advanced", advanced_settings_menu.get_input_data())
 
     # Mouse Menu
     def change_mouse(value, *args):
@@ -1894,8 +2067,8 @@ def main(test=False):
             ] for item in sublist]
         if not CONFIG["mice"][CURRENT_MOUSE]["performance"].keys():
             experiment_profile_menu._text[5] = "No performance records found."
-        elif all(parser.parse(date, dayfirst=True) < datetime.datetime.today() - datetime.timedelta(days=14)
-                 for date in CONFIG["mice"][CURRENT_MOUSE]["performance"].keys()):
+        elif PLOT_CACHE.record("mice", CURRENT_MOUSE, "performance")[0].max() < \
+                np.datetime64(datetime.datetime.today() - datetime.timedelta(days=14)):
             experiment_profile_menu._text[5] = "Performance records older than 14 days."
         if pairing_selector_type.get_value()[0] == "Mouse":
             pairing_selector_profile._index = MOUSE_NR
@@ -1922,27 +2095,23 @@ def main(test=False):
 
     # Add Mouse Menu
     def add_mouse():
-        global CONFIG
         data = add_mouse_menu.get_input_data()
-        CONFIG["mice"][data["id"]] = dict()
-        CONFIG["mice"][data["id"]]["name"] = data["name"]
         raw_date = str(data["dob"])
-        CONFIG["mice"][data["id"]]["dob"] = datetime.date(int(raw_date[-4:]), int(raw_date[-6:-4]), int(raw_date[:-6]))
-        CONFIG["mice"][data["id"]]["weight"] = data["weight"]
-        CONFIG["mice"][data["id"]]["performance"] = dict()
-        CONFIG["mice"][data["id"]]["pairing_duration"] = dict()
-        with open('config.json', 'w') as outfile:
-            json.dump(CONFIG, outfile, indent=4, default=str)
+        CONFIG.add_animal("mice", data["id"], {
+            "name": data["name"],
+            "dob": datetime.date(int(raw_date[-4:]), int(raw_date[-6:-4]), int(raw_date[:-6])),
+            "weight": data["weight"],
+            "performance": dict(),
+            "pairing_duration": dict()
+        })
+        CONFIG.save()
 
         global CURRENT_MOUSE
         global MOUSE_NR
         global MOUSE_INFO
 
-        if len(CONFIG["mice"]) == 1:
-            CURRENT_MOUSE = list(CONFIG["mice"].keys())[0]
-        else:
-            MOUSE_NR = len(CONFIG["mice"]) - 1
-            CURRENT_MOUSE = list(CONFIG["mice"].keys())[MOUSE_NR]
+        MOUSE_NR = CONFIG.animal_index("mice", data["id"])
+        CURRENT_MOUSE = data["id"]
 
         MOUSE_INFO = ['Name: {0}'.format(CONFIG["mice"][CURRENT_MOUSE]["name"]),
                       'Date of Birth: {0}'.format(CONFIG["mice"][CURRENT_MOUSE]["dob"]),
@@ -1961,8 +2130,8 @@ def main(test=False):
             ] for item in sublist]
         if not CONFIG["mice"][CURRENT_MOUSE]["performance"].keys():
             experiment_profile_menu._text[5] = "No performance records found."
-        elif all(parser.parse(date, dayfirst=True) < datetime.datetime.today() - datetime.timedelta(days=14)
-                 for date in CONFIG["mice"][CURRENT_MOUSE]["performance"].keys()):
+        elif PLOT_CACHE.record("mice", CURRENT_MOUSE, "performance")[0].max() < \
+                np.datetime64(datetime.datetime.today() - datetime.timedelta(days=14)):
             experiment_profile_menu._text[5] = "Performance records older than 14 days."
 
         if pairing_selector_type.get_value()[0] == "Mouse":
@@ -2008,9 +2177,8 @@ def main(test=False):
         global MOUSE_NR
         global MOUSE_INFO
 
-        CONFIG["mice"].pop(CURRENT_MOUSE, None)
-        with open('config.json', 'w') as outfile:
-            json.dump(CONFIG, outfile, indent=4, default=str)
+        CONFIG.remove_animal("mice", CURRENT_MOUSE)
+        CONFIG.save()
 
         if len(CONFIG["mice"]) > 0:
             MOUSE_NR = 0
@@ -2032,8 +2200,8 @@ def main(test=False):
                 ] for item in sublist]
             if not CONFIG["mice"][CURRENT_MOUSE]["performance"].keys():
                 experiment_profile_menu._text[5] = "No performance records found."
-            elif all(parser.parse(date, dayfirst=True) < datetime.datetime.today() - datetime.timedelta(days=14)
-                     for date in CONFIG["mice"][CURRENT_MOUSE]["performance"].keys()):
+            elif PLOT_CACHE.record("mice", CURRENT_MOUSE, "performance")[0].max() < \
+                    np.datetime64(datetime.datetime.today() - datetime.timedelta(days=14)):
                 experiment_profile_menu._text[5] = "Performance records older than 14 days."
 
             if pairing_selector_type.get_value()[0] == "Mouse":
@@ -2136,26 +2304,22 @@ def main(test=False):
 
     # Add Rat Menu
     def add_rat():
-        global CONFIG
         data = add_rat_menu.get_input_data()
-        CONFIG["rats"][data["id"]] = dict()
-        CONFIG["rats"][data["id"]]["name"] = data["name"]
         raw_date = str(data["dob"])
-        CONFIG["rats"][data["id"]]["dob"] = datetime.date(int(raw_date[-4:]), int(raw_date[-6:-4]), int(raw_date[:-6]))
-        CONFIG["rats"][data["id"]]["weight"] = data["weight"]
-        CONFIG["rats"][data["id"]]["pairing_duration"] = dict()
-        with open('config.json', 'w') as outfile:
-            json.dump(CONFIG, outfile, indent=4, default=str)
+        CONFIG.add_animal("rats", data["id"], {
+            "name": data["name"],
+            "dob": datetime.date(int(raw_date[-4:]), int(raw_date[-6:-4]), int(raw_date[:-6])),
+            "weight": data["weight"],
+            "pairing_duration": dict()
+        })
+        CONFIG.save()
 
         global CURRENT_RAT
         global RAT_NR
         global RAT_INFO
 
-        if len(CONFIG["rats"]) == 1:
-            CURRENT_RAT = list(CONFIG["rats"].keys())[0]
-        else:
-            RAT_NR = len(CONFIG["rats"]) - 1
-            CURRENT_RAT = list(CONFIG["rats"].keys())[RAT_NR]
+        RAT_NR = CONFIG.animal_index("rats", data["id"])
+        CURRENT_RAT = data["id"]
 
         RAT_INFO = ['Name: {0}'.format(CONFIG["rats"][CURRENT_RAT]["name"]),
                     'Date of Birth: {0}'.format(CONFIG["rats"][CURRENT_RAT]["dob"]),
@@ -2205,9 +2369,8 @@ def main(test=False):
         global RAT_NR
         global RAT_INFO
 
-        CONFIG["rats"].pop(CURRENT_RAT, None)
-        with open('config.json', 'w') as outfile:
-            json.dump(CONFIG, outfile, indent=4, default=str)
+        CONFIG.remove_animal("rats", CURRENT_RAT)
+        CONFIG.save()
 
         if len(CONFIG["rats"]) > 0:
             RAT_NR = 0
@@ -2318,8 +2481,8 @@ def main(test=False):
         experiment_profile_menu.add_line(pygameMenu.locals.TEXT_NEWLINE)
         if not CONFIG["mice"][CURRENT_MOUSE]["performance"].keys():
             experiment_profile_menu._text[5] = "No performance records found."
-        elif all(parser.parse(date, dayfirst=True) < datetime.datetime.today() - datetime.timedelta(days=14)
-                 for date in CONFIG["mice"][CURRENT_MOUSE]["performance"].keys()):
+        elif PLOT_CACHE.record("mice", CURRENT_MOUSE, "performance")[0].max() < \
+                np.datetime64(datetime.datetime.today() - datetime.timedelta(days=14)):
             experiment_profile_menu._text[5] = "Performance records older than 14 days."
 
         if not CONFIG["mice"][CURRENT_MOUSE]["pairing_duration"].keys():
@@ -1,25 +1,28 @@
 import multiprocessing
+import os
+import re
 import pygame
 from threading import Timer
 from pandas import DataFrame
 import TPM_Utility
+import TPM_Hardware
+import TPM_Timing
 import time
-import random as rdm
-import csv
+import numpy as np
+import TPM_Records
 
 
 # accurate up until 200sps, maximum 400sps
-def analog_recorder_func(instructions, go_event, current_line, instruction_pipe, lick_inputs, target_sps=200):
+def analog_recorder_func(instructions, go_event, sample_ring, instruction_pipe, channel_table, target_sps=200,
+                         backend='binary'):
     # Initialization
     start_time = time.perf_counter()
-    output_file = None
-    writer = None
+    output_file = TPM_Records.BackgroundRecordWriter(channel_table.fieldnames, backend=backend,
+                                                     field_types=channel_table.field_types)
+    ring_width = len(channel_table.ring_columns)
     paused = True
     counter = 0
 
-    mouse_lick_in = lick_inputs[0]
-    rat_lick_in = lick_inputs[1]
-
     # Prepare the i2c communication
     import board
     import busio
@@ -30,25 +33,33 @@ def analog_recorder_func(instructions, go_event, current_line, instruction_pipe,
     import adafruit_ads1x15.ads1115 as ADS
     from adafruit_ads1x15.analog_in import AnalogIn
     ads = ADS.ADS1115(i2c)
-    ads.gain = 2 / 3
+    ads.gain = channel_table.ads_gains[0] if channel_table.ads_gains else 2 / 3
     print("ADC initialized.")
 
-    # Prepare position channel to be read
-    position_channel = AnalogIn(ads, ADS.P0)
-    velocity_channel = AnalogIn(ads, ADS.P1)
+    # Prepare the channels to be read, differential pairs get both pins (e.g. P0-P1)
+    analog_inputs = [(channel.gain, AnalogIn(ads, *[getattr(ADS, pin) for pin in channel.input.split('-')]))
+                     for channel in channel_table.ads_channels]
     print("Channels initialized.")
 
-    # Prepare to read the lick-inputs
-    import pigpio
-    pi = pigpio.pi()
-    pi.set_mode(mouse_lick_in, pigpio.INPUT)
-    pi.set_pull_up_down(mouse_lick_in, pigpio.PUD_DOWN)
-    pi.set_mode(rat_lick_in, pigpio.INPUT)
-    pi.set_pull_up_down(rat_lick_in, pigpio.PUD_DOWN)
+    def read_voltages():
+        voltages = []
+        for gain, analog_input in analog_inputs:
+            if ads.gain != gain:
+                ads.gain = gain
+            voltages.append(analog_input.voltage)
+        return voltages
+
+    # Prepare to read the gpio-inputs
+    pi = TPM_Hardware.connect_pi()
+    for pin in channel_table.gpio_pins:
+        pi.set_mode(pin, TPM_Hardware.INPUT)
+        pi.set_pull_up_down(pin, TPM_Hardware.PUD_DOWN)
     print("PiGPIO input initialized.")
 
-    target = 1. / target_sps
-    end = time.perf_counter() + target
+    # Every edge on the gpio-inputs is stored with its tick, the samples only contain the current level
+    lick_recorder = TPM_Hardware.LickEventRecorder(pi, channel_table.gpio_pins)
+
+    scheduler = TPM_Timing.DeadlineScheduler(target_sps)
 
     while True:
         # Check for new instructions
@@ -60,21 +71,30 @@ def analog_recorder_func(instructions, go_event, current_line, instruction_pipe,
                 paused = False
                 go_event.wait()
                 start_time = time.perf_counter()
+                sample_ring.set_epoch(start_time)
+                lick_recorder.start()
+                scheduler.start(start_time)
             elif command is instructions.Reset:
-                if output_file:
-                    output_file.close()
+                if output_file.file_location:
+                    lick_events = lick_recorder.take()
+                    output_file.save_table(TPM_Hardware.lick_file_location(output_file.file_location),
+                                           TPM_Records.LICK_FIELDNAMES, lick_events, meta=lick_recorder.meta())
+                    print('SAVED ' + str(len(lick_events)) + ' LICK EVENTS.')
                 print('DROPPED ' + str(counter) + ' LINES.')
+                print(scheduler.report())
+                print(output_file.report())
+                scheduler.reset()
                 file_location = instruction_pipe.recv()
-                output_file = open(file_location, 'w')
-                writer = csv.DictWriter(output_file,
-                                        fieldnames=['Timestamp', 'Position', 'Speed', 'Mouse Lick', 'Rat Lick'],
-                                        lineterminator='\n')
-                writer.writeheader()
+                output_file.rotate(file_location, meta={'target_sps': target_sps,
+                                                        'channels': channel_table.meta()})
                 counter = 0
                 paused = True
+            elif command is instructions.Prepare:
+                output_file.prepare(instruction_pipe.recv(), meta={'target_sps': target_sps,
+                                                                   'channels': channel_table.meta()})
             elif command is instructions.SamplingRate:
                 target_sps = instruction_pipe.recv()
-                target = 1. / target_sps
+                scheduler.set_rate(target_sps)
             elif command is instructions.Stop:
                 break
             else:
@@ -84,41 +104,144 @@ def analog_recorder_func(instructions, go_event, current_line, instruction_pipe,
             time.sleep(0.05)
             continue
 
-        if time.perf_counter() > end:
-            timestamp = time.perf_counter() - start_time
-            new_position = position_channel.voltage
-            new_speed = velocity_channel.voltage
-            mouse_lick = pi.read(mouse_lick_in)
-            rat_lick = pi.read(rat_lick_in)
+        scheduler.wait()
+        timestamp = time.perf_counter() - start_time
+        row = channel_table.pack(timestamp, read_voltages(), pi.read_bank_1())
+
+        sample_ring.append(row[:ring_width])
+
+        output_file.append(row)
+        counter += 1
+
+    lick_recorder.cancel()
+    if output_file.file_location:
+        output_file.save_table(TPM_Hardware.lick_file_location(output_file.file_location),
+                               TPM_Records.LICK_FIELDNAMES, lick_recorder.take(), meta=lick_recorder.meta())
+    output_file.close()
+    print(counter)
+    print('RECORDER STOPPED.')
+
 
-            current_line[0:3] = [timestamp, new_position, mouse_lick]
+# paced by the ALERT/RDY pin of the ADS1115 in continuous mode, 860sps split over the channels (430sps for two)
+def continuous_recorder_func(instructions, go_event, sample_ring, instruction_pipe, channel_table, alert_pin,
+                             target_sps=430, backend='binary', fake_hardware=False):
+    # Initialization
+    output_file = TPM_Records.BackgroundRecordWriter(channel_table.fieldnames, backend=backend,
+                                                     field_types=channel_table.field_types)
+    ring_width = len(channel_table.ring_columns)
+    paused = True
+    counter = 0
+
+    # Prepare the pigpio connection, which is used for the i2c communication as well
+    pi = TPM_Hardware.connect_pi(fake_hardware, adc_alert_pin=alert_pin)
+    for pin in channel_table.gpio_pins:
+        pi.set_mode(pin, TPM_Hardware.INPUT)
+        pi.set_pull_up_down(pin, TPM_Hardware.PUD_DOWN)
+    print("PiGPIO input initialized.")
+
+    lick_recorder = TPM_Hardware.LickEventRecorder(pi, channel_table.gpio_pins)
+    if fake_hardware and channel_table.gpio_pins:
+        pi.simulate_licks(channel_table.gpio_pins)
 
-            row_dict = {
-                'Timestamp': timestamp,
-                'Position': new_position,
-                'Speed': new_speed,
-                'Mouse Lick': mouse_lick,
-                'Rat Lick': rat_lick
-            }
-            writer.writerow(row_dict)
-            counter += 1
+    # Prepare the ADC in continuous mode, the multiplexer cycles through the ADS channels of the table
+    ads = TPM_Hardware.ContinuousADS1115(pi, alert_pin, channels=channel_table.ads_inputs,
+                                         gain=channel_table.ads_gains)
+    target_sps = ads.set_data_rate(target_sps)
+    ads.start()
+    start_tick = pi.get_current_tick()
+    print(f"ADC initialized in continuous mode ({ads.data_rate}sps, {target_sps}sps per channel).")
 
-            end = time.perf_counter() + target
-            time.sleep(target * 0.8)
+    # The ADC sets the pace, the scheduler only keeps track of the intervals
+    scheduler = TPM_Timing.DeadlineScheduler(None)
+
+    while True:
+        # Check for new instructions
+        if instruction_pipe.poll():
+            command = instruction_pipe.recv()
+            if command is instructions.Pause:
+                paused = True
+            elif command is instructions.Ready:
+                paused = False
+                go_event.wait()
+                ads.clear()
+                start_tick = pi.get_current_tick()
+                sample_ring.set_epoch(time.perf_counter())
+                lick_recorder.start(start_tick)
+                scheduler.start()
+            elif command is instructions.Reset:
+                if output_file.file_location:
+                    lick_events = lick_recorder.take()
+                    output_file.save_table(TPM_Hardware.lick_file_location(output_file.file_location),
+                                           TPM_Records.LICK_FIELDNAMES, lick_events, meta=lick_recorder.meta())
+                    print('SAVED ' + str(len(lick_events)) + ' LICK EVENTS.')
+                print('DROPPED ' + str(counter) + ' LINES.')
+                print(scheduler.report())
+                print(output_file.report())
+                scheduler.reset()
+                file_location = instruction_pipe.recv()
+                output_file.rotate(file_location, meta={'target_sps': target_sps, 'data_rate': ads.data_rate,
+                                                        'sampling_mode': 'continuous',
+                                                        'channels': channel_table.meta()})
+                counter = 0
+                paused = True
+            elif command is instructions.Prepare:
+                output_file.prepare(instruction_pipe.recv(), meta={'target_sps': target_sps,
+                                                                   'data_rate': ads.data_rate,
+                                                                   'sampling_mode': 'continuous',
+                                                                   'channels': channel_table.meta()})
+            elif command is instructions.SamplingRate:
+                target_sps = ads.set_data_rate(instruction_pipe.recv())
+            elif command is instructions.Stop:
+                break
+            else:
+                raise ValueError(f'Unknown command received: {command}')
+
+        if paused:
+            time.sleep(0.05)
+            continue
+
+        scan = ads.read_scan(timeout=0.05)
+        if scan is None:
+            continue
 
+        scheduler.wait()
+        tick, voltages = scan
+        timestamp = TPM_Hardware.tick_difference(start_tick, tick)
+        row = channel_table.pack(timestamp, voltages, pi.read_bank_1())
+
+        sample_ring.append(row[:ring_width])
+
+        output_file.append(row)
+        counter += 1
+
+    ads.close()
+    lick_recorder.cancel()
+    pi.stop()
+    if output_file.file_location:
+        output_file.save_table(TPM_Hardware.lick_file_location(output_file.file_location),
+                               TPM_Records.LICK_FIELDNAMES, lick_recorder.take(), meta=lick_recorder.meta())
+    output_file.close()
     print(counter)
     print('RECORDER STOPPED.')
 
 
-# records as fast as possible, between 20-30ksps
-def unlimited_recorder_func(instructions, go_event, current_line, instruction_pipe):
+# records as fast as possible (between 20-30ksps) or at target_sps, with simulated signals, used by TPM_Benchmark
+def unlimited_recorder_func(instructions, go_event, sample_ring, instruction_pipe, backend='binary', target_sps=None,
+                            spin_tail=0.0005):
+    """
+    Without backend only the sample ring is written. On Stop the statistics of the last run are sent back through the
+    instruction pipe (samples, duration, cpu_time and the timing statistics of the scheduler).
+    """
     # Initialization
     start_time = time.perf_counter()
-    output_file = None
-    writer = None
+    start_cpu_time = time.process_time()
+    output_file = TPM_Records.BackgroundRecordWriter(TPM_Records.VIRTUAL_FIELDNAMES, backend=backend) \
+        if backend else None
     paused = True
     counter = 0
 
+    scheduler = TPM_Timing.DeadlineScheduler(target_sps, spin_tail=spin_tail)
+
     while True:
         # Check for new instructions
         if instruction_pipe.poll():
@@ -129,15 +252,17 @@ def unlimited_recorder_func(instructions, go_event, current_line, instruction_pi
                 paused = False
                 go_event.wait()
                 start_time = time.perf_counter()
+                start_cpu_time = time.process_time()
+                sample_ring.set_epoch(start_time)
+                scheduler.start(start_time)
             elif command is instructions.Reset:
-                if output_file:
-                    output_file.close()
                 print('DROPPED ' + str(counter) + ' LINES.')
+                print(scheduler.report())
+                scheduler.reset()
                 file_location = instruction_pipe.recv()
-                output_file = open(file_location, 'w')
-                writer = csv.DictWriter(output_file, fieldnames=['Timestamp', 'Position', 'Speed', 'whatever'],
-                                        lineterminator='\n')
-                writer.writeheader()
+                if output_file:
+                    print(output_file.report())
+                    output_file.rotate(file_location)
                 counter = 0
                 paused = True
             elif command is instructions.Stop:
@@ -148,36 +273,42 @@ def unlimited_recorder_func(instructions, go_event, current_line, instruction_pi
         if paused:
             continue
 
+        scheduler.wait()
         timestamp = time.perf_counter() - start_time
-        new_position = rdm.random()
-        new_speed = rdm.random()
-
-        current_line[0:3] = [timestamp, new_position, new_speed]
-
-        row_dict = {
-            'Timestamp': timestamp,
-            'Position': new_position,
-            'Speed': new_speed,
-            'whatever': counter
-        }
-        writer.writerow(row_dict)
+        new_position = TPM_Hardware.fake_position(timestamp)
+        new_speed = TPM_Hardware.fake_speed(timestamp)
+
+        sample_ring.append((timestamp, new_position, new_speed))
+
+        if output_file:
+            output_file.append((timestamp, new_position, new_speed, counter))
         counter += 1
 
+    duration = time.perf_counter() - start_time
+    if output_file:
+        output_file.close()
+    # The file output is closed first, its cpu time belongs to the run
+    instruction_pipe.send({
+        'samples': counter,
+        'duration': duration,
+        'cpu_time': time.process_time() - start_cpu_time,
+        'timing': scheduler.statistics(),
+        'storage': output_file.report() if output_file else None
+    })
     print(counter)
     print('RECORDER STOPPED.')
 
 
 # virtual recorder, reads from pygame inputs
-def virtual_recorder_func(instructions, go_event, current_line, instruction_pipe, mouse_input_queue, target_sps=200):
+def virtual_recorder_func(instructions, go_event, sample_ring, instruction_pipe, mouse_input_queue, target_sps=200,
+                          backend='binary'):
     # Initialization
     start_time = time.perf_counter()
-    output_file = None
-    writer = None
+    output_file = TPM_Records.BackgroundRecordWriter(TPM_Records.VIRTUAL_FIELDNAMES, backend=backend)
     paused = True
     counter = 0
 
-    target = 1. / target_sps
-    end = time.perf_counter() + target
+    scheduler = TPM_Timing.DeadlineScheduler(target_sps)
 
     virtual_position = 0  # in cm
     virtual_speed = 0  # in cm/s
@@ -192,19 +323,20 @@ def virtual_recorder_func(instructions, go_event, current_line, instruction_pipe
                 paused = False
                 go_event.wait()
                 start_time = time.perf_counter()
+                sample_ring.set_epoch(start_time)
+                scheduler.start(start_time)
             elif command is instructions.Reset:
-                if output_file:
-                    output_file.close()
                 print('DROPPED ' + str(counter) + ' LINES.')
-                output_file = open('virtual_records.csv', 'w')
-                writer = csv.DictWriter(output_file, fieldnames=['Timestamp', 'Position', 'Speed', 'whatever'],
-                                        lineterminator='\n')
-                writer.writeheader()
+                print(scheduler.report())
+                print(output_file.report())
+                scheduler.reset()
+                file_location = 'virtual_records' + TPM_Records.RECORD_EXTENSIONS[backend]
+                output_file.rotate(file_location, meta={'target_sps': target_sps})
                 counter = 0
                 paused = True
             elif command is instructions.SamplingRate:
                 target_sps = instruction_pipe.recv()
-                target = 1. / target_sps
+                scheduler.set_rate(target_sps)
             elif command is instructions.Stop:
                 break
             else:
@@ -214,43 +346,139 @@ def virtual_recorder_func(instructions, go_event, current_line, instruction_pipe
         if paused:
             continue
 
-        if time.perf_counter() > end:
+        scheduler.wait()
 
-            while not mouse_input_queue.empty():
-                # virtual input
-                event_button = mouse_input_queue.get()
-                if event_button == 4:
-                    virtual_speed += 0.1
-                elif event_button == 5:
-                    virtual_speed -= 0.1
+        while not mouse_input_queue.empty():
+            # virtual input
+            event_button = mouse_input_queue.get()
+            if event_button == 4:
+                virtual_speed += 0.1
+            elif event_button == 5:
+                virtual_speed -= 0.1
 
-            timestamp = time.perf_counter() - start_time
+        timestamp = time.perf_counter() - start_time
 
-            if virtual_speed < -2.5:
-                virtual_speed = -2.5
-            elif virtual_speed > 2.5:
-                virtual_speed = 2.5
+        if virtual_speed < -2.5:
+            virtual_speed = -2.5
+        elif virtual_speed > 2.5:
+            virtual_speed = 2.5
 
-            virtual_position += virtual_speed * target
+        virtual_position += virtual_speed * scheduler.period
 
-            if virtual_position < 0:
-                virtual_position = 5
-            if virtual_position > 5:
-                virtual_position = 0
+        if virtual_position < 0:
+            virtual_position = 5
+        if virtual_position > 5:
+            virtual_position = 0
+
+        sample_ring.append((timestamp, virtual_position, virtual_speed + 2.5))
+
+        output_file.append((timestamp, virtual_position, virtual_speed, counter))
+        counter += 1
+
+    output_file.close()
+    print(counter)
+    print('RECORDER STOPPED.')
+
+
+def replay_file_list(replay_location):
+    """
+    :param replay_location: a single record file or a session folder with one record file per trial
+    :return: list of the record files in trial order (lick files are left out)
+    """
+    if not os.path.isdir(replay_location):
+        return [replay_location]
+
+    def trial_index(file_name):
+        numbers = re.findall(r'\d+', file_name)
+        return (int(numbers[-1]) if numbers else 0, file_name)
+
+    file_names = [file_name for file_name in os.listdir(replay_location)
+                  if file_name.endswith(TPM_Records.RECORD_EXTENSIONS['binary']) and
+                  not file_name.endswith('_licks' + TPM_Records.RECORD_EXTENSIONS['binary'])]
+    return [os.path.join(replay_location, file_name) for file_name in sorted(file_names, key=trial_index)]
+
+
+# replay recorder, streams recorded trials back into the sample ring
+def replay_recorder_func(instructions, go_event, sample_ring, instruction_pipe, replay_location, speed=1.,
+                         batch_size=256):
+    """
+    Stands in for the hardware recorders on machines without the setup. Every Reset continues with the next
+    recorded trial of replay_location (the file location sent by the experiment loop is not written). The rows are
+    published when they are due at the given speed (1 = real time, 10 = ten times faster), with speed None or 0 as
+    fast as possible in batches of batch_size rows. The timestamps are scaled to the replay clock, so the consumers
+    see a stream like from a live recorder.
+    """
+    # Initialization
+    start_time = time.perf_counter()
+    replay_files = replay_file_list(replay_location)
+    assert replay_files, f'No record files found in {replay_location}.'
+    file_index = -1
+    records = None
+    timestamp_column = sample_ring.column('Timestamp')
+    row_index = 0
+    replay_end = None
+    paused = True
+    counter = 0
 
-            current_line[0:3] = [timestamp, virtual_position, virtual_speed + 2.5]
+    while True:
+        # Check for new instructions
+        if instruction_pipe.poll():
+            command = instruction_pipe.recv()
+            if command is instructions.Pause:
+                paused = True
+            elif command is instructions.Ready:
+                paused = False
+                go_event.wait()
+                start_time = time.perf_counter()
+                sample_ring.set_epoch(start_time)
+            elif command is instructions.Reset:
+                if records is not None:
+                    duration = (replay_end or time.perf_counter()) - start_time
+                    print(f'REPLAYED {row_index}/{len(records)} LINES IN {duration:.2f}s '
+                          f'({row_index / duration if duration > 0 else 0.:.0f} sps).')
+                instruction_pipe.recv()
+                file_index = (file_index + 1) % len(replay_files)
+                _, file_records = TPM_Records.read_records(replay_files[file_index])
+                records = np.zeros((len(file_records), len(sample_ring.columns)))
+                for column, name in enumerate(sample_ring.columns):
+                    if name in file_records.dtype.names:
+                        records[:, column] = file_records[name]
+                if speed:
+                    records[:, timestamp_column] /= speed
+                print(f'REPLAYING {replay_files[file_index]} ({len(records)} LINES).')
+                row_index = 0
+                replay_end = None
+                paused = True
+            elif command is instructions.Prepare:
+                instruction_pipe.recv()
+            elif command is instructions.SamplingRate:
+                instruction_pipe.recv()
+            elif command is instructions.Stop:
+                break
+            else:
+                raise ValueError(f'Unknown command received: {command}')
 
-            row_dict = {
-                'Timestamp': timestamp,
-                'Position': virtual_position,
-                'Speed': virtual_speed,
-                'whatever': counter
-            }
-            writer.writerow(row_dict)
-            counter += 1
+        # Skip the rest of the process if paused or the trial is replayed completely
+        if paused or records is None or row_index == len(records):
+            time.sleep(0.001)
+            continue
 
-            end = time.perf_counter() + target
-            time.sleep(target * 0.8)
+        elapsed = time.perf_counter() - start_time
+        if speed:
+            due_index = np.searchsorted(records[:, timestamp_column], elapsed, side='right')
+            if due_index == row_index:
+                time.sleep(min(records[row_index, timestamp_column] - elapsed, 0.001))
+                continue
+            batch = records[row_index:due_index]
+        else:
+            batch = records[row_index:row_index + batch_size].copy()
+            batch[:, timestamp_column] = elapsed
+
+        sample_ring.extend(batch)
+        row_index += len(batch)
+        counter += len(batch)
+        if row_index == len(records):
+            replay_end = time.perf_counter()
 
     print(counter)
     print('RECORDER STOPPED.')
@@ -0,0 +1,335 @@
+import csv
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+import datetime
+import numpy as np
+
+# -----------------------------------------------------------------------------
+# File layout
+# -----------------------------------------------------------------------------
+# A record file starts with the magic bytes, followed by the length of the json-header (uint32, little endian),
+# the json-header itself and then the raw rows of the structured array. The number of rows is not stored in the
+# header, it follows from the file size. A file that was cut short (e.g. power loss) can therefore still be read
+# up to the last complete chunk.
+RECORD_MAGIC = b'TPMREC01'
+RECORD_EXTENSIONS = {
+    'binary': '.rec',
+    'csv': '.csv'
+}
+
+# Columns that are not stored as 64-bit floats
+FIELD_TYPES = {
+    'Mouse Lick': 'u1',
+    'Rat Lick': 'u1',
+    'Tick': '<u4',
+    'GPIO': 'u1',
+    'Level': 'u1'
+}
+
+ANALOG_FIELDNAMES = ('Timestamp', 'Position', 'Speed', 'Mouse Lick', 'Rat Lick')
+VIRTUAL_FIELDNAMES = ('Timestamp', 'Position', 'Speed', 'whatever')
+LICK_FIELDNAMES = ('Timestamp', 'Tick', 'GPIO', 'Level')
+
+
+def record_dtype(fieldnames, field_types=None):
+    """
+    Builds the structured numpy dtype for a list of column names.
+    :param fieldnames: names of the columns in the order they are written
+    :param field_types: optional dict overriding the dtype of single columns, defaults to FIELD_TYPES
+    :return: numpy.dtype
+    """
+    if field_types is None:
+        field_types = FIELD_TYPES
+    return np.dtype([(name, field_types.get(name, '<f8')) for name in fieldnames])
+
+
+class RecordWriter:
+    """
+    Binary output backend of the recorders. Rows are collected in a preallocated structured array and written to the
+    file as whole chunks, which keeps the per-sample cost in the sampling loop to a single array assignment.
+    """
+    def __init__(self, file_location, fieldnames, chunk_size=4096, meta=None, field_types=None):
+        assert isinstance(chunk_size, int) and chunk_size > 0, \
+            'The chunk size must be an integer above 0.'
+
+        self.file_location = file_location
+        self.fieldnames = tuple(fieldnames)
+        self.dtype = record_dtype(self.fieldnames, field_types)
+        self.chunk = np.zeros(chunk_size, dtype=self.dtype)
+        self.chunk_size = chunk_size
+        self.index = 0
+        self.counter = 0
+
+        header = {
+            'fields': [[name, self.dtype[name].str] for name in self.fieldnames],
+            'chunk_size': chunk_size,
+            'created': datetime.datetime.now().isoformat(),
+            'meta': meta if meta else {}
+        }
+        header_bytes = json.dumps(header).encode('utf-8')
+
+        self.output_file = open(file_location, 'wb')
+        self.output_file.write(RECORD_MAGIC)
+        self.output_file.write(struct.pack('<I', len(header_bytes)))
+        self.output_file.write(header_bytes)
+
+    def append(self, row):
+        self.chunk[self.index] = row
+        self.index += 1
+        self.counter += 1
+        if self.index == self.chunk_size:
+            self.flush()
+
+    def extend(self, rows):
+        """writes a whole structured array at once, the pending chunk is written first to keep the order
+        """
+        self.flush()
+        self.output_file.write(np.asarray(rows, dtype=self.dtype).tobytes())
+        self.counter += len(rows)
+
+    def flush(self):
+        if self.index:
+            self.output_file.write(self.chunk[:self.index].tobytes())
+            self.index = 0
+        self.output_file.flush()
+
+    def close(self):
+        if self.output_file:
+            self.flush()
+            self.output_file.close()
+            self.output_file = None
+
+
+class CsvRecordWriter:
+    """
+    Text output backend with the same interface as the RecordWriter, one csv-line per sample.
+    """
+    def __init__(self, file_location, fieldnames, **kwargs):
+        self.file_location = file_location
+        self.fieldnames = tuple(fieldnames)
+        self.counter = 0
+
+        self.output_file = open(file_location, 'w')
+        self.writer = csv.writer(self.output_file, lineterminator='\n')
+        self.writer.writerow(self.fieldnames)
+
+    def append(self, row):
+        self.writer.writerow(row)
+        self.counter += 1
+
+    def extend(self, rows):
+        self.writer.writerows(rows.tolist())
+        self.counter += len(rows)
+
+    def flush(self):
+        self.output_file.flush()
+
+    def close(self):
+        if self.output_file:
+            self.output_file.close()
+            self.output_file = None
+
+
+RECORD_BACKENDS = {
+    'binary': RecordWriter,
+    'csv': CsvRecordWriter
+}
+
+
+def open_record_writer(file_location, fieldnames, backend='binary', **kwargs):
+    if backend not in RECORD_BACKENDS:
+        raise ValueError(f'Unknown record backend: {backend}')
+    return RECORD_BACKENDS[backend](file_location, fieldnames, **kwargs)
+
+
+class BackgroundRecordWriter:
+    """
+    Moves the file output of a recorder into a writer thread. The sampling loop fills one of buffer_number
+    preallocated chunks and hands it over once it is full, the thread writes it and returns it to the pool. Opening,
+    closing and pre-opening (prepare) of trial files happen in the thread as well, so the sampling loop never waits
+    for the storage. If the storage falls behind and no free chunk is left, backpressure is counted and the rows are
+    dropped (counted in dropped) until a chunk is free again.
+    """
+    def __init__(self, fieldnames, backend='binary', chunk_size=4096, buffer_number=2, field_types=None):
+        assert backend in RECORD_BACKENDS, \
+            f'Backend must be one of {tuple(RECORD_BACKENDS.keys())}.'
+        assert isinstance(buffer_number, int) and buffer_number > 1, \
+            'At least two buffers are needed, one to fill and one to write.'
+
+        self.fieldnames = tuple(fieldnames)
+        self.backend = backend
+        self.field_types = field_types
+        self.dtype = record_dtype(self.fieldnames, field_types)
+        self.chunk_size = chunk_size
+
+        self.free_buffers = queue.Queue()
+        for _ in range(buffer_number):
+            self.free_buffers.put(np.zeros(chunk_size, dtype=self.dtype))
+        self.buffer = self.free_buffers.get()
+        self.index = 0
+
+        self.file_location = None
+        self.counter = 0
+        self.backpressure = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _open(self, file_location, meta):
+        return open_record_writer(file_location, self.fieldnames, backend=self.backend, chunk_size=1, meta=meta,
+                                  field_types=self.field_types)
+
+    def _write_loop(self):
+        file_writer = None
+        prepared = {}
+        while True:
+            job = self.jobs.get()
+            command = job[0]
+            try:
+                if command == 'write':
+                    if file_writer:
+                        file_writer.extend(job[1][:job[2]])
+                elif command == 'open':
+                    if file_writer:
+                        file_writer.close()
+                    file_writer = prepared.pop(job[1], None) or self._open(job[1], job[2])
+                elif command == 'prepare':
+                    if job[1] not in prepared:
+                        prepared[job[1]] = self._open(job[1], job[2])
+                elif command == 'table':
+                    table_writer = RecordWriter(job[1], job[2], chunk_size=1, meta=job[4])
+                    table_writer.extend(job[3])
+                    table_writer.close()
+                elif command == 'stop':
+                    if file_writer:
+                        file_writer.close()
+                    # Files that were prepared for trials which never started are removed again
+                    for location, unused_writer in prepared.items():
+                        unused_writer.close()
+                        os.remove(location)
+                    return
+            except OSError as error:
+                self.errors += 1
+                print(f'RECORD WRITER ERROR: {error}')
+            finally:
+                if command == 'write':
+                    self.free_buffers.put(job[1])
+
+    def _next_buffer(self):
+        try:
+            return self.free_buffers.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _hand_over(self):
+        if self.buffer is not None and self.index:
+            self.jobs.put(('write', self.buffer, self.index))
+            self.buffer = None
+        self.index = 0
+        if self.buffer is None:
+            self.buffer = self._next_buffer()
+            if self.buffer is None:
+                self.backpressure += 1
+
+    def append(self, row):
+        if self.buffer is None:
+            self.buffer = self._next_buffer()
+            if self.buffer is None:
+                self.dropped += 1
+                return
+        self.buffer[self.index] = row
+        self.index += 1
+        self.counter += 1
+        if self.index == self.chunk_size:
+            self._hand_over()
+
+    def prepare(self, file_location, meta=None):
+        """opens the file of an upcoming trial in the background
+        """
+        self.jobs.put(('prepare', file_location, meta))
+
+    def rotate(self, file_location, meta=None):
+        """writes the pending rows to the current file and continues with the next one
+        """
+        self._hand_over()
+        self.jobs.put(('open', file_location, meta))
+        self.file_location = file_location
+        self.counter = 0
+
+    def save_table(self, file_location, fieldnames, rows, meta=None):
+        """writes a complete structured array (e.g. lick events) to its own binary file in the background
+        """
+        self.jobs.put(('table', file_location, fieldnames, rows, meta))
+
+    def flush(self):
+        self._hand_over()
+
+    def report(self):
+        return (f'STORAGE: {self.backpressure} times no free buffer, {self.dropped} rows dropped, '
+                f'{self.jobs.qsize()} jobs pending, {self.errors} errors')
+
+    def close(self):
+        self._hand_over()
+        self.jobs.put(('stop',))
+        self.thread.join()
+
+
+def read_header(input_file):
+    if input_file.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+        raise ValueError(f'{input_file.name} is not a record file.')
+    header_length, = struct.unpack('<I', input_file.read(4))
+    return json.loads(input_file.read(header_length).decode('utf-8'))
+
+
+def read_records(file_location):
+    """
+    Reads a binary record file.
+    :param file_location: location of the record file
+    :return: tuple of the header (dict) and the records (structured numpy array)
+    """
+    with open(file_location, 'rb') as input_file:
+        header = read_header(input_file)
+        dtype = np.dtype([tuple(field) for field in header['fields']])
+        data = input_file.read()
+    row_number = len(data) // dtype.itemsize
+    records = np.frombuffer(data, dtype=dtype, count=row_number)
+    return header, records
+
+
+def export_csv(file_location, csv_location=None):
+    """
+    Converts a binary record file into a csv-file with the same columns.
+    :param file_location: location of the record file
+    :param csv_location: location of the csv-file, defaults to the record file with a .csv extension
+    :return: location of the csv-file
+    """
+    if csv_location is None:
+        csv_location = os.path.splitext(file_location)[0] + RECORD_EXTENSIONS['csv']
+
+    header, records = read_records(file_location)
+    with open(csv_location, 'w') as output_file:
+        writer = csv.writer(output_file, lineterminator='\n')
+        writer.writerow(records.dtype.names)
+        writer.writerows(records.tolist())
+    return csv_location
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python TPM_Records.py <record file> [<record file> ...]')
+        return
+
+    for file_location in sys.argv[1:]:
+        csv_location = export_csv(file_location)
+        print(f'{file_location} -> {csv_location}')
+
+
+if __name__ == '__main__':
+    main()
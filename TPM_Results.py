@@ -0,0 +1,154 @@
+import datetime
+import json
+import os
+import sys
+
+# -----------------------------------------------------------------------------
+# Layout
+# -----------------------------------------------------------------------------
+# Every session is one json-lines file in the results directory. The first line is the session header (animals,
+# settings, start), every finished trial appends one line and the last line marks the end of the session. Next to the
+# sessions the index holds one line per session with the animals and the date, so the history of an animal can be
+# found without opening every session. Nothing is ever rewritten, a session that was cut short (e.g. power loss)
+# keeps all trials up to the last one.
+RESULTS_DIRECTORY = 'results'
+INDEX_FILE = 'index.jsonl'
+SESSION_EXTENSION = '.jsonl'
+
+
+def _json_line(record):
+    return json.dumps(record, default=str) + '\n'
+
+
+class SessionStore:
+    """
+    Append-only result file of one experiment session. The header and the index entry are written when the session
+    starts, every trial is written (and flushed) as soon as it is added.
+    """
+    def __init__(self, session_start, mouse, rat=None, settings=None, directory=RESULTS_DIRECTORY, **header):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.session_start = session_start
+        self.file_name = f'{session_start.strftime("%Y-%m-%d_%H-%M-%S_%f")}_{mouse}{SESSION_EXTENSION}'
+        self.file_location = os.path.join(directory, self.file_name)
+        self.trials = 0
+        self.closed = False
+
+        self.output_file = open(self.file_location, 'a')
+        self._write({'type': 'session', 'start': session_start.isoformat(), 'mouse': mouse, 'rat': rat,
+                     'settings': settings if settings else {}, **header})
+
+        with open(os.path.join(directory, INDEX_FILE), 'a') as index_file:
+            index_file.write(_json_line({'file': self.file_name, 'start': session_start.isoformat(),
+                                         'date': session_start.date().isoformat(), 'mouse': mouse, 'rat': rat}))
+
+    def _write(self, record):
+        self.output_file.write(_json_line(record))
+        self.output_file.flush()
+
+    def add_trial(self, trial, result):
+        """
+        :param trial: number of the trial
+        :param result: dict with the measurements of the trial
+        """
+        self._write({'type': 'trial', 'trial': trial, **result})
+        self.trials += 1
+
+    def close(self, status='finished', **summary):
+        if self.closed:
+            return
+        self._write({'type': 'end', 'end': datetime.datetime.now().isoformat(), 'status': status,
+                     'trials': self.trials, **summary})
+        self.output_file.close()
+        self.closed = True
+
+
+def read_index(directory=RESULTS_DIRECTORY, mouse=None, rat=None, since=None):
+    """
+    Lists the sessions of the results directory.
+    :param mouse: only sessions of this mouse
+    :param rat: only sessions of this rat
+    :param since: only sessions on or after this date (datetime.date)
+    :return: list of the index entries (dicts with file, start, date, mouse and rat), oldest first
+    """
+    index_location = os.path.join(directory, INDEX_FILE)
+    if not os.path.isfile(index_location):
+        return []
+
+    entries = []
+    with open(index_location) as index_file:
+        for line in index_file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if mouse is not None and entry['mouse'] != mouse:
+                continue
+            if rat is not None and entry['rat'] != rat:
+                continue
+            if since is not None and datetime.date.fromisoformat(entry['date']) < since:
+                continue
+            entries.append(entry)
+    return entries
+
+
+def read_session(file_location):
+    """
+    Reads one session file. A last line that was cut short is ignored.
+    :return: tuple of the header (dict), the trials (list of dicts) and the end record (dict, None if the session
+    did not end properly)
+    """
+    header, trials, end = None, [], None
+    with open(file_location) as input_file:
+        for line in input_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if record['type'] == 'session':
+                header = record
+            elif record['type'] == 'trial':
+                trials.append(record)
+            elif record['type'] == 'end':
+                end = record
+    return header, trials, end
+
+
+def load_history(directory=RESULTS_DIRECTORY, mouse=None, rat=None, since=None):
+    """
+    Reads the sessions of one animal (or all sessions), only the files listed for it in the index are opened.
+    :return: list of (header, trials, end) tuples as returned by read_session, oldest first
+    """
+    return [read_session(os.path.join(directory, entry['file']))
+            for entry in read_index(directory, mouse, rat, since)]
+
+
+def convert_results_file(results_location='results.json', directory=RESULTS_DIRECTORY):
+    """
+    Moves the sessions of a results.json of earlier versions into the results directory.
+    :return: number of converted sessions
+    """
+    with open(results_location) as input_file:
+        results = json.load(input_file)
+
+    for experiment_start, session in results.items():
+        session_start = datetime.datetime.strptime(experiment_start, '%d-%m-%Y (%H:%M:%S.%f)')
+        config = session.get('config', {})
+        session_store = SessionStore(session_start, session.get('mouse'), settings=config.get('settings'),
+                                     directory=directory, converted_from=results_location)
+        for trial_name, result in session.get('measurements', {}).items():
+            session_store.add_trial(int(trial_name.split('_')[-1]), result)
+        session_store.close('converted')
+    return len(results)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python TPM_Results.py <results.json> [<results directory>]')
+        return
+
+    session_number = convert_results_file(*sys.argv[1:3])
+    print(f'{session_number} sessions converted.')
+
+
+if __name__ == '__main__':
+    main()
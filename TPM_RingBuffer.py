@@ -0,0 +1,410 @@
+import math
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+SAMPLE_COLUMNS = ('Timestamp', 'Position', 'Speed')
+
+# Slots of the int64 header in front of the sample data
+_HEADER_SLOTS = 8
+_SEQUENCE = 0
+_EPOCH = 1
+
+
+class SampleRing:
+    """
+    Single-producer/multi-consumer ring buffer in shared memory. The recorder appends rows of float64 values, every
+    appended row increases the sequence number by one. Consumers keep their own cursor (see RingReader) and read all
+    rows since their last read, so no sample is lost or repeated as long as a consumer is not more than capacity rows
+    behind. The row is written before the sequence number is published, readers never see half-written rows.
+    """
+    def __init__(self, columns=SAMPLE_COLUMNS, capacity=65536, name=None):
+        assert isinstance(capacity, int) and capacity > 0, \
+            'The capacity must be an integer above 0.'
+
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.owner = name is None
+
+        size = 8 * _HEADER_SLOTS + 8 * capacity * len(self.columns)
+        if self.owner:
+            self.shared_memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shared_memory = shared_memory.SharedMemory(name=name)
+        self.name = self.shared_memory.name
+
+        self.header = np.ndarray((_HEADER_SLOTS,), dtype=np.int64, buffer=self.shared_memory.buf)
+        self.data = np.ndarray((capacity, len(self.columns)), dtype=np.float64, buffer=self.shared_memory.buf,
+                               offset=8 * _HEADER_SLOTS)
+        if self.owner:
+            self.header[:] = 0
+
+    # Only the name is sent to other processes, they attach to the same block
+    def __getstate__(self):
+        return {'columns': self.columns, 'capacity': self.capacity, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def sequence(self):
+        return int(self.header[_SEQUENCE])
+
+    @property
+    def epoch(self):
+        """time.perf_counter() value the timestamps of the recorder are relative to, None before the first start
+        """
+        epoch = int(self.header[_EPOCH])
+        return epoch / 1e9 if epoch else None
+
+    def set_epoch(self, start_time):
+        self.header[_EPOCH] = int(start_time * 1e9)
+
+    def append(self, row):
+        sequence = self.header[_SEQUENCE]
+        self.data[sequence % self.capacity] = row
+        self.header[_SEQUENCE] = sequence + 1
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=np.float64)
+        sequence = int(self.header[_SEQUENCE])
+        if len(rows) > self.capacity:
+            sequence += len(rows) - self.capacity
+            rows = rows[-self.capacity:]
+        indices = np.arange(sequence, sequence + len(rows)) % self.capacity
+        self.data[indices] = rows
+        self.header[_SEQUENCE] = sequence + len(rows)
+
+    def latest(self):
+        """returns a copy of the newest row (zeros before the first append)
+        """
+        sequence = self.sequence
+        if sequence == 0:
+            return np.zeros(len(self.columns))
+        return self.data[(sequence - 1) % self.capacity].copy()
+
+    def column(self, name):
+        return self.columns.index(name)
+
+    def reader(self, from_start=False):
+        return RingReader(self, from_start)
+
+    def close(self):
+        self.header = None
+        self.data = None
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
+
+
+class RingReader:
+    """
+    Cursor of a single consumer on a SampleRing. Rows that were overwritten before they could be read are counted
+    in lost.
+    """
+    def __init__(self, ring, from_start=False):
+        self.ring = ring
+        self.cursor = max(0, ring.sequence - ring.capacity) if from_start else ring.sequence
+        self.lost = 0
+
+    def backlog(self):
+        return self.ring.sequence - self.cursor
+
+    def skip(self):
+        """moves the cursor to the newest row, without reading anything
+        """
+        self.cursor = self.ring.sequence
+
+    def read(self, max_rows=None):
+        """
+        Reads all rows since the last read.
+        :param max_rows: optional upper limit of rows for one batch
+        :return: float64 array of shape (rows, columns)
+        """
+        ring = self.ring
+        sequence = ring.sequence
+        if sequence - self.cursor > ring.capacity:
+            self.lost += sequence - ring.capacity - self.cursor
+            self.cursor = sequence - ring.capacity
+        if max_rows is not None:
+            sequence = min(sequence, self.cursor + max_rows)
+        if sequence == self.cursor:
+            return ring.data[:0].copy()
+
+        start = self.cursor % ring.capacity
+        end = start + sequence - self.cursor
+        if end <= ring.capacity:
+            rows = ring.data[start:end].copy()
+        else:
+            rows = np.concatenate((ring.data[start:], ring.data[:end - ring.capacity]))
+
+        # The producer may have lapped the cursor while copying, those rows are not valid anymore. The row at the
+        # current sequence number might be in the middle of being written.
+        overwritten = min(ring.sequence + 1 - ring.capacity - self.cursor, len(rows))
+        if overwritten > 0:
+            self.lost += overwritten
+            rows = rows[overwritten:]
+
+        self.cursor = sequence
+        return rows
+
+
+
+def summary_columns(columns):
+    """columns of a decimated stream: the mean keeps the name of the raw column, min and max get a suffix
+    """
+    values = tuple(column for column in columns if column != 'Timestamp')
+    return (('Timestamp',) + values + tuple(column + ' Min' for column in values) +
+            tuple(column + ' Max' for column in values))
+
+
+class Decimator:
+    """
+    Summarizes a stream into buckets of 1/rate seconds (by timestamp) and publishes min, mean and max of every
+    finished bucket into its own SampleRing. The timestamp of a summary is the one of the newest sample in the bucket.
+    The input is either raw samples or the summaries of a faster Decimator, which is why it works on min, max, sum and
+    count instead of single values. add() takes a single sample with plain floats (cheap in the sampling loop),
+    extend() whole batches with numpy.
+    """
+    def __init__(self, ring, rate):
+        assert rate > 0, \
+            'The rate of a decimated stream must be above 0.'
+
+        self.ring = ring
+        self.rate = rate
+        self.reset()
+
+    def reset(self):
+        """drops the unfinished bucket, e.g. when the recorder clock restarts
+        """
+        self.bucket = None
+        self.timestamp = 0.
+        self.minimum = []
+        self.maximum = []
+        self.total = []
+        self.count = 0
+
+    def _publish(self):
+        self.ring.append((self.timestamp, *[total / self.count for total in self.total], *self.minimum,
+                          *self.maximum))
+
+    def add(self, timestamp, minimum, maximum, total, count):
+        """
+        Adds a single sample (minimum, maximum and total are the same list of values, count is 1) or summary.
+        :return: the finished bucket as tuple (timestamp, minimum, maximum, total, count) or None
+        """
+        bucket = math.floor(timestamp * self.rate)
+        if bucket == self.bucket:
+            self.timestamp = timestamp
+            self.minimum = [min(old, new) for old, new in zip(self.minimum, minimum)]
+            self.maximum = [max(old, new) for old, new in zip(self.maximum, maximum)]
+            self.total = [old + new for old, new in zip(self.total, total)]
+            self.count += count
+            return None
+
+        finished = None
+        if self.bucket is not None:
+            self._publish()
+            finished = (self.timestamp, self.minimum, self.maximum, self.total, self.count)
+        self.bucket = bucket
+        self.timestamp = timestamp
+        self.minimum = list(minimum)
+        self.maximum = list(maximum)
+        self.total = list(total)
+        self.count = count
+        return finished
+
+    def extend(self, timestamps, minimum, maximum, total, count):
+        """
+        Adds a batch of samples or summaries as arrays (timestamps and count 1d, the others rows x values).
+        :return: tuple of arrays (timestamps, minimum, maximum, total, count) of the finished buckets or None
+        """
+        buckets = np.floor(timestamps * self.rate).astype(np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        ends = np.append(starts[1:], len(buckets))
+
+        segment_timestamps = timestamps[ends - 1]
+        segment_minimum = np.minimum.reduceat(minimum, starts)
+        segment_maximum = np.maximum.reduceat(maximum, starts)
+        segment_total = np.add.reduceat(total, starts)
+        segment_count = np.add.reduceat(count, starts)
+
+        # The first segment continues the unfinished bucket or the unfinished bucket is finished before it
+        if self.bucket is not None:
+            if buckets[0] == self.bucket:
+                segment_minimum[0] = np.minimum(segment_minimum[0], self.minimum)
+                segment_maximum[0] = np.maximum(segment_maximum[0], self.maximum)
+                segment_total[0] += self.total
+                segment_count[0] += self.count
+            else:
+                segment_timestamps = np.concatenate(([self.timestamp], segment_timestamps))
+                segment_minimum = np.concatenate(([self.minimum], segment_minimum))
+                segment_maximum = np.concatenate(([self.maximum], segment_maximum))
+                segment_total = np.concatenate(([self.total], segment_total))
+                segment_count = np.concatenate(([self.count], segment_count))
+
+        # The last segment stays open until a sample of a later bucket arrives
+        self.bucket = int(buckets[-1])
+        self.timestamp = float(segment_timestamps[-1])
+        self.minimum = segment_minimum[-1].tolist()
+        self.maximum = segment_maximum[-1].tolist()
+        self.total = segment_total[-1].tolist()
+        self.count = int(segment_count[-1])
+        if len(segment_timestamps) == 1:
+            return None
+
+        finished = (segment_timestamps[:-1], segment_minimum[:-1], segment_maximum[:-1], segment_total[:-1],
+                    segment_count[:-1])
+        self.ring.extend(np.column_stack((finished[0], finished[3] / finished[4][:, None], finished[1],
+                                          finished[2])))
+        return finished
+
+
+class SampleStreams:
+    """
+    Raw sample ring plus decimated summary streams at the given rates (samples per second), with the interface of a
+    SampleRing. The producer appends raw rows once, the fastest Decimator summarizes them and every slower one the
+    output of the next faster one, so the cost for the producer hardly grows with the number of streams.
+    Consumers subscribe to the resolution they need with reader(rate), rate None is the raw stream.
+    """
+    def __init__(self, columns=SAMPLE_COLUMNS, rates=(1000, 100, 10), capacity=65536, summary_capacity=8192):
+        assert columns[0] == 'Timestamp', \
+            'The first column must be the timestamp.'
+
+        self.raw = SampleRing(columns, capacity)
+        self.rates = tuple(sorted(rates, reverse=True))
+        self.streams = {rate: SampleRing(summary_columns(columns), summary_capacity) for rate in self.rates}
+        self.decimators = [Decimator(self.streams[rate], rate) for rate in self.rates]
+
+    @property
+    def columns(self):
+        return self.raw.columns
+
+    @property
+    def capacity(self):
+        return self.raw.capacity
+
+    @property
+    def sequence(self):
+        return self.raw.sequence
+
+    @property
+    def epoch(self):
+        return self.raw.epoch
+
+    def set_epoch(self, start_time):
+        for ring in (self.raw,) + tuple(self.streams.values()):
+            ring.set_epoch(start_time)
+        for decimator in self.decimators:
+            decimator.reset()
+
+    def ring(self, rate=None):
+        return self.raw if rate is None else self.streams[rate]
+
+    def append(self, row):
+        self.raw.append(row)
+        values = row[1:]
+        summary = (row[0], values, values, values, 1)
+        for decimator in self.decimators:
+            summary = decimator.add(*summary)
+            if summary is None:
+                break
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=np.float64)
+        self.raw.extend(rows)
+        if self.decimators and len(rows):
+            self._decimate(rows)
+
+    def _decimate(self, rows):
+        values = rows[:, 1:]
+        summaries = (rows[:, 0], values, values, values, np.ones(len(rows), dtype=np.int64))
+        for decimator in self.decimators:
+            summaries = decimator.extend(*summaries)
+            if summaries is None:
+                break
+
+    def latest(self):
+        return self.raw.latest()
+
+    def column(self, name):
+        return self.raw.column(name)
+
+    def reader(self, from_start=False, rate=None):
+        return self.ring(rate).reader(from_start)
+
+    def close(self):
+        for ring in (self.raw,) + tuple(self.streams.values()):
+            ring.close()
+
+
+class SampleIntake:
+    """
+    Long-lived consumer thread that drains a RingReader in batches and hands every batch to sink. Replaces polling
+    with a new timer thread per read. Counts the rows, batches and the read rate since the last reset, the backlog
+    and lost rows come from the reader. An error in a batch is counted and printed, the intake goes on.
+    """
+    def __init__(self, reader, sink, interval=1 / 300, max_rows=None):
+        assert interval > 0, \
+            'The intake interval must be above 0 seconds.'
+
+        self.reader = reader
+        self.sink = sink
+        self.interval = interval
+        self.max_rows = max_rows
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._intake_loop, daemon=True)
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+        self.max_backlog = 0
+
+    def start(self):
+        self.thread.start()
+
+    def _intake_loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.drain()
+            except Exception as error:
+                self.errors += 1
+                print(f'SAMPLE INTAKE ERROR: {error}')
+
+    def drain(self):
+        """reads everything that is available right now, also usable without the thread
+        """
+        self.max_backlog = max(self.max_backlog, self.reader.backlog())
+        samples = self.reader.read(self.max_rows)
+        if len(samples):
+            self.rows += len(samples)
+            self.batches += 1
+            self.sink(samples)
+        return len(samples)
+
+    def statistics(self):
+        duration = time.perf_counter() - self.start_time
+        return {
+            'rows': self.rows,
+            'batches': self.batches,
+            'rate': self.rows / duration if duration > 0 else 0.,
+            'backlog': self.reader.backlog(),
+            'max_backlog': self.max_backlog,
+            'lost': self.reader.lost,
+            'errors': self.errors
+        }
+
+    def report(self):
+        stats = self.statistics()
+        return (f'INTAKE: {stats["rows"]} rows in {stats["batches"]} batches ({stats["rate"]:.0f} rows/s), '
+                f'backlog {stats["backlog"]} (max {stats["max_backlog"]}), {stats["lost"]} lost, '
+                f'{stats["errors"]} errors')
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
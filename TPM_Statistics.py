@@ -1,5 +1,5 @@
 import tkinter as tk
-from pandas import DataFrame, plotting
+from pandas import plotting
 import time
 import screeninfo
 from tkinter import Tk, RIGHT, BOTH, LEFT, BOTTOM, NW, TOP, N, W, E, S, Y
@@ -8,8 +8,17 @@ import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import datetime
+import math
+import os
+import queue
 import random as rdm
+import threading
+from collections import deque
 from threading import Timer
+import numpy as np
+import TPM_Records
+import TPM_Timing
+import TPM_RingBuffer
 
 MENU_BACKGROUND_COLOR = (228, 55, 36)
 MENUBAR_BACKGROUND_COLOR = (170, 65, 50)
@@ -22,6 +31,312 @@ def _from_rgb(rgb):
     return "#%02x%02x%02x" % rgb
 
 
+TRACE_COLUMNS = ('Timestamp', 'Position', 'Speed')
+
+
+class TraceStore:
+    """
+    Column store of the traces of one trial. Every column is a preallocated float64 array which doubles its size
+    when it is full, so appending is amortized O(1) and the plots get views instead of converted lists. Appending
+    (intake thread) and taking views (drawing) are guarded by a lock, so all views of one call have the same length.
+    """
+    def __init__(self, columns=TRACE_COLUMNS, capacity=4096):
+        assert isinstance(capacity, int) and capacity > 0, \
+            'The capacity must be an integer above 0.'
+
+        self.columns = tuple(columns)
+        self.data = np.zeros((len(self.columns), capacity))
+        self.length = 0
+        # Changes with every extend and clear, a consumer only redraws if it differs from the last drawn one
+        self.version = 0
+        # Changes with every clear only, i.e. once per trial
+        self.clears = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, name):
+        return self.views(name)[0]
+
+    def clear(self):
+        with self.lock:
+            self.length = 0
+            self.version += 1
+            self.clears += 1
+
+    def extend(self, rows, column_indices=None):
+        """
+        :param rows: 2d array with one row per sample
+        :param column_indices: columns of rows in the order of the store columns, defaults to the same order
+        """
+        if column_indices is None:
+            column_indices = range(len(self.columns))
+        with self.lock:
+            new_length = self.length + len(rows)
+            if new_length > self.data.shape[1]:
+                capacity = self.data.shape[1]
+                while capacity < new_length:
+                    capacity *= 2
+                data = np.zeros((len(self.columns), capacity))
+                data[:, :self.length] = self.data[:, :self.length]
+                self.data = data
+            for store_index, row_index in enumerate(column_indices):
+                self.data[store_index, self.length:new_length] = rows[:, row_index]
+            self.length = new_length
+            self.version += 1
+
+    def views(self, *names):
+        """returns views (no copies) on the stored part of the given columns, all columns if no name is given
+        """
+        names = names if names else self.columns
+        with self.lock:
+            return tuple(self.data[self.columns.index(name), :self.length] for name in names)
+
+
+
+TRACE_PHASES = ('Trial', 'Reward', 'Inter-Trial')
+
+
+class TraceArchive:
+    """
+    Per-session store of the traces the tracer has shown. The arrays of every finished trial are appended to one
+    record file (with the trial number as first column) and its phase boundaries to a second one next to it. Writing
+    and flushing happen in a background thread after every trial, so a crash loses at most the running trial and
+    read_trace_archive restores all earlier ones (python TPM_Dashboard.py --replay <trace file> shows them again).
+    """
+    def __init__(self, file_location, columns=TRACE_COLUMNS):
+        self.file_location = file_location
+        self.phase_location = phase_file_location(file_location)
+        self.columns = tuple(columns)
+        self.trials = 0
+        self.last_trial = None
+        self.errors = 0
+
+        field_types = dict(TPM_Records.FIELD_TYPES, Trial='<u4', Phase='u1')
+        meta = {'phases': TRACE_PHASES}
+        self.trace_writer = TPM_Records.RecordWriter(file_location, ('Trial',) + self.columns,
+                                                     field_types=field_types, meta=meta)
+        self.phase_writer = TPM_Records.RecordWriter(self.phase_location, ('Trial', 'Phase', 'Start'),
+                                                     field_types=field_types, meta=meta)
+
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            trial, traces, phases = job
+            try:
+                self.trace_writer.extend(np.rec.fromarrays((np.full(len(traces[0]), trial),) + traces,
+                                                           dtype=self.trace_writer.dtype))
+                self.phase_writer.extend(np.array([(trial, TRACE_PHASES.index(phase), start)
+                                                   for phase, start in phases], dtype=self.phase_writer.dtype))
+                self.trace_writer.flush()
+                self.phase_writer.flush()
+            except Exception as error:
+                # A trial that cannot be written (disk full, unknown phase, ...) must not stop the following ones
+                self.errors += 1
+                print(f'TRACE ARCHIVE ERROR: {error}')
+        self.trace_writer.close()
+        self.phase_writer.close()
+
+    def save_trial(self, trial, trace_store, phases):
+        """
+        Hands a copy of a finished trial to the writer thread. Empty trials and trials that were already saved are
+        skipped, so the end of a trial can be reported more than once (e.g. Dump and Stop).
+        :param trial: number of the trial
+        :param trace_store: TraceStore with the traces of the trial
+        :param phases: list of (phase, start time) tuples, phase is one of TRACE_PHASES
+        """
+        if trial == self.last_trial or not len(trace_store):
+            return
+        self.last_trial = trial
+        traces = tuple(view.copy() for view in trace_store.views(*self.columns))
+        self.jobs.put((trial, traces, list(phases)))
+        self.trials += 1
+
+    def report(self):
+        return f'TRACE ARCHIVE: {self.trials} trials, {self.jobs.qsize()} pending, {self.errors} errors'
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+
+def phase_file_location(file_location):
+    return os.path.splitext(file_location)[0] + '_phases' + TPM_Records.RECORD_EXTENSIONS['binary']
+
+
+def read_trace_archive(file_location):
+    """
+    Reads the traces of a session back, e.g. to show the statistics again after a crash.
+    :param file_location: location of the trace file of a TraceArchive
+    :return: dict of trial number to a tuple of the TraceStore and the list of (phase, start time) of the trial
+    """
+    _, traces = TPM_Records.read_records(file_location)
+    _, phases = TPM_Records.read_records(phase_file_location(file_location))
+    columns = tuple(name for name in traces.dtype.names if name != 'Trial')
+
+    trials = {}
+    for trial in np.unique(traces['Trial']):
+        trial_traces = traces[traces['Trial'] == trial]
+        trace_store = TraceStore(columns, capacity=max(len(trial_traces), 1))
+        trace_store.extend(np.column_stack([trial_traces[name] for name in columns]))
+        trial_phases = [(TRACE_PHASES[phase], start) for _, phase, start in phases[phases['Trial'] == trial].tolist()]
+        trials[int(trial)] = (trace_store, trial_phases)
+    return trials
+
+
+class TraceDownsampler:
+    """
+    Pixel-aware min/max downsampling of the traces. The x-range of the axis is split into one bucket per horizontal
+    pixel and every bucket is drawn as its minimum and maximum, so a line never has more than two points per pixel
+    no matter how long the trial is or how fast the recorder samples. Finished buckets are kept, every update only
+    processes the samples since the last open bucket. A change of the x-range, the axis width or a cleared store
+    starts over.
+    """
+    def __init__(self, column_number=2):
+        self.column_number = column_number
+        self.x_range = None
+        self.pixels = 0
+        self.clears = None
+        self.reset()
+
+    def reset(self):
+        self.done = 0
+        self.length = 0
+        self.x = np.zeros((self.column_number, 1024))
+        self.y = np.zeros((self.column_number, 1024))
+
+    def _buckets(self, timestamps, columns):
+        bucket_ids = np.floor((timestamps - self.x_range[0]) / self.bucket_width).astype(np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket_ids)) + 1))
+        ends = np.append(starts[1:], len(timestamps))
+        x = np.column_stack((timestamps[starts], timestamps[ends - 1])).ravel()
+        y = [np.column_stack((np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts))).ravel()
+             for values in columns]
+        return starts, x, y
+
+    def _store(self, x, y):
+        new_length = self.length + len(x)
+        if new_length > self.x.shape[1]:
+            capacity = max(2 * self.x.shape[1], new_length)
+            self.x = np.concatenate((self.x, np.zeros((self.column_number, capacity - self.x.shape[1]))), axis=1)
+            self.y = np.concatenate((self.y, np.zeros((self.column_number, capacity - self.y.shape[1]))), axis=1)
+        self.x[:, self.length:new_length] = x
+        for column, values in enumerate(y):
+            self.y[column, self.length:new_length] = values
+        self.length = new_length
+
+    def update(self, x_range, pixels, timestamps, columns, clears=None):
+        """
+        :param x_range: (start, end) of the x-axis
+        :param pixels: width of the axis in pixels
+        :param timestamps: all timestamps of the trial
+        :param columns: tuple of the value arrays of the trial, one per line
+        :param clears: clear counter of the TraceStore (read before its views), every new trial starts over
+        :return: list with one (x, y) tuple per column
+        """
+        pixels = max(int(pixels), 1)
+        if tuple(x_range) != self.x_range or pixels != self.pixels or clears != self.clears or \
+                len(timestamps) < self.done:
+            self.x_range = tuple(x_range)
+            self.pixels = pixels
+            self.clears = clears
+            self.bucket_width = (self.x_range[1] - self.x_range[0]) / pixels
+            self.reset()
+
+        if len(timestamps) == self.done:
+            return [(self.x[column, :self.length], self.y[column, :self.length])
+                    for column in range(self.column_number)]
+
+        # All buckets but the last are finished, the last one can still get samples
+        starts, x, y = self._buckets(timestamps[self.done:], [values[self.done:] for values in columns])
+        if len(starts) > 1:
+            self._store(x[:-2], [values[:-2] for values in y])
+            self.done += starts[-1]
+
+        return [(np.concatenate((self.x[column, :self.length], x[-2:])),
+                 np.concatenate((self.y[column, :self.length], y[column][-2:])))
+                for column in range(self.column_number)]
+
+
+class BlitManager:
+    """
+    Blitting for the live parts of the statistics figure. The animated artists are left out of full draws, after
+    every full draw the figure (without them) is cached as background. A frame then only restores the background,
+    draws the animated artists and blits the area of the given axes. The background is invalidated on resize, on
+    changed axis limits and by invalidate() (e.g. new trial, pause text), the next frame is then a full draw.
+    """
+    def __init__(self, figure, animated_artists, blit_axes, frame_history=1000):
+        self.figure = figure
+        self.canvas = figure.canvas
+        self.animated_artists = tuple(animated_artists)
+        self.blit_axes = blit_axes
+        self.background = None
+        self.frame_times = deque(maxlen=frame_history)
+        self.full_draws = 0
+        self.blits = 0
+
+        for artist in self.animated_artists:
+            artist.set_animated(True)
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.canvas.mpl_connect('resize_event', self.invalidate)
+        for axis in set(artist.axes for artist in self.animated_artists):
+            axis.callbacks.connect('xlim_changed', self.invalidate)
+            axis.callbacks.connect('ylim_changed', self.invalidate)
+
+    def _on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self.animated_artists:
+            self.figure.draw_artist(artist)
+
+    @property
+    def valid(self):
+        return self.background is not None
+
+    def invalidate(self, *args):
+        self.background = None
+
+    def update(self):
+        """draws one frame, a full draw if the background is invalid and a blit otherwise
+        """
+        start = time.perf_counter()
+        if self.background is None:
+            self.canvas.draw()
+            self.full_draws += 1
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_animated()
+            self.canvas.blit(self.blit_axes.bbox)
+            self.blits += 1
+        self.frame_times.append(time.perf_counter() - start)
+
+    def statistics(self):
+        frame_times = np.array(self.frame_times)
+        return {
+            'frames': len(frame_times),
+            'full_draws': self.full_draws,
+            'blits': self.blits,
+            'frame_time_p50': float(np.percentile(frame_times, 50)) if len(frame_times) else 0.,
+            'frame_time_p99': float(np.percentile(frame_times, 99)) if len(frame_times) else 0.,
+            'frame_time_max': float(frame_times.max()) if len(frame_times) else 0.
+        }
+
+    def report(self):
+        stats = self.statistics()
+        return (f'DRAWING: {stats["blits"]} blits, {stats["full_draws"]} full draws, frame time '
+                f'p50 {stats["frame_time_p50"] * 1e3:.1f}ms / p99 {stats["frame_time_p99"] * 1e3:.1f}ms / '
+                f'max {stats["frame_time_max"] * 1e3:.1f}ms')
+
+
 class Statistics:
     def __init__(self, trial_types, previous_performance, trial_number=None, trial_plot_span=15,
                  trial_labels=('Blocked', 'Smell', 'Visual', 'Opened')):
@@ -35,7 +350,7 @@ class Statistics:
         if trial_number:
             assert isinstance(trial_number, int) and 0 < trial_number <= len(trial_types), \
                 'Trial number must be an corresponding to the length of trial types or a lower value, greater than 0.'
-        assert isinstance(trial_plot_span, int) and 0 < trial_number <= 101, \
+        assert isinstance(trial_plot_span, int) and 0 < trial_plot_span <= 101, \
             'Trial span must be an integer corresponding to the number of trials visible in the trial_plot.'
 
         self.trial_types = trial_types
@@ -53,22 +368,14 @@ class Statistics:
 
         plotting.register_matplotlib_converters()
 
-        self.trace_data = {
-                'Timestamp': [],
-                'Position': [],
-                'Speed': []
-            }
+        self.trace_data = TraceStore()
 
         self.position_plot, = self.position_axis.plot([], [], label='Position', color='black')
         self.speed_plot, = self.speed_axis.plot([], [], label='Speed', color='blue')
 
         self.trial_axis = plt.subplot2grid((2, 2), (1, 0))
-        x = range(1, len(self.trial_types) + 1)
-        self.trial_axis.set_xticks(x)
-        trial_points = [list(t) for t in zip(x, self.trial_types)]
-        self.trial_markers = [self.trial_axis.plot(*p, marker='o', color='blue', zorder=4, markersize=12.5,
-                                                   fillstyle='none')[0]
-                              for p in trial_points]
+        # Ticks are only generated for the visible trials
+        self.trial_axis.xaxis.set_major_locator(matplotlib.ticker.MultipleLocator(1))
         self.colored_markers = (('blue', 'o'),
                                 ('blue', '<'),
                                 ('green', 'o'),
@@ -76,6 +383,18 @@ class Statistics:
                                 ('red', 'o'),
                                 ('red', '<'))
 
+        # All trials are one collection, colour, fill and marker of every trial are kept in arrays and only the
+        # trials within the trial_plot_span around the current one are handed to the collection
+        self.marker_paths = {}
+        for _, marker in self.colored_markers:
+            marker_style = matplotlib.markers.MarkerStyle(marker)
+            self.marker_paths[marker] = marker_style.get_path().transformed(marker_style.get_transform())
+        self.trial_offsets = np.column_stack((np.arange(1, len(self.trial_types) + 1), self.trial_types)).astype(float)
+        self.trial_edge_colors = np.tile(matplotlib.colors.to_rgba('blue'), (len(self.trial_types), 1))
+        self.trial_face_colors = np.zeros((len(self.trial_types), 4))
+        self.trial_marker_list = ['o'] * len(self.trial_types)
+        self.trial_strip = self.trial_axis.scatter([], [], s=12.5 ** 2, marker='o', linewidths=1., zorder=4)
+
         self.performance_axis = plt.subplot2grid((2, 2), (1, 1))
         self.success_rate = 0
         self.current_performance, = self.performance_axis.bar(datetime.datetime.today(), 0, color='#8c564b')
@@ -114,6 +433,7 @@ class Statistics:
         self.trial_axis.set_title('Trial Types')
         self.trial_axis.set_xlabel('Current Trial')
         self.trial_axis.set_yticks((0, 1, 2, 3))
+        self.trial_axis.set_ylim(-0.5, 3.5)
         self.trial_axis.set_yticklabels(self.trial_plot_labels, rotation=45)
         self.current_trial_marker = self.trial_axis.axvline(self.current_trial, color='cyan',
                                                             linewidth=12.5, zorder=1)
@@ -124,6 +444,7 @@ class Statistics:
         finish_label = self.trial_axis.text(self.trial_number + 0.7, 1, 'Finish Line', rotation=-90, fontsize=12)
         finish_label.set_clip_on(True)
         self.trial_axis.set_xlim(0.5, self.trial_plot_span + 0.5)
+        self.update_trial_strip()
 
         self.performance_axis.set_title('Performance over Time')
         self.performance_axis.set_xlabel('Training on Date')
@@ -162,37 +483,40 @@ class Statistics:
                                                       color='red', bbox=bbox)
         self.pause_text.set_visible(False)
 
-    def update_traces(self, new_data, blit=True):
-        # adapted from https://stackoverflow.com/questions/40126176/fast-live-plotting-in-matplotlib-pyplot
-        self.trace_data = new_data
-
-        if blit:
-            # cache the background
-            position_background = self.statistics_figure.canvas.copy_from_bbox(self.position_axis.bbox)
+        self._blit_manager = None
+        self.trace_downsampler = TraceDownsampler()
 
-        self.position_plot.set_data(self.trace_data['Timestamp'], self.trace_data['Position'])
-        self.speed_plot.set_data(self.trace_data['Timestamp'], self.trace_data['Speed'])
-        self.current_phase.set_width(self.trace_data['Timestamp'][-1] - self.current_phase.get_x())
+    @property
+    def blit_manager(self):
+        # The canvas of the figure is replaced when it is embedded in Tk, so the manager is created on first use
+        if self._blit_manager is None or self._blit_manager.canvas is not self.statistics_figure.canvas:
+            self._blit_manager = BlitManager(self.statistics_figure,
+                                             (self.position_plot, self.speed_plot, self.trial_patch,
+                                              self.reward_patch, self.inter_trial_patch),
+                                             self.position_axis)
+        return self._blit_manager
 
-        if blit:
-            # restore background
-            self.statistics_figure.canvas.restore_region(position_background)
-
-            # redraw just the points
-            try:
-                self.position_axis.draw_artist(self.position_plot)
-                self.speed_axis.draw_artist(self.speed_plot)
-                self.position_axis.draw_artist(self.current_phase)
-
-            except ValueError:
-                print('During trace-plotting a ValueError has occured!')
-
-            # fill in the axes rectangle
-            self.statistics_figure.canvas.blit(self.position_axis.bbox)
+    def update_traces(self, new_data, blit=True):
+        self.trace_data = new_data
 
-        else:
-            # redraw everything
-            self.statistics_figure.canvas.draw()
+        # A clear between the two reads only mixes the trials for one frame, the next one sees the new counter
+        clears = self.trace_data.clears
+        timestamps, positions, speeds = self.trace_data.views('Timestamp', 'Position', 'Speed')
+        (position_x, position_y), (speed_x, speed_y) = self.trace_downsampler.update(
+            self.position_axis.get_xlim(), self.position_axis.bbox.width, timestamps, (positions, speeds), clears)
+        self.position_plot.set_data(position_x, position_y)
+        self.speed_plot.set_data(speed_x, speed_y)
+        self.current_phase.set_width(timestamps[-1] - self.current_phase.get_x())
+
+        if not blit:
+            self.blit_manager.invalidate()
+        self.blit_manager.update()
+
+    def redraw(self):
+        """draws the figure only if something outside of the animated artists changed
+        """
+        if not self.blit_manager.valid:
+            self.blit_manager.update()
 
     def update_phase(self, new_phase):
         end_last_phase = self.current_phase.get_x() + self.current_phase.get_width()
@@ -209,6 +533,31 @@ class Statistics:
             raise ValueError(f'Unknown command received: {new_phase}')
         self.current_phase.set_x(end_last_phase)
 
+    def show_trial(self, trace_store, phases, duration, result_code=0):
+        """
+        Draws a finished trial at once, e.g. one of the trace archive.
+        :param phases: list of (phase, start time) of the trial as kept by the TraceArchive, starting with 'Trial'
+        """
+        self.new_trial(duration, result_code)
+        for phase, start in phases[1:]:
+            self.current_phase.set_width(start - self.current_phase.get_x())
+            self.update_phase(phase)
+        if len(trace_store):
+            self.update_traces(trace_store, blit=False)
+        else:
+            self.redraw()
+
+    def update_trial_strip(self):
+        """hands the trials of the visible part of the trial axis to the collection
+        """
+        x_start, x_end = self.trial_axis.get_xlim()
+        first = max(0, int(math.floor(x_start)) - 1)
+        last = min(len(self.trial_types), int(math.ceil(x_end)))
+        self.trial_strip.set_offsets(self.trial_offsets[first:last])
+        self.trial_strip.set_edgecolors(self.trial_edge_colors[first:last])
+        self.trial_strip.set_facecolors(self.trial_face_colors[first:last])
+        self.trial_strip.set_paths([self.marker_paths[marker] for marker in self.trial_marker_list[first:last]])
+
     def pause_function(self, frequency, counter=0):
         counter = counter % 2
         if counter == 1:
@@ -223,6 +572,7 @@ class Statistics:
         self.pause_text.set_bbox(bbox)
 
         self.pause_text.set_color(color)
+        self.blit_manager.invalidate()
 
         self.pause_thread = Timer(1. / frequency, self.pause_function, args=(frequency, counter,))
         self.pause_thread.daemon = True
@@ -236,14 +586,10 @@ class Statistics:
         if self.pause_thread:
             self.pause_thread.cancel()
         self.pause_text.set_visible(False)
+        self.blit_manager.invalidate()
 
     def new_trial(self, duration, result_code):
         print("new trial!")
-        self.trace_data = {
-                'Timestamp': [],
-                'Position': [],
-                'Speed': []
-            }
 
         self.position_plot.set_data([], [])
         self.speed_plot.set_data([], [])
@@ -259,9 +605,10 @@ class Statistics:
         self.current_phase = self.trial_patch
 
         if self.current_trial > 0:
-            self.trial_markers[self.current_trial - 1].set_fillstyle('full')
-            self.trial_markers[self.current_trial - 1].set_color(self.colored_markers[result_code][0])
-            self.trial_markers[self.current_trial - 1].set_marker(self.colored_markers[result_code][1])
+            color, marker = self.colored_markers[result_code]
+            self.trial_edge_colors[self.current_trial - 1] = matplotlib.colors.to_rgba(color)
+            self.trial_face_colors[self.current_trial - 1] = matplotlib.colors.to_rgba(color)
+            self.trial_marker_list[self.current_trial - 1] = marker
             if result_code > 1:
                 self.success_rate = (self.success_rate * (self.current_trial - 1) + 1) / self.current_trial
                 self.current_performance.set_height(self.success_rate * 100)
@@ -274,15 +621,18 @@ class Statistics:
                 self.current_performance_text.set_text(str(round(self.success_rate * 100, 1)))
 
         self.current_trial += 1
-        self.current_trial_marker.set_xdata(self.current_trial)
+        self.current_trial_marker.set_xdata([self.current_trial])
         plot_border = (self.trial_plot_span - 1) / 2 + 0.5
         self.trial_axis.set_xlim(max(0.5, self.current_trial - plot_border),
                                  max(0.5 + self.trial_plot_span, self.current_trial + plot_border))
+        self.update_trial_strip()
+        # Markers, performance bar and phase patches changed outside of the blitted area
+        self.blit_manager.invalidate()
 
 
 class StatisticsFrame(Frame):
     def __init__(self, screen, root, statistics, text1, text2, trial_number, disk_states, go_event, stop_event,
-                 trial_labels=('Blocked', 'Smell', 'Visual', 'Opened'), show_fps=False, *args, **kwargs):
+                 trial_labels=('Blocked', 'Smell', 'Visual', 'Opened'), show_frame_times=False, *args, **kwargs):
         Frame.__init__(self, root, *args, **kwargs)
         self.screen = screen
         self.root = root
@@ -304,8 +654,8 @@ class StatisticsFrame(Frame):
         self.trial_info_text = tk.StringVar()
         self.experiment_info_text = tk.StringVar()
         self.success_rate_string = '0'
-        self.fps_text = tk.StringVar()
-        self.init_ui(text1, text2, show_fps)
+        self.frame_time_text = tk.StringVar()
+        self.init_ui(text1, text2, show_frame_times)
         self.go_event = go_event
         self.stop_event = stop_event
 
@@ -341,8 +691,9 @@ class StatisticsFrame(Frame):
     def update_phase(self, new_phase):
         self.statistics.update_phase(new_phase)
 
-    def update_fps(self, new_fps):
-        self.fps_text.set(f'Current FPS: {new_fps}')
+    def update_frame_times(self, frame_statistics):
+        self.frame_time_text.set(f'Frame time: {frame_statistics["frame_time_p50"] * 1e3:.1f}ms '
+                                 f'(p99 {frame_statistics["frame_time_p99"] * 1e3:.1f}ms)')
 
     def update_trial(self, duration):
         self.current_trial += 1
@@ -358,7 +709,7 @@ class StatisticsFrame(Frame):
         self.statistics.end_blinking_pause()
         self.statistics.new_trial(duration, rdm.randint(0, 4))
 
-    def init_ui(self, text1, text2, show_fps):
+    def init_ui(self, text1, text2, show_frame_times):
         Style().configure('TFrame', background=_from_rgb(MENU_BACKGROUND_COLOR))
         Style().configure('TButton', font=("Helvetica", 30))
         Style().configure('TLabel', font=("Helvetica", 25), background=_from_rgb(MENU_BACKGROUND_COLOR), spacing3=100)
@@ -410,12 +761,12 @@ class StatisticsFrame(Frame):
                                                                                                  anchor=W)
         self._message_text.set('')
 
-        fps_label = Label(button_frame_outer, textvariable=self.fps_text, style='Message.TLabel')
-        fps_label.place(relx=0.785, rely=0.5, anchor=W)
-        self.fps_text.set('')
+        frame_time_label = Label(button_frame_outer, textvariable=self.frame_time_text, style='Message.TLabel')
+        frame_time_label.place(relx=0.72, rely=0.5, anchor=W)
+        self.frame_time_text.set('')
 
-        if not show_fps:
-            fps_label.place_forget()
+        if not show_frame_times:
+            frame_time_label.place_forget()
 
         button_frame_inner = Frame(button_frame_outer, borderwidth=1)
         button_frame_inner.pack(side=BOTTOM, fill=None, expand=False)
@@ -444,31 +795,9 @@ class StatisticsFrame(Frame):
         self.update_time()
 
 
-def tracer_func(instructions, go_event, stop_event, instruction_pipe, latest_line, screen):
-    # Initialization
-    records = {
-        'Timestamp': [],
-        'Position': [],
-        'Speed': []
-    }
-
-    new_data = None
-    paused = False
-
-    window = Tk()
-    window.overrideredirect(True)
-    window.title("Statistics Window")
-    if screen.x > 0:
-        x_string = f'+{screen.x}'
-    else:
-        x_string = str(screen.x)
-    geometry_string = f'{screen.width}x{screen.height}{x_string}+0'
-    print(geometry_string)
-    window.geometry(geometry_string)
-
-    window.state('normal')
-
-    trial_number = 100
+def placeholder_session(trial_number=100):
+    """random disk states and previous performance, until the tracer gets the real ones from the experiment
+    """
     disk_random = 1 * [0] + 1 * [1] + 1 * [2] + 1 * [3]
     disk_states = tuple(disk_random[int(len(disk_random) * rdm.random())] for _ in range(trial_number))
     performance = {
@@ -477,85 +806,155 @@ def tracer_func(instructions, go_event, stop_event, instruction_pipe, latest_lin
         datetime.datetime.today() - datetime.timedelta(days=14): 20,
         datetime.datetime.today() - datetime.timedelta(days=20): 0
     }
+    return disk_states, performance
 
-    statistics_collection = Statistics(disk_states, performance, trial_number=15, trial_plot_span=11)
 
-    mouse_info = 'Current Mouse: \nName: Mickey \nWeight: Fat \nBirthdate: 01.01.1940 \nMLA-NR: WD-40'
+def statistics_loop(instructions, go_event, instruction_pipe, sample_ring, statistics, name, stream_rate=None,
+                    target_fps=30, trace_location=None, new_trial=None, render_step=None):
+    """
+    Instruction and render loop shared by the tracer window and the headless renderer. Every frame handles the
+    pending instructions (as long as the frame budget lasts) and redraws the statistics only if new samples arrived
+    or the figure was invalidated. Returns after the Stop instruction.
+    :param statistics: Statistics that are drawn
+    :param name: name in the reports, e.g. 'TRACER'
+    :param new_trial: called with the duration of every new trial, defaults to starting it on the statistics
+    :param render_step: called at the end of every frame with whether it was drawn and the FrameClock, e.g. to show
+    or publish the frame
+    """
+    records = TraceStore()
+    # Every finished trial is appended to the trace archive of the session (if a location is given)
+    trace_archive = TraceArchive(trace_location) if trace_location else None
+    trial = 0
+    phases = []
+    paused = False
 
-    rat_info = 'Current Rat: \nName: Steve \nWeight: Fatter \nBirthdate: 01.01.1945 \nMLA-NR: MLA-007'
+    if new_trial is None:
+        def new_trial(duration):
+            statistics.end_blinking_pause()
+            statistics.new_trial(duration, rdm.randint(0, 4))
 
-    statistics_frame = StatisticsFrame(screen, window, statistics_collection, mouse_info, rat_info, 15, disk_states,
-                                       go_event, stop_event, show_fps=True)
-    window.update()
+    # Subscribes to the decimated stream of stream_rate (if the recorder publishes one), the mean keeps the name
+    sample_reader = sample_ring.reader(rate=stream_rate) if stream_rate else sample_ring.reader()
+    trace_stream = sample_reader.ring
+    stream_monitor = TPM_Timing.StreamMonitor(f'{name} STREAM')
+
+    record_columns = [trace_stream.column(column) for column in records.columns]
+
+    def take_samples(new_samples):
+        stream_monitor.update(new_samples, trace_stream.epoch)
+        records.extend(new_samples, record_columns)
+
+    # One thread drains the stream in batches for the whole session
+    sample_intake = TPM_RingBuffer.SampleIntake(sample_reader, take_samples)
+    sample_intake.start()
+
+    frame_clock = TPM_Timing.FrameClock(target_fps)
+    drawn_version = None
+    running = True
+
+    while running:
+        frame_clock.begin()
 
-    def update_data(current_line, shared_array, target_fps=300):
-        start = time.perf_counter()
-        if current_line != list(shared_array):
-            current_line = list(shared_array)
-            records['Timestamp'].append(current_line[0])
-            records['Position'].append(current_line[1])
-            records['Speed'].append(current_line[2])
-        target = 1. / target_fps
-        passed = time.perf_counter() - start
-        differ = target - passed
-        t = Timer(differ, update_data, args=(current_line, shared_array, target_fps, ))
-        t.daemon = True
-        t.start()
-
-    update_data(new_data, latest_line)
-
-    start_time = time.perf_counter()
-    x = 0.5
-    counter = 0
-
-    while True:
         # Check for new instructions
-        if instruction_pipe.poll():
+        while running and instruction_pipe.poll() and frame_clock.remaining() > 0:
             command = instruction_pipe.recv()
             if command is instructions.Pause:
                 paused = True
-                statistics_frame.statistics.show_blinking_pause()
+                statistics.show_blinking_pause()
             elif command is instructions.Ready:
                 paused = False
-                records = {
-                    'Timestamp': [],
-                    'Position': [],
-                    'Speed': []
-                }
+                records.clear()
+                phases = [('Trial', 0.)]
                 go_event.set()
             elif command is instructions.Reset:
+                print(stream_monitor.report())
+                print(sample_intake.report())
+                print(statistics.blit_manager.report())
+                print(frame_clock.report())
+                stream_monitor.reset()
+                frame_clock.reset()
+                sample_intake.reset()
+                if trace_archive:
+                    trace_archive.save_trial(trial, records, phases)
+                trial += 1
                 duration = instruction_pipe.recv()
-                statistics_frame.update_trial(duration)
+                new_trial(duration)
                 paused = True
             elif command is instructions.Dump:
-                df = DataFrame(records)
-                df.to_csv('TRACER.csv')
+                if trace_archive:
+                    trace_archive.save_trial(trial, records, phases)
             elif command is instructions.Phase:
                 new_phase = instruction_pipe.recv()
-                statistics_frame.update_phase(new_phase)
+                statistics.update_phase(new_phase)
+                phases.append((new_phase, statistics.current_phase.get_x()))
             elif command is instructions.Stop:
-                break
+                if trace_archive:
+                    trace_archive.save_trial(trial, records, phases)
+                running = False
             else:
                 raise ValueError(f'Unknown command received: {command}')
 
-        statistics_frame.root.update()
-
+        drawn = False
         if paused:
-            statistics_frame.statistics.statistics_figure.canvas.draw()
-            time.sleep(50 / 1000)
-            continue
+            # Only the blinking pause text changes, it invalidates the figure when it needs a new draw
+            drawn = not statistics.blit_manager.valid
+            statistics.redraw()
+        elif len(records) and (records.version != drawn_version or not statistics.blit_manager.valid):
+            drawn_version = records.version
+            statistics.update_traces(records)
+            drawn = True
 
-        if records['Timestamp']:
-            statistics_frame.statistics.update_traces(records)
+        if render_step is not None:
+            render_step(drawn, frame_clock)
 
-        counter += 1
-        if (time.perf_counter() - start_time) > x:
-            statistics_frame.update_fps(int(counter / (time.perf_counter() - start_time)))
-            print("FPS: ", counter / (time.perf_counter() - start_time))
-            counter = 0
-            start_time = time.perf_counter()
+        frame_clock.end(drawn)
+
+    sample_intake.stop()
+    if trace_archive:
+        trace_archive.close()
+        print(trace_archive.report())
+
+
+def tracer_func(instructions, go_event, stop_event, instruction_pipe, sample_ring, screen, stream_rate=None,
+                target_fps=30, trace_location=None):
+    window = Tk()
+    window.overrideredirect(True)
+    window.title("Statistics Window")
+    if screen.x > 0:
+        x_string = f'+{screen.x}'
+    else:
+        x_string = str(screen.x)
+    geometry_string = f'{screen.width}x{screen.height}{x_string}+0'
+    print(geometry_string)
+    window.geometry(geometry_string)
+
+    window.state('normal')
+
+    disk_states, performance = placeholder_session()
+
+    statistics_collection = Statistics(disk_states, performance, trial_number=15, trial_plot_span=11)
+
+    mouse_info = 'Current Mouse: \nName: Mickey \nWeight: Fat \nBirthdate: 01.01.1940 \nMLA-NR: WD-40'
+
+    rat_info = 'Current Rat: \nName: Steve \nWeight: Fatter \nBirthdate: 01.01.1945 \nMLA-NR: MLA-007'
+
+    statistics_frame = StatisticsFrame(screen, window, statistics_collection, mouse_info, rat_info, 15, disk_states,
+                                       go_event, stop_event, show_frame_times=True)
+    window.update()
+
+    label_update = time.perf_counter()
+
+    def show_frame(drawn, frame_clock):
+        # Tk processes its events every frame, the frame time label is updated twice per second
+        nonlocal label_update
+        statistics_frame.root.update()
+        if time.perf_counter() - label_update > 0.5:
+            statistics_frame.update_frame_times(frame_clock.statistics())
+            label_update = time.perf_counter()
 
-    print(len(records['Timestamp']))
+    statistics_loop(instructions, go_event, instruction_pipe, sample_ring, statistics_collection, 'TRACER',
+                    stream_rate, target_fps, trace_location, new_trial=statistics_frame.update_trial,
+                    render_step=show_frame)
     print('TRACER STOPPED.')
 
 
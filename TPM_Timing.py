@@ -0,0 +1,250 @@
+import threading
+import time
+from array import array
+from collections import deque
+import numpy as np
+
+# Bin edges of the lateness histogram in seconds
+LATENESS_BINS = (0., 10e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, float('inf'))
+
+
+def _format_seconds(seconds):
+    if seconds == float('inf'):
+        return 'inf'
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.0f}µs'
+    return f'{seconds * 1e3:.1f}ms'
+
+
+class DeadlineScheduler:
+    """
+    Paces a sampling loop on absolute deadlines (start + n * period), so a late sample does not shift all following
+    ones. The wait sleeps until shortly before the deadline and spins for the last spin_tail seconds. Deadlines that
+    are missed by more than a whole period are either skipped (catch_up=False) or sampled back to back
+    (catch_up=True). Lateness and inter-sample interval of every sample are kept until the next reset.
+    If target_sps is None, the scheduler does not wait at all and only records the intervals.
+    """
+    def __init__(self, target_sps=None, spin_tail=0.0005, catch_up=False):
+        assert target_sps is None or target_sps > 0, \
+            'The target sampling rate must be above 0 or None for an unlimited rate.'
+        assert spin_tail >= 0, \
+            'The spin tail must be a duration in seconds (0 or more).'
+
+        self.period = 1. / target_sps if target_sps else None
+        self.spin_tail = spin_tail
+        self.catch_up = catch_up
+
+        self.start_time = time.perf_counter()
+        self.index = 0
+        self.last_sample = None
+        self.missed = 0
+        self.lateness = array('d')
+        self.intervals = array('d')
+
+    @property
+    def target_sps(self):
+        return 1. / self.period if self.period else None
+
+    def reset(self):
+        self.missed = 0
+        self.last_sample = None
+        self.lateness = array('d')
+        self.intervals = array('d')
+
+    def start(self, start_time=None):
+        """anchors the deadlines at start_time (default now), the first sample is due immediately
+        """
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.index = 0
+        self.last_sample = None
+
+    def set_rate(self, target_sps):
+        """changes the rate, the next deadline stays where it is and the following ones use the new period
+        """
+        next_deadline = self.start_time + self.index * self.period if self.period else time.perf_counter()
+        self.period = 1. / target_sps if target_sps else None
+        self.start(next_deadline)
+
+    def wait(self):
+        """
+        Blocks until the next deadline.
+        :return: lateness of this sample in seconds
+        """
+        if self.period is None:
+            now = time.perf_counter()
+            lateness = 0.
+        else:
+            deadline = self.start_time + self.index * self.period
+            remaining = deadline - time.perf_counter()
+            if remaining > self.spin_tail:
+                time.sleep(remaining - self.spin_tail)
+            now = time.perf_counter()
+            while now < deadline:
+                now = time.perf_counter()
+            lateness = now - deadline
+
+            self.index += 1
+            if lateness >= self.period:
+                missed = int(lateness / self.period)
+                self.missed += missed
+                if not self.catch_up:
+                    self.index += missed
+
+        self.lateness.append(lateness)
+        if self.last_sample is not None:
+            self.intervals.append(now - self.last_sample)
+        self.last_sample = now
+        return lateness
+
+    def statistics(self):
+        """
+        Summarizes the samples since the last reset.
+        :return: dict with counts, percentiles of lateness and interval (in seconds) and the lateness histogram
+        """
+        lateness = np.frombuffer(self.lateness, dtype=np.float64)
+        intervals = np.frombuffer(self.intervals, dtype=np.float64)
+        histogram, _ = np.histogram(lateness, bins=LATENESS_BINS)
+        late_limit = self.period / 2 if self.period else float('inf')
+        return {
+            'samples': len(lateness),
+            'late': int(np.count_nonzero(lateness > late_limit)),
+            'missed': self.missed,
+            'lateness_p50': float(np.percentile(lateness, 50)) if len(lateness) else 0.,
+            'lateness_p99': float(np.percentile(lateness, 99)) if len(lateness) else 0.,
+            'lateness_max': float(lateness.max()) if len(lateness) else 0.,
+            'interval_p50': float(np.percentile(intervals, 50)) if len(intervals) else 0.,
+            'interval_p99': float(np.percentile(intervals, 99)) if len(intervals) else 0.,
+            'histogram': histogram.tolist()
+        }
+
+    def report(self):
+        stats = self.statistics()
+        if not stats['samples']:
+            return 'TIMING: no samples.'
+
+        intervals = (f'interval p50 {_format_seconds(stats["interval_p50"])} / '
+                     f'p99 {_format_seconds(stats["interval_p99"])}')
+        if not self.period:
+            return f'TIMING: {stats["samples"]} samples, {intervals}'
+
+        bins = [f'{_format_seconds(low)}-{_format_seconds(high)}: {count}' for low, high, count
+                in zip(LATENESS_BINS[:-1], LATENESS_BINS[1:], stats['histogram'])]
+        return (f'TIMING: {stats["samples"]} samples, {stats["late"]} late (more than half a period), '
+                f'{stats["missed"]} missed deadlines, lateness p50 {_format_seconds(stats["lateness_p50"])} / '
+                f'p99 {_format_seconds(stats["lateness_p99"])} / max {_format_seconds(stats["lateness_max"])}, '
+                f'{intervals}\n'
+                'LATENESS: ' + ' | '.join(bins))
+
+
+class StreamMonitor:
+    """
+    Consumer side counterpart of the DeadlineScheduler. Counts the rows a consumer reads from the sample ring and
+    the end-to-end lag of every row, i.e. the time between the moment the row was due on the recorder clock
+    (ring epoch + timestamp) and the moment the consumer got it. Kept until the next reset.
+    update may run on another thread (e.g. a SampleIntake) than statistics and reset, the counters are locked.
+    """
+    def __init__(self, name='STREAM', timestamp_column=0):
+        self.name = name
+        self.timestamp_column = timestamp_column
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.perf_counter()
+            self.rows = 0
+            self.lags = array('d')
+
+    def update(self, samples, epoch):
+        """
+        :param samples: rows of one read of a RingReader
+        :param epoch: epoch of the sample ring, the lag is not measured while it is None
+        """
+        now = time.perf_counter()
+        lags = now - (epoch + samples[:, self.timestamp_column]) if epoch is not None and len(samples) else None
+        with self.lock:
+            self.rows += len(samples)
+            if lags is not None:
+                self.lags.frombytes(lags.astype(np.float64).tobytes())
+
+    def statistics(self):
+        # A copy, a view on the array would block update from growing it
+        with self.lock:
+            lags = np.array(self.lags, dtype=np.float64)
+            rows = self.rows
+            duration = time.perf_counter() - self.start_time
+        return {
+            'rows': rows,
+            'duration': duration,
+            'throughput': rows / duration if duration > 0 else 0.,
+            'lag_p50': float(np.percentile(lags, 50)) if len(lags) else 0.,
+            'lag_p99': float(np.percentile(lags, 99)) if len(lags) else 0.,
+            'lag_max': float(lags.max()) if len(lags) else 0.
+        }
+
+    def report(self):
+        stats = self.statistics()
+        if not stats['rows']:
+            return f'{self.name}: no samples.'
+        return (f'{self.name}: {stats["rows"]} rows in {stats["duration"]:.1f}s ({stats["throughput"]:.0f} sps), '
+                f'lag p50 {_format_seconds(max(stats["lag_p50"], 0.))} / '
+                f'p99 {_format_seconds(max(stats["lag_p99"], 0.))} / max {_format_seconds(max(stats["lag_max"], 0.))}')
+
+
+class FrameClock:
+    """
+    Paces a render loop at target_fps. Every frame has a budget of one period, remaining() tells a frame how much of
+    it is left (e.g. to stop handling messages in time). The work time of the recent frames (without the wait) and the
+    number of frames without redraw are kept for the display and until the next reset.
+    """
+    def __init__(self, target_fps=30, history=300):
+        self.scheduler = DeadlineScheduler(target_fps, spin_tail=0.)
+        self.frame_times = deque(maxlen=history)
+        self.frame_start = time.perf_counter()
+        self.frames = 0
+        self.skipped = 0
+        self.scheduler.start()
+
+    @property
+    def budget(self):
+        return self.scheduler.period
+
+    def reset(self):
+        """clears the statistics, the deadlines of the frames stay where they are
+        """
+        self.scheduler.reset()
+        self.frame_times.clear()
+        self.frames = 0
+        self.skipped = 0
+
+    def begin(self):
+        self.frame_start = time.perf_counter()
+
+    def remaining(self):
+        return self.budget - (time.perf_counter() - self.frame_start)
+
+    def end(self, drawn=True):
+        """closes the frame and waits for the start of the next one
+        """
+        self.frame_times.append(time.perf_counter() - self.frame_start)
+        self.frames += 1
+        if not drawn:
+            self.skipped += 1
+        self.scheduler.wait()
+
+    def statistics(self):
+        frame_times = np.array(self.frame_times)
+        return {
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'missed': self.scheduler.missed,
+            'frame_time_p50': float(np.percentile(frame_times, 50)) if len(frame_times) else 0.,
+            'frame_time_p99': float(np.percentile(frame_times, 99)) if len(frame_times) else 0.,
+            'frame_time_max': float(frame_times.max()) if len(frame_times) else 0.
+        }
+
+    def report(self):
+        stats = self.statistics()
+        return (f'FRAMES: {stats["frames"]} frames, {stats["skipped"]} without redraw, {stats["missed"]} over '
+                f'budget, frame time p50 {_format_seconds(stats["frame_time_p50"])} / '
+                f'p99 {_format_seconds(stats["frame_time_p99"])} / max {_format_seconds(stats["frame_time_max"])}')
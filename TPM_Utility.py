@@ -8,6 +8,14 @@ class Instructions(Enum):
     End_Trial = auto()
     Sending_Records = auto()
     Stop_Experiment = auto()
+    Prepare = auto()
+    Pause = auto()
+    Go = auto()
+    Reset = auto()
+    Phase = auto()
+    Dump = auto()
+    SamplingRate = auto()
+    Stop = auto()
 
 
 class Phases(Enum):